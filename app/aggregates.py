@@ -0,0 +1,96 @@
+from heapq import heapify, heappop, heappush
+
+
+class Aggregate:
+    """Running count, sum, min and max over a multiset of readings.
+
+    Adds and removes are O(log n). Min and max come from heaps with lazy
+    deletion: values that are no longer present are popped only when they
+    reach the top, so reads are amortized O(1).
+    """
+
+    __slots__ = ("count", "total", "counts", "low", "high")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.counts = {}  # value -> multiplicity
+        self.low = []
+        self.high = []  # negated values
+
+    def __getstate__(self):
+        # The heaps are rebuilt on load, which also drops their stale entries
+        return self.count, self.total, dict(self.counts)
+
+    def __setstate__(self, state):
+        self.count, self.total, self.counts = state
+        self._rebuild()
+
+    def add(self, value: int):
+        self.count += 1
+        self.total += value
+        seen = self.counts.get(value, 0)
+        self.counts[value] = seen + 1
+        if not seen:
+            heappush(self.low, value)
+            heappush(self.high, -value)
+            if len(self.low) > 2 * len(self.counts) + 16:
+                self._rebuild()
+
+    def remove(self, value: int):
+        self.count -= 1
+        self.total -= value
+        left = self.counts[value] - 1
+        if left:
+            self.counts[value] = left
+        else:
+            del self.counts[value]
+
+    def subtract(self, other: "Aggregate"):
+        """Remove every reading counted in `other`, in O(distinct values)."""
+        self.count -= other.count
+        self.total -= other.total
+        for value, times in other.counts.items():
+            left = self.counts[value] - times
+            if left:
+                self.counts[value] = left
+            else:
+                del self.counts[value]
+
+    def merge(self, other: "Aggregate"):
+        """Add back every reading counted in `other`; undoes `subtract`."""
+        self.count += other.count
+        self.total += other.total
+        for value, times in other.counts.items():
+            seen = self.counts.get(value, 0)
+            self.counts[value] = seen + times
+            if not seen:
+                heappush(self.low, value)
+                heappush(self.high, -value)
+        if len(self.low) > 2 * len(self.counts) + 16:
+            self._rebuild()
+
+    def replace(self, old: int, new: int):
+        if old != new:
+            self.remove(old)
+            self.add(new)
+
+    def _rebuild(self):
+        # Drop stale heap entries left behind by removed values
+        self.low = list(self.counts)
+        self.high = [-value for value in self.counts]
+        heapify(self.low)
+        heapify(self.high)
+
+    def min(self):
+        while self.low[0] not in self.counts:
+            heappop(self.low)
+        return self.low[0]
+
+    def max(self):
+        while -self.high[0] not in self.counts:
+            heappop(self.high)
+        return -self.high[0]
+
+    def summary(self) -> dict:
+        return {"count": self.count, "min": self.min(), "max": self.max(), "mean": self.total / self.count}
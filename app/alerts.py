@@ -0,0 +1,111 @@
+from collections import deque
+import itertools
+import math
+import threading
+import time
+
+from .indexes import SortedIndex
+from .models import Rule
+
+# Fired alerts kept for GET /alerts
+MAX_ALERTS = 10_000
+
+
+def bound(rule: Rule) -> int:
+    # device_info is an int, so every rule becomes "value >= bound" or "value <= bound"
+    if rule.op == ">":
+        return math.floor(rule.threshold) + 1
+    if rule.op == ">=":
+        return math.ceil(rule.threshold)
+    if rule.op == "<":
+        return math.ceil(rule.threshold) - 1
+    return math.floor(rule.threshold)
+
+
+class RuleIndex:
+    """Threshold rules indexed so a reading only touches rules it can match.
+
+    Rules are grouped by (scope, device_type), with scope a `(kind, id)` pair or
+    None for everywhere, and each group keeps "above" and "below" rules sorted by
+    bound. A reading looks up the groups of its room or hallway, floor, house and
+    the global scope (for its type and for any type) and takes the matching
+    prefix or suffix of each: O(log n + matches) whatever the rule count.
+
+    Alerts are edge-triggered: a rule fires for a device when a reading starts
+    matching it and again only after a reading has stopped matching it.
+    """
+
+    def __init__(self, max_alerts: int = MAX_ALERTS):
+        self.rules = {}
+        self.above = {}  # (scope, device_type) -> SortedIndex of (bound, rule_id)
+        self.below = {}
+        self.active = {}  # device_id -> rule ids its last reading matched
+        self.alerts = deque(maxlen=max_alerts)
+        self.next_alert = 1
+        self.lock = threading.Lock()
+
+    def __contains__(self, rule_id):
+        return rule_id in self.rules
+
+    def _group(self, rule: Rule):
+        side = self.above if rule.op in (">", ">=") else self.below
+        scope = None if rule.scope is None else (rule.scope, rule.scope_id)
+        return side, (scope, rule.device_type)
+
+    def add(self, rule: Rule):
+        side, key = self._group(rule)
+        entry = (bound(rule), rule.rule_id)  # first, so a bad threshold leaves nothing behind
+        self.rules[rule.rule_id] = rule
+        side.setdefault(key, SortedIndex()).add(entry)
+
+    def remove(self, rule_id: int):
+        rule = self.rules.pop(rule_id, None)
+        if rule is not None:
+            side, key = self._group(rule)
+            side[key].discard((bound(rule), rule_id))
+        return rule
+
+    def matching(self, scopes: list, device_type: str, value: int) -> set:
+        matched = set()
+        for scope in scopes + [None]:
+            for key in ((scope, device_type), (scope, None)):
+                above = self.above.get(key)
+                if above is not None:
+                    matched.update(rule_id for _, rule_id in above.scan(high=(value, math.inf)))
+                below = self.below.get(key)
+                if below is not None:
+                    matched.update(rule_id for _, rule_id in below.scan(low=(value, -math.inf)))
+        return matched
+
+    def evaluate(self, device_id: int, device_type: str, value: int, scopes: list, house_id: int) -> list:
+        """Record a reading and return the alerts it fires."""
+        matched = self.matching(scopes, device_type, value) if self.rules else set()
+        previous = self.active.get(device_id, set())
+        if matched:
+            self.active[device_id] = matched
+        else:
+            self.active.pop(device_id, None)
+        fired = []
+        for rule_id in sorted(matched - previous):
+            rule = self.rules.get(rule_id)
+            if rule is None:
+                continue
+            with self.lock:
+                alert = {"alert_id": self.next_alert, "rule_id": rule_id, "device_id": device_id,
+                         "device_type": device_type, "value": value, "op": rule.op,
+                         "threshold": rule.threshold, "house_id": house_id, "ts": time.time()}
+                self.next_alert += 1
+                self.alerts.append(alert)
+            fired.append(alert)
+        return fired
+
+    def forget(self, device_id: int):
+        self.active.pop(device_id, None)
+
+    def since(self, after: int = 0, limit: int = 100) -> list:
+        with self.lock:
+            if not self.alerts:
+                return []
+            # Alert ids are consecutive, so the start is an offset, not a search
+            start = max(0, after - self.alerts[0]["alert_id"] + 1)
+            return list(itertools.islice(self.alerts, start, start + limit))
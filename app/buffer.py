@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Distinct devices allowed to wait in the buffer before writes are refused
+MAX_PENDING = 100_000
+
+
+class Overloaded(Exception):
+    """Raised by `offer` when the buffer cannot take the readings."""
+
+
+class WriteBuffer:
+    """Coalesces device readings and applies them in batches on a writer thread.
+
+    `offer` records the latest value per device (last write wins) and returns
+    at once; every `window` seconds the writer hands everything pending to
+    `apply` as one list of readings. At most `max_pending` distinct devices
+    wait at a time, so overload turns into refused writes instead of a
+    backlog whose latency keeps growing.
+    """
+
+    def __init__(self, apply, window: float, max_pending: int = MAX_PENDING):
+        self.apply = apply
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = {}  # device_id -> latest device_info
+        self.lock = threading.Lock()
+        # One flush at a time, so batches are applied in the order they were taken
+        self.flushing = threading.Lock()
+        self.accepted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.thread = threading.Thread(target=self._run, name="write-buffer", daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def offer(self, readings: list):
+        """Queue `(device_id, device_info)` pairs, all of them or none."""
+        with self.lock:
+            new = {device_id for device_id, _ in readings if device_id not in self.pending}
+            if len(self.pending) + len(new) > self.max_pending:
+                self.rejected += len(readings)
+                raise Overloaded
+            for device_id, device_info in readings:
+                self.pending[device_id] = device_info
+            self.accepted += len(readings)
+            self.coalesced += len(readings) - len(new)
+
+    def flush(self):
+        with self.flushing:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if pending:
+                self.apply([{"device_id": device_id, "device_info": device_info}
+                            for device_id, device_info in pending.items()])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"pending": len(self.pending), "accepted": self.accepted,
+                    "coalesced": self.coalesced, "rejected": self.rejected}
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Applying buffered writes failed")
@@ -0,0 +1,38 @@
+from collections import deque
+import itertools
+
+# Changes kept per house before older ones are compacted into a resync marker
+DEFAULT_LIMIT = 1024
+
+
+class ChangeLog:
+    """The recent changes to one house, each tagged with the version it produced.
+
+    Every version bump appends exactly one change, so versions in `entries`
+    are consecutive and `since` is an offset, not a search. Once more than
+    `limit` changes pile up the oldest are dropped; asking for changes from
+    before `start` then returns None, telling the client to resync.
+    """
+
+    __slots__ = ("entries", "start")
+
+    def __init__(self, version: int = 0, limit: int = DEFAULT_LIMIT):
+        self.entries = deque(maxlen=limit)
+        self.start = version  # every change after this version is in entries
+
+    def append(self, version: int, change: dict):
+        if not self.entries.maxlen:
+            self.start = version  # a limit of 0 keeps nothing; any older version resyncs
+            return
+        if len(self.entries) == self.entries.maxlen:
+            self.start = self.entries[0]["version"]
+        self.entries.append({"version": version, **change})
+
+    def pop(self):
+        if self.entries:
+            self.entries.pop()
+
+    def since(self, version: int):
+        if version < self.start:
+            return None
+        return list(itertools.islice(self.entries, version - self.start, None))
@@ -0,0 +1,101 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import time
+
+DEFAULT_CAPACITY = 1024
+
+
+class DeviceHistory:
+    """Fixed-capacity ring buffer of (timestamp, value) readings.
+
+    Samples live in two typed arrays (8 bytes each) instead of one Python
+    object per reading; once full, the oldest reading is overwritten.
+    """
+
+    __slots__ = ("capacity", "timestamps", "values", "head")
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array("d")
+        self.values = array("q")
+        self.head = 0  # next slot to overwrite once the buffer is full
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, value: int, ts: float = None):
+        if ts is None:
+            ts = time.time()
+        # Keep timestamps non-decreasing so range lookups can bisect.
+        if self.timestamps:
+            last = self.timestamps[self.head - 1]
+            if ts < last:
+                ts = last
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(ts)
+            self.values.append(value)
+            return
+        self.timestamps[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+
+    def checkpoint(self):
+        """State to pass to `rollback` to undo the appends made after this."""
+        if len(self.timestamps) < self.capacity:
+            return (len(self.timestamps), self.head, None, None)
+        return (len(self.timestamps), self.head, self.timestamps[self.head], self.values[self.head])
+
+    def rollback(self, checkpoint):
+        # Checkpoints are rolled back newest first, one append at a time
+        size, head, ts, value = checkpoint
+        if ts is None:
+            del self.timestamps[size:]
+            del self.values[size:]
+        else:
+            self.timestamps[head] = ts
+            self.values[head] = value
+        self.head = head
+
+    def ordered(self):
+        # Rotate the ring into chronological order with two C-level slices.
+        if self.head == 0:
+            return self.timestamps, self.values
+        h = self.head
+        return (self.timestamps[h:] + self.timestamps[:h],
+                self.values[h:] + self.values[:h])
+
+    def window(self, start: float = None, end: float = None):
+        ts, vals = self.ordered()
+        lo = 0 if start is None else bisect_left(ts, start)
+        hi = len(ts) if end is None else bisect_right(ts, end)
+        return ts[lo:hi], vals[lo:hi]
+
+    def samples(self, start: float = None, end: float = None):
+        ts, vals = self.window(start, end)
+        return [{"ts": t, "value": v} for t, v in zip(ts, vals)]
+
+    def downsample(self, buckets: int, start: float = None, end: float = None):
+        ts, vals = self.window(start, end)
+        if not ts:
+            return []
+        lo_ts = ts[0] if start is None else start
+        hi_ts = ts[-1] if end is None else end
+        width = (hi_ts - lo_ts) / buckets or 1.0
+        result = []
+        lo = 0
+        for b in range(buckets):
+            b_start = lo_ts + b * width
+            b_end = hi_ts if b == buckets - 1 else b_start + width
+            hi = bisect_right(ts, b_end) if b == buckets - 1 else bisect_left(ts, b_end, lo)
+            if hi > lo:
+                chunk = vals[lo:hi]
+                result.append({
+                    "start": b_start,
+                    "end": b_end,
+                    "count": hi - lo,
+                    "min": min(chunk),
+                    "max": max(chunk),
+                    "mean": sum(chunk) / (hi - lo),
+                })
+            lo = hi
+        return result
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+# Distinct devices a subscriber may have waiting before further ones are dropped
+MAX_PENDING = 1024
+
+
+class Subscription:
+    """One subscriber's pending updates, coalesced to the latest per device.
+
+    Producers call `offer` from any thread; the subscriber's event loop waits
+    on `ready` and takes everything at once with `drain`. A slow subscriber
+    only ever holds one update per device, and at most `max_pending` devices;
+    anything beyond that is counted in `dropped` rather than queued.
+    """
+
+    def __init__(self, scope: tuple, loop: asyncio.AbstractEventLoop, max_pending: int = MAX_PENDING):
+        self.scope = scope
+        self.loop = loop
+        self.max_pending = max_pending
+        self.ready = asyncio.Event()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.dropped = 0
+
+    def offer(self, key, event: dict):
+        with self.lock:
+            if key not in self.pending and len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            wake = not self.pending
+            self.pending[key] = event
+        if wake:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def drain(self) -> dict:
+        with self.lock:
+            events, self.pending = list(self.pending.values()), {}
+            dropped, self.dropped = self.dropped, 0
+            self.ready.clear()
+        return {"events": events, "dropped": dropped}
+
+
+class Hub:
+    """Fans events out to the subscriptions registered on any of their scopes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # scope -> set of Subscription
+
+    def __bool__(self):
+        return bool(self.subscriptions)
+
+    def subscribe(self, scope: tuple, loop: asyncio.AbstractEventLoop, max_pending: int = MAX_PENDING):
+        subscription = Subscription(scope, loop, max_pending)
+        with self.lock:
+            self.subscriptions.setdefault(scope, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            group = self.subscriptions.get(subscription.scope, set())
+            group.discard(subscription)
+            if not group:
+                self.subscriptions.pop(subscription.scope, None)
+
+    def publish(self, scopes, key, event: dict):
+        with self.lock:
+            targets = [s for scope in scopes for s in self.subscriptions.get(scope, ())]
+        for subscription in targets:
+            subscription.offer(key, event)
@@ -0,0 +1,41 @@
+import threading
+
+KINDS = ("user", "house", "floor", "room", "hallway", "device")
+# Ids each allocator owns per kind; sharded worker i allocates from i * SPAN
+SPAN = 1 << 48
+
+
+class IdAllocator:
+    """Server-side ids: one counter per kind, each behind its own lock.
+
+    Counters start above the highest id already stored in the allocator's
+    range [base, base + SPAN), and `observe` moves them past ids clients pick
+    themselves, so an allocated id is never one that is taken. `reserve`
+    hands out a contiguous block in one step. Giving each sharded worker its
+    own `base` keeps the ids they allocate apart without any coordination.
+    """
+
+    def __init__(self, highest: dict, base: int = 0):
+        self.base = base
+        self.end = base + SPAN
+        self.next = {kind: max(base + 1, (highest.get(kind) or base) + 1) for kind in KINDS}
+        self.locks = {kind: threading.Lock() for kind in KINDS}
+
+    def reserve(self, kind: str, count: int = 1) -> int:
+        """First id of a block of `count` fresh ids."""
+        with self.locks[kind]:
+            first = self.next[kind]
+            if first + count > self.end:
+                raise OverflowError(f"No {kind} ids left")
+            self.next[kind] = first + count
+        return first
+
+    def observe(self, kind: str, id: int):
+        # Checked without the lock first: ids below the counter are the common case
+        if self.base <= id < self.end and id >= self.next[kind]:
+            self.advance(kind, id + 1)
+
+    def advance(self, kind: str, next_id: int):
+        with self.locks[kind]:
+            if next_id > self.next[kind]:
+                self.next[kind] = next_id
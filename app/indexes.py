@@ -0,0 +1,74 @@
+from bisect import bisect_left, bisect_right
+import threading
+
+
+class SortedIndex:
+    """An ordered set of keys that supports "keys after X" scans.
+
+    Writes are O(1): new keys go to a pending set and removed ones to a
+    tombstone set. The sorted list is rebuilt lazily on the next scan, where
+    Timsort merges the already-sorted bulk with the pending keys in close to
+    linear time.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.pending = set()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys) + len(self.pending) - len(self.removed)
+
+    def __getstate__(self):
+        return {"keys": self.sorted_keys()}
+
+    def __setstate__(self, state):
+        self.keys = state["keys"]
+        self.pending = set()
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            if key in self.removed:
+                self.removed.discard(key)
+            else:
+                self.pending.add(key)
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.pending:
+                self.pending.discard(key)
+            else:
+                self.removed.add(key)
+
+    def sorted_keys(self):
+        with self.lock:
+            if self.pending or self.removed:
+                # Build a new list rather than mutate, so scans already running keep theirs
+                removed = self.removed
+                keys = [k for k in self.keys if k not in removed] if removed else list(self.keys)
+                keys.extend(self.pending)
+                keys.sort()
+                self.keys = keys
+                self.pending = set()
+                self.removed = set()
+            return self.keys
+
+    def scan(self, after=None, low=None, high=None):
+        """Yield keys in order, starting after `after` (or at `low`), up to `high`."""
+        keys = self.sorted_keys()
+        return scan_sorted(keys, after, low, high)
+
+
+def scan_sorted(keys: list, after=None, low=None, high=None):
+    if after is not None:
+        start = bisect_right(keys, after)
+    elif low is not None:
+        start = bisect_left(keys, low)
+    else:
+        start = 0
+    stop = len(keys) if high is None else bisect_right(keys, high)
+    for i in range(start, stop):
+        yield keys[i]
@@ -0,0 +1,77 @@
+from contextlib import ExitStack, contextmanager
+import threading
+
+DEFAULT_STRIPES = 64
+
+
+class StripedLock:
+    """A fixed set of re-entrant locks shared out by key hash.
+
+    Keys that land on different stripes never contend, so work on different
+    houses runs in parallel while everything under one house is serialized.
+    """
+
+    def __init__(self, stripes: int = DEFAULT_STRIPES):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def many(self, keys):
+        """Hold the stripes of all `keys`, taken in stripe order so that two
+        holders of overlapping sets never deadlock."""
+        with ExitStack() as stack:
+            for stripe in sorted({hash(key) % len(self.locks) for key in keys}):
+                stack.enter_context(self.locks[stripe])
+            yield
+
+
+class WriteBarrier:
+    """Lets writers through together, or one exclusive holder alone.
+
+    Every write holds `shared()` for its whole duration; `exclusive()` stops
+    new writers, waits for the running ones to finish and then holds the
+    state still, e.g. to snapshot it. Shared holds are re-entrant per thread,
+    and a waiting exclusive holder goes before writers that arrive after it.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.writers = 0
+        self.closed = False  # an exclusive holder is waiting or inside
+        self.local = threading.local()
+
+    @contextmanager
+    def shared(self):
+        depth = getattr(self.local, "depth", 0)
+        if not depth:
+            with self.cond:
+                while self.closed:
+                    self.cond.wait()
+                self.writers += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if not depth:
+                with self.cond:
+                    self.writers -= 1
+                    if not self.writers:
+                        self.cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.cond:
+            while self.closed:
+                self.cond.wait()
+            self.closed = True
+            while self.writers:
+                self.cond.wait()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.closed = False
+                self.cond.notify_all()
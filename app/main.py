@@ -1,473 +1,1513 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, WebSocket
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.testclient import TestClient
 import pytest
-from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Optional, get_type_hints
+import asyncio
+import base64
+import contextlib
+import functools
+import inspect
+import itertools
+import json
 import logging
+import math
+import os
+import threading
+import uuid
+try:
+    import msgpack
+except ImportError:  # optional: MessagePack bodies are only offered when it is installed
+    msgpack = None
+from .aggregates import Aggregate
+from .alerts import RuleIndex
+from .buffer import MAX_PENDING, Overloaded, WriteBuffer
+from .cache import SnapshotCache
+from .changes import ChangeLog
+from .history import DeviceHistory
+from .hub import Hub
+from .ids import KINDS as ID_KINDS, SPAN as ID_SPAN, IdAllocator
+from .locks import StripedLock, WriteBarrier
+from .metrics import Metrics, MetricsMiddleware, SlowRequestProfiler
+from .models import INT64_MAX, INT64_MIN, Device, Floor, Hallway, House, Id, Room, Rule, User
+from .persistence import Journal
+from .reaper import Reaper
+from .storage import CHILD_KINDS, DuplicateError, keyed_by_value, open_repository
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# Request counts, errors and latencies per route, served on /metrics. Setting
+# HOUSE_SLOW_REQUEST_MS also logs a sampled stack profile of slower requests.
+metrics = Metrics()
+slow_request_ms = os.environ.get("HOUSE_SLOW_REQUEST_MS")
+profiler = SlowRequestProfiler(float(slow_request_ms) / 1000) if slow_request_ms else None
+app.add_middleware(MetricsMiddleware, metrics=metrics, profiler=profiler)
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    # As FastAPI's own handler, except that an Infinity or NaN from the body is
+    # echoed back as a string: strict JSON has no way to write it
+    errors = [{**error, "input": str(error["input"])}
+              if isinstance(error.get("input"), float) and not math.isfinite(error["input"]) else error
+              for error in exc.errors()]
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
+
+# Entities live in the repository, each stored once with its child lists left
+# empty. Parents reference children by id and nested responses are built on
+# demand. HOUSE_STORAGE picks the backend: "memory" (default) or "sqlite:<path>".
+repo = open_repository(os.environ.get("HOUSE_STORAGE", "memory"))
+# device_id -> DeviceHistory ring buffer of timestamped readings; devices loaded
+# from a snapshot get theirs on first use, see device_history()
+histories = {}
+# (scope kind, scope id) -> {device_type: Aggregate} over the devices below that
+# room, hallway, floor or house, kept current by every device write
+aggregates = {}
+# Threshold alert rules, checked against every reading
+rules = RuleIndex()
+# Device change fan-out for /subscribe websockets, keyed by ("house"|"floor"|
+# "room"|"hallway"|"device", id) scopes
+hub = Hub()
+# Seconds between batches sent to a subscriber; updates within one are coalesced
+SUBSCRIPTION_TICK = 0.1
+# house_id -> version, bumped by every mutation under that house
+house_versions = {}
+# house_id -> ChangeLog of the changes behind its latest versions, for delta sync
+house_changes = {}
+CHANGELOG_LIMIT = max(0, int(os.environ.get("HOUSE_CHANGELOG_LIMIT", 1024)))
+# Serialized GET /house bodies keyed by house_id, valid for one version
+SNAPSHOT_CACHE_BYTES = 64 * 1024 * 1024
+house_snapshots = SnapshotCache(SNAPSHOT_CACHE_BYTES)
+# Handlers run concurrently in the thread pool. Everything under one house is
+# serialized by that house's stripe; different houses proceed in parallel.
+house_locks = StripedLock()
+user_locks = StripedLock()
+# Held shared by every write, before its stripe, and exclusively by journal
+# compaction, so a snapshot never catches a write half-applied
+barrier = WriteBarrier()
+# Write-ahead journal; None unless persistence is enabled via HOUSE_DATA_DIR
+journal = None
+# Coalescing buffer for device readings; None unless enabled via HOUSE_WRITE_BUFFER_MS
+write_buffer = None
+# handler name -> (undecorated handler, {param: TypeAdapter}) for log replay
+replay_handlers = {}
+# Bookkeeping of the mutation running on this thread: `undo` steps put the
+# in-memory state beside the repository back if it fails, and `after` actions
+# (change notifications, alert checks, reaper jobs) run once it has committed.
+pending = threading.local()
+# Distinguishes ETags issued by this process from ones issued before a restart
+etag_epoch = uuid.uuid4().hex[:8]
+# house_id -> incarnation, drawn afresh each time a house is created, so a house
+# recreated under a deleted one's id never reuses its (epoch, version) pairs
+house_incarnations = {}
+incarnations = itertools.count(1)
+# Server-side ids, for creates that leave them out and for POST /ids/reserve.
+# app.shard gives each worker its own HOUSE_ID_BASE so their ids never meet.
+id_base = int(os.environ.get("HOUSE_ID_BASE", 0))
+ids = IdAllocator({kind: repo.max_id(kind, id_base, id_base + ID_SPAN) for kind in ID_KINDS}, id_base)
+
+@contextlib.contextmanager
+def all_or_nothing():
+    if getattr(pending, "undo", None) is not None:
+        yield
+        return
+    pending.undo, pending.after = [], []
+    try:
+        yield
+    except BaseException:
+        undo = pending.undo
+        pending.undo = pending.after = None
+        for step in reversed(undo):
+            step()
+        raise
+    else:
+        after = pending.after
+        pending.undo = pending.after = None
+        for action in after:
+            action()
+
+def on_rollback(step):
+    if getattr(pending, "undo", None) is not None:
+        pending.undo.append(step)
+
+def after_commit(action):
+    # Outside a mutation (replay, the reaper) there is nothing to wait for
+    if getattr(pending, "after", None) is None:
+        action()
+    else:
+        pending.after.append(action)
+
+# Deleting a house, floor, room or hallway detaches it at once and leaves the
+# subtree to the reaper, which frees it in chunks on a background thread.
+def subtree_children(kind: str, id: int):
+    return [(child_kind, child_id) for child_kind in CHILD_KINDS[kind]
+            for child_id in repo.children(kind, id, child_kind)]
+
+def free_record(kind: str, id: int):
+    repo.remove(kind, id)
+    if kind == "device":
+        histories.pop(id, None)
+        rules.forget(id)
+    else:
+        aggregates.pop((kind, id), None)
+
+@contextlib.contextmanager
+def write_lock(lock):
+    with barrier.shared(), lock:
+        yield
+
+reaper = Reaper(subtree_children, free_record, lambda house_id: write_lock(house_locks(house_id)),
+                lambda: repo.transaction())
+# Replay frees subtrees inline so later records can reuse their ids
+replaying = False
+
+def delete_subtree(kind: str, id: int, house_id: int, ancestors: list):
+    repo.detach(kind, id)
+    # Its readings leave the aggregates above it now, not as the reaper gets to them
+    by_type = aggregates.pop((kind, id), {})
+    for scope in ancestors:
+        for device_type, aggregate in by_type.items():
+            remaining = aggregates[scope][device_type]
+            remaining.subtract(aggregate)
+            if not remaining.count:
+                del aggregates[scope][device_type]
+        if not aggregates.get(scope, True):
+            del aggregates[scope]
+
+    def restore():
+        if by_type:
+            aggregates[(kind, id)] = by_type
+        for scope in ancestors:
+            for device_type, aggregate in by_type.items():
+                aggregates.setdefault(scope, {}).setdefault(device_type, Aggregate()).merge(aggregate)
+    on_rollback(restore)
+    if replaying:
+        return reaper.submit(kind, id, house_id, inline=True).id
+    job = reaper.submit(kind, id, house_id, held=True)
+    on_rollback(lambda: reaper.cancel(job))
+    after_commit(lambda: reaper.release(job))
+    return job.id
+
+def delete_device_by_id(device_id: int):
+    device = repo.get("device", device_id)
+    scopes = device_scopes(device_id)
+    publish_device(device_id, deleted=True)
+    after_commit(lambda: rules.forget(device_id))
+    uncount_device(scopes, device)
+    repo.remove("device", device_id)
+    history = histories.pop(device_id, None)
+
+    def restore():
+        count_device(scopes, device)
+        if history is not None:
+            histories[device_id] = history
+    on_rollback(restore)
+
+def insert(kind: str, record, parent=None):
+    # The contains() checks in handlers give the early, readable error; this
+    # catches the id being taken by a concurrent request under another house.
+    try:
+        repo.add(kind, record, parent)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail=f"{kind.capitalize()} already exists")
+    ids.observe(kind, getattr(record, f"{kind}_id"))
+
+def assign_id(kind: str, record):
+    # Set on the handler's own argument, so the journal records the id used
+    field = f"{kind}_id"
+    if getattr(record, field) is None:
+        try:
+            setattr(record, field, ids.reserve(kind))
+        except OverflowError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def check_house(house_id: int):
+    # A deleted house stays stored, detached, until the reaper frees it
+    if repo.parent("house", house_id) is None:
+        raise HTTPException(status_code=404, detail="House not found")
+
+def check_floor(house_id: int, floor_id: int):
+    check_house(house_id)
+    parent = repo.parent("floor", floor_id)
+    if parent is None:
+        raise HTTPException(status_code=404, detail="Floor not found")
+    if parent != house_id:
+        raise HTTPException(status_code=404, detail="This floor doesnt exist in the house")
+
+def check_room(house_id: int, floor_id: int, room_id: int):
+    check_floor(house_id, floor_id)
+    parent = repo.parent("room", room_id)
+    if parent is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if parent != floor_id:
+        raise HTTPException(status_code=404, detail="This room doesnt exist in the specified floor")
+
+def check_hallway(house_id: int, floor_id: int, hallway_id: int):
+    check_floor(house_id, floor_id)
+    parent = repo.parent("hallway", hallway_id)
+    if parent is None:
+        raise HTTPException(status_code=404, detail="Hallway not found")
+    if parent != floor_id:
+        raise HTTPException(status_code=404, detail="This hallway doesnt exist in the specified floor")
+
+def check_device(kind: str, container_id: int, device_id: int):
+    parent = repo.parent("device", device_id)
+    if parent is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    if parent != (kind, container_id):
+        raise HTTPException(status_code=404, detail=f"Device not found in the {kind}")
+
+def house_of_device(device_id: int):
+    # None once any link on the way up is gone, so it is safe to call unlocked
+    parent = repo.parent("device", device_id)
+    if parent is None:
+        return None
+    house_id = repo.parent("floor", repo.parent(*parent))
+    # A deleted house is detached before the reaper frees its floors
+    return house_id if house_id in house_versions else None
+
+def device_scopes(device_id: int):
+    container = repo.parent("device", device_id)
+    floor_id = repo.parent(*container)
+    return [container, ("floor", floor_id), ("house", repo.parent("floor", floor_id))]
+
+def count_device(scopes: list, device: Device):
+    for scope in scopes:
+        aggregates.setdefault(scope, {}).setdefault(device.device_type, Aggregate()).add(device.device_info)
+
+def uncount_device(scopes: list, device: Device):
+    for scope in scopes:
+        by_type = aggregates[scope]
+        by_type[device.device_type].remove(device.device_info)
+        if not by_type[device.device_type].count:
+            del by_type[device.device_type]
+            if not by_type:
+                del aggregates[scope]
+
+def aggregate_device(device_id: int):
+    device = repo.get("device", device_id)
+    scopes = device_scopes(device_id)
+    count_device(scopes, device)
+    on_rollback(lambda: uncount_device(scopes, device))
+
+def start_history(device: Device):
+    histories[device.device_id] = DeviceHistory()
+    histories[device.device_id].append(device.device_info)
+    on_rollback(lambda: histories.pop(device.device_id, None))
+
+def device_history(device_id: int):
+    # Started from the stored reading for devices that came from a snapshot
+    history = histories.get(device_id)
+    if history is None:
+        device = repo.get("device", device_id)
+        if device is None:
+            return None
+        history = DeviceHistory()
+        history.append(device.device_info)
+        history = histories.setdefault(device_id, history)
+    return history
+
+def publish_device(device_id: int, deleted: bool = False):
+    if not hub:
+        return
+    device = repo.get("device", device_id)
+    scopes = device_scopes(device_id) + [("device", device_id)]
+    event = {**device.model_dump(), f"{scopes[0][0]}_id": scopes[0][1],
+             "floor_id": scopes[1][1], "house_id": scopes[2][1], "deleted": deleted}
+    after_commit(lambda: hub.publish(scopes, device_id, event))
+
+def check_rules(device_id: int):
+    if not rules.rules:
+        return
+    device = repo.get("device", device_id)
+    scopes = device_scopes(device_id)
+
+    def evaluate():
+        for alert in rules.evaluate(device_id, device.device_type, device.device_info, scopes, scopes[2][1]):
+            hub.publish(scopes + [("device", device_id)], ("alert", alert["alert_id"]), {"type": "alert", **alert})
+    after_commit(evaluate)
+
+def touch_house(house_id: int, op: str, kind: str, id: int, parent: tuple = None, **data):
+    # Each change to a house is one version, recorded in its change log
+    house_versions[house_id] += 1
+    change = {"op": op, "kind": kind, "id": id}
+    if parent is not None:
+        change["parent"] = list(parent)
+    if data:
+        change["data"] = data
+    house_changes[house_id].append(house_versions[house_id], change)
+
+    def undo():
+        house_versions[house_id] -= 1
+        house_changes[house_id].pop()
+    on_rollback(undo)
+
+def start_changes(house_id: int):
+    house_versions[house_id] = 0
+    house_changes[house_id] = ChangeLog(0, CHANGELOG_LIMIT)
+    house_incarnations[house_id] = next(incarnations)
+
+    def undo():
+        house_versions.pop(house_id, None)
+        house_changes.pop(house_id, None)
+        house_incarnations.pop(house_id, None)
+    on_rollback(undo)
+
+def house_epoch(house_id: int) -> str:
+    return f"{etag_epoch}.{house_incarnations[house_id]}"
+
+# model_copy is shallow and skips validation, so building a response only
+# allocates the outer objects; stored records are never mutated by it.
+def build_room(room_id: int):
+    devices = [repo.get("device", d) for d in repo.children("room", room_id, "device")]
+    return repo.get("room", room_id).model_copy(update={"devices": devices})
+
+def build_hallway(hallway_id: int):
+    devices = [repo.get("device", d) for d in repo.children("hallway", hallway_id, "device")]
+    return repo.get("hallway", hallway_id).model_copy(update={"devices": devices})
+
+def build_floor(floor_id: int):
+    return repo.get("floor", floor_id).model_copy(update={
+        "rooms": [build_room(r) for r in repo.children("floor", floor_id, "room")],
+        "hallways": [build_hallway(h) for h in repo.children("floor", floor_id, "hallway")],
+    })
+
+def build_house(house_id: int):
+    house = repo.get("house", house_id)
+    return house.model_copy(update={
+        "owner": repo.get("user", repo.parent("house", house_id)) or house.owner,
+        "floors": [build_floor(f) for f in repo.children("house", house_id, "floor")],
+    })
+
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    return msgpack is not None and accept is not None and any(t in accept for t in MSGPACK_TYPES)
+
+def encode(model: BaseModel, accept: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    # Stored records are already valid, so serialize them straight to bytes
+    # instead of letting response_model validate and encode them again.
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if wants_msgpack(accept):
+        return Response(content=msgpack.packb(model.model_dump()), media_type=MSGPACK_TYPES[0], headers=headers)
+    return Response(content=model.model_dump_json().encode(), media_type="application/json", headers=headers)
+
+
+# Sparse reads: ?depth= cuts the tree below a level, ?include= picks which
+# child lists to expand and ?fields= which plain fields to keep (ids always
+# stay). Skipped subtrees are never read from the repository.
+CHILD_LISTS = {"house": ("floors",), "floor": ("rooms", "hallways"), "room": ("devices",),
+               "hallway": ("devices",), "device": ()}
+LIST_KIND = {"floors": "floor", "rooms": "room", "hallways": "hallway", "devices": "device"}
+PROJECTED_FIELDS = ("name", "owner", "device_type", "device_info")
+
+def projection(depth: Optional[int], fields: Optional[str], include: Optional[str]):
+    # None when the caller wants the whole tree
+    if depth is None and fields is None and include is None:
+        return None
+    fields = None if fields is None else {f.strip() for f in fields.split(",") if f.strip()}
+    include = None if include is None else {i.strip() for i in include.split(",") if i.strip()}
+    for name in sorted(fields or ()):
+        if name not in PROJECTED_FIELDS:
+            raise HTTPException(status_code=400, detail=f"Unknown field {name}")
+    for name in sorted(include or ()):
+        if name not in LIST_KIND:
+            raise HTTPException(status_code=400, detail=f"Unknown child list {name}")
+    return depth, fields, include
+
+def projection_tag(spec) -> str:
+    depth, fields, include = spec
+    return f"-p{'' if depth is None else depth}" \
+           f"-{','.join(sorted(fields)) if fields is not None else '*'}" \
+           f"-{','.join(sorted(include)) if include is not None else '*'}"
+
+def project(kind: str, id: int, spec):
+    depth, fields, include = spec
+    record = repo.get(kind, id)
+    data = {f"{kind}_id": id}
+    for name, value in record:
+        if name in data or name in CHILD_LISTS[kind] or (fields is not None and name not in fields):
+            continue
+        if name == "owner":
+            value = repo.get("user", repo.parent("house", id)) or value
+            value = value.model_dump()
+        data[name] = value
+    if depth != 0:
+        below = (None if depth is None else depth - 1, fields, include)
+        for name in CHILD_LISTS[kind]:
+            if include is None or name in include:
+                child_kind = LIST_KIND[name]
+                data[name] = [project(child_kind, child, below) for child in repo.children(kind, id, child_kind)]
+    return data
+
+def encode_data(data: dict, accept: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if wants_msgpack(accept):
+        return Response(content=msgpack.packb(data), media_type=MSGPACK_TYPES[0], headers=headers)
+    return Response(content=json.dumps(data, separators=(",", ":")).encode(), media_type="application/json",
+                    headers=headers)
 
-users = {}
-houses = {}
-floors ={}
-rooms = {}
-devices = {}
-hallways = {}
-user_id =0
-house_id=0
-floor_id=0
-room_id=0
-device_id=0
-hallway_id = 0
-
-def delete_floor_by_id(floor_id: int):
-    # Remove rooms in the floor
-    for room in floors[floor_id].rooms:
-        if room.room_id in rooms:
-            del rooms[room.room_id]
-    # Remove hallways in the floor
-    for hallway in floors[floor_id].hallways:
-        if hallway.hallway_id in hallways:
-            del hallways[hallway.hallway_id]
-    # Finally, delete the floor
-    del floors[floor_id]
-
-def delete_room_by_id(room_id: int):
-    for dev in rooms[room_id].devices:
-        if dev.device_id in devices:
-            del devices[dev.device_id]  
-    del rooms[room_id]
-
-def delete_hallway_by_id(hallway_id: int):
-    for dev in hallways[hallway_id].devices:
-        if dev.device_id in devices:
-            del devices[dev.device_id]  
-    del hallways[hallway_id]
-
-
-def get_new_id(id):
-    id = id +1
-    return id
-
-class User(BaseModel):
-    user_id : int
-    name : str = Field(..., min_length=3, max_length=50)
-
-class Device(BaseModel):
-    device_id: int
-    device_type: Literal["humidity", "temperature"]  # Only allow 'humidity' or 'temperature'
-    device_info : int
-
-class Hallway(BaseModel):
-    hallway_id : int 
-    name : str
-    devices : list[Device] = []
-
-class Room(BaseModel):
-    room_id : int 
-    name : str
-    devices : list[Device] = []
-
-class Floor(BaseModel):
-    floor_id : int
-    name:str
-    rooms: list[Room] = []
-    hallways: list[Hallway] = []
-
-class House(BaseModel):
-    house_id: int
-    name:str
-    owner: User
-    floors: list[Floor] = []
 
 class UpdatedObject(BaseModel):
     name: str
 class UpdatedDevice(BaseModel):
-    device_info: int
-    
+    device_info: int = Field(..., ge=INT64_MIN, le=INT64_MAX)
+
+class Reading(BaseModel):
+    device_id: Id
+    device_info: int = Field(..., ge=INT64_MIN, le=INT64_MAX)
+
+def apply_reading(device_id: int, device_info: int):
+    # Devices are stored once, so a single update is the whole write.
+    house_id = house_of_device(device_id)
+    if house_id is None:
+        raise HTTPException(status_code=404, detail="Device not found")
+    device = repo.get("device", device_id)
+    scopes = device_scopes(device_id)
+    for scope in scopes:
+        aggregates[scope][device.device_type].replace(device.device_info, device_info)
+    history = device_history(device_id)  # before the write, so a new one starts from the old reading
+    repo.update("device", device_id, device_info=device_info)
+    checkpoint = history.checkpoint()
+    history.append(device_info)
+
+    def undo():
+        history.rollback(checkpoint)
+        for scope in scopes:
+            aggregates[scope][device.device_type].replace(device_info, device.device_info)
+    on_rollback(undo)
+    publish_device(device_id)
+    check_rules(device_id)
+    touch_house(house_id, "update", "device", device_id, device_info=device_info)
+
+def parse_readings(body: bytes, content_type: str):
+    if any(t in content_type for t in MSGPACK_TYPES):
+        if msgpack is None:
+            raise HTTPException(status_code=415, detail="MessagePack is not supported")
+        items = msgpack.unpackb(body)
+    elif "ndjson" in content_type:
+        lines = [line for line in body.splitlines() if line.strip()]
+        return [json.loads(line) for line in lines]
+    else:
+        items = json.loads(body)
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Expected an array of readings")
+    return items
+
+@contextlib.contextmanager
+def held(*locks):
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+@contextlib.contextmanager
+def user_scope(user_id: int):
+    # Writes to a user reach into the houses it owns, so their stripes are
+    # held too, taken before any transaction opens as for every house write.
+    # Creating a house holds its owner's stripe, so the list cannot change.
+    with user_locks(user_id):
+        house_ids = repo.children("user", user_id, "house") if repo.contains("user", user_id) else ()
+        with house_locks.many(house_ids):
+            yield
+
+def scope_lock(arguments: dict):
+    # The locks guarding whatever a handler touches, picked from its
+    # arguments; a user's stripe always comes before any house's
+    if "house_id" in arguments:
+        return house_locks(arguments["house_id"])
+    if "house" in arguments:
+        house = arguments["house"]
+        return held(user_locks(house.owner.user_id), house_locks(house.house_id))
+    if "batch" in arguments:
+        return house_locks(arguments["batch"].house_id)
+    if "user_id" in arguments:
+        return user_scope(arguments["user_id"])
+    if "user" in arguments:
+        return user_locks(arguments["user"].user_id)
+    return contextlib.nullcontext()
+
+def locked(handler):
+    # For reads that assemble a subtree, so they never see half of a write
+    signature = inspect.signature(handler)
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with scope_lock(signature.bind(*args, **kwargs).arguments):
+            return handler(*args, **kwargs)
+    return wrapper
+
+def mutation(handler):
+    # Runs the handler under its scope lock in one storage transaction and
+    # journals each successful call as (handler name, json-dumped arguments) so
+    # a restart can replay it. Journaling inside the lock keeps the log in the
+    # order writes were applied to each house.
+    hints = get_type_hints(handler, include_extras=True)
+    adapters = {name: TypeAdapter(hints[name]) for name in inspect.signature(handler).parameters}
+    signature = inspect.signature(handler)
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        house = bound.arguments.get("house")
+        if isinstance(house, House):
+            # Its stripe is picked by id, so an id left to the server comes first
+            assign_id("house", house)
+        with write_lock(scope_lock(bound.arguments)):
+            with all_or_nothing(), repo.transaction():
+                result = handler(*args, **kwargs)
+            if journal is not None:
+                record = {name: adapters[name].dump_python(value, mode="json")
+                          for name, value in bound.arguments.items()}
+                journal.append(handler.__name__, record, compact_journal)
+        return result
+
+    replay_handlers[handler.__name__] = (handler, adapters)
+    return wrapper
+
+def replay(records):
+    global replaying
+    replaying = True
+    try:
+        with repo.transaction(rollback=False):
+            for op, args in records:
+                handler, adapters = replay_handlers[op]
+                try:
+                    handler(**{name: adapters[name].validate_python(value) for name, value in args.items()})
+                except HTTPException:
+                    # Only writes that succeeded are logged, but one replayed onto
+                    # a SQLite file that already holds it fails the second time
+                    pass
+    finally:
+        replaying = False
+
+def dump_state():
+    # Snapshots hold the stored data as it is, so a restart loads it instead of
+    # re-running a handler per record. Histories and change logs restart empty.
+    return {"repository": repo.dump(), "aggregates": aggregates, "rules": list(rules.rules.values()),
+            "ids": dict(ids.next)}
+
+def compact_journal():
+    # On the journal's own thread: writers wait only while the state is
+    # captured and pickled, not while the snapshot is written out
+    with barrier.exclusive():
+        snapshot = journal.checkpoint(dump_state())
+    journal.write_snapshot(snapshot)
+
+def resume_houses():
+    # Side state for houses already stored when the process starts
+    for house_id in repo.ids("house"):
+        if repo.parent("house", house_id) is not None and house_id not in house_versions:
+            start_changes(house_id)
+    for kind, id, house_id in repo.detached_records():
+        reaper.submit(kind, id, house_id)
+
+def recount_devices():
+    # Aggregates for the devices under every live house, a page of a floor at a time
+    for house_id in list(house_versions):
+        for floor_id in repo.children("house", house_id, "floor"):
+            after = None
+            while True:
+                found = repo.page("device", {"floor_id": floor_id}, after, 10_000)
+                for _, device, container in found:
+                    count_device([container, ("floor", floor_id), ("house", house_id)], device)
+                if len(found) < 10_000:
+                    break
+                after = found[-1][0]
+
+def resume_repository():
+    # A SQLite file from an earlier run already holds records; what is kept
+    # beside the repository is rebuilt for them. Histories start on first use.
+    resume_houses()
+    recount_devices()
+
+def restore_state(state: dict):
+    repo.load(state["repository"])
+    aggregates.clear()
+    aggregates.update(state["aggregates"])
+    for rule in state["rules"]:
+        rules.add(rule)
+    for kind, next_id in state["ids"].items():
+        ids.advance(kind, next_id)
+    resume_houses()
+
+def enable_persistence(data_dir: str):
+    global journal
+    store = Journal(data_dir)
+    state, records = store.load()
+    if not isinstance(state, dict) and repo.count("house"):
+        resume_repository()
+    if isinstance(state, list):
+        # Snapshots used to be handler calls rebuilding the state; they still replay
+        records = state + records
+    elif state is not None:
+        restore_state(state)
+    replay(records)
+    logger.info("Replayed %d journal records from %s", len(records), data_dir)
+    if store.pending:
+        # Fold the replayed tail into a fresh snapshot so the next start skips it
+        store.compact(dump_state())
+    else:
+        store.open()
+    journal = store
+
 #USER
 @app.post("/users", response_model=User)
+@mutation
 def create_user(user:User):
-    if user.user_id in users:
+    assign_id("user", user)
+    if repo.contains("user", user.user_id):
         raise HTTPException(status_code=400, detail="User already exists")
-    users[user.user_id] = user
+    insert("user", user)
     return user
 
 @app.patch("/users/{user_id}")
-def update_user(user_id: int, user: UpdatedObject):
-    if user_id not in users:
+@mutation
+def update_user(user_id: Id, user: UpdatedObject):
+    if not repo.contains("user", user_id):
         raise HTTPException(status_code=404, detail="User not found")
     if user.name:
-        old_user = users[user_id]
-        updated_user = old_user.model_copy(update={"name": user.name})
-        users[user_id] = updated_user  # Only update the name field
-        for house in houses:
-            if users[user_id] in house.owner:
-                house.owner = updated_user
-                users[user_id] = updated_user
-    return users[user_id]
+        # Houses reference their owner by id, so the single record is all there is to update
+        repo.update("user", user_id, name=user.name)
+        for house_id in repo.children("user", user_id, "house"):
+            touch_house(house_id, "update", "owner", user_id, name=user.name)
+    return repo.get("user", user_id)
 
 
 @app.get("/users/{user_id}", response_model=User)
-def get_user(user_id: int):
-    if user_id not in users:
+def get_user(user_id: Id, accept: Optional[str] = Header(None)):
+    user = repo.get("user", user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return encode(user, accept)
+
+@app.get("/users/{user_id}/houses")
+@locked
+def get_user_houses(user_id: Id):
+    # The repository keeps each owner's houses as children, so this is O(houses owned)
+    if not repo.contains("user", user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    return users[user_id]
+    houses = [repo.get("house", house_id) for house_id in repo.children("user", user_id, "house")]
+    return {"user_id": user_id, "houses": [{"house_id": house.house_id, "name": house.name} for house in houses]}
 
 @app.delete("/users/{user_id}")
-def delete_user(user_id: int):
-    if user_id not in users:
+@mutation
+def delete_user(user_id: Id, cascade: bool = False):
+    if not repo.contains("user", user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    del users[user_id]
-    return {"message": "User deleted successfully"}
+    house_ids = repo.children("user", user_id, "house")
+    # Journals from before owners were protected may hold such deletes; replay them as they were
+    if house_ids and not cascade and not replaying:
+        raise HTTPException(status_code=400, detail="User still owns houses")
+    job_ids = []
+    for house_id in house_ids if cascade else ():
+        job_ids.append(drop_house(house_id))
+    repo.remove("user", user_id)
+    return {"message": "User deleted successfully", "job_ids": job_ids}
 #HOUSE
 @app.post("/house", response_model=House)
+@mutation
 def create_house(house :House):
-    if house.house_id in houses:
+    assign_id("house", house)
+    if repo.contains("house", house.house_id):
         raise HTTPException(status_code=400, detail="House already exists")
-    if house.owner.user_id not in users:
+    owner = repo.get("user", house.owner.user_id)
+    if owner is None:
         raise HTTPException(status_code=400, detail="Owner doesnt exist")
 
-    # Check if the owner's name matches the one stored in `users`
-    if house.owner.name != users[house.owner.user_id].name:
+    # Check if the owner's name matches the one stored for the user
+    if house.owner.name != owner.name:
         raise HTTPException(status_code=400, detail="Owner name mismatch")
-    houses[house.house_id] = house
+    if house.floors:
+        raise HTTPException(status_code=400, detail="Floors must be created through the floor endpoint")
+    insert("house", house, parent=house.owner.user_id)
+    start_changes(house.house_id)
     return house
 
 @app.patch("/house/{house_id}")
-def update_house(house_id: int, house: UpdatedObject):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    
+@mutation
+def update_house(house_id: Id, house: UpdatedObject):
+    check_house(house_id)
     if house.name:
-        old_house = houses[house_id]
-        updated_house = old_house.model_copy(update={"name": house.name})
-        houses[house_id] = updated_house
-    return houses[house_id]
+        repo.update("house", house_id, name=house.name)
+        touch_house(house_id, "update", "house", house_id, name=house.name)
+    return build_house(house_id)
 
 
 @app.get("/house/{house_id}", response_model=House)
-def get_house(house_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    return houses[house_id]
+@locked
+def get_house(house_id: Id, if_none_match: Optional[str] = Header(None), accept: Optional[str] = Header(None),
+              depth: Optional[int] = Query(None, ge=0), fields: Optional[str] = None, include: Optional[str] = None):
+    check_house(house_id)
+    spec = projection(depth, fields, include)
+    version = house_versions[house_id]
+    binary = wants_msgpack(accept)
+    tag = "" if spec is None else projection_tag(spec)
+    etag = f'"{house_epoch(house_id)}-{house_id}-{version}{tag}{"-mp" if binary else ""}"'
+    headers = {"ETag": etag, "Vary": "Accept", "X-House-Epoch": house_epoch(house_id), "X-House-Version": str(version)}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    if spec is not None:
+        # Trimmed responses are cheap to build and vary too much to be worth caching
+        return encode_data(project("house", house_id, spec), accept, headers)
+    key = (house_id, "msgpack") if binary else house_id
+    body = house_snapshots.get(key, version)
+    if body is None:
+        response = encode(build_house(house_id), accept)
+        body = response.body
+        house_snapshots.put(key, version, body)
+    return Response(content=body, media_type=MSGPACK_TYPES[0] if binary else "application/json", headers=headers)
 
-##ADD Dependencies
-@app.delete("/house/{house_id}")
-def delete_house(house_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    for i, f in enumerate(houses[house_id].floors):
-        if f.floor_id == floor_id:
-            delete_floor_by_id(floor_id)
-    del houses[house_id]
-    return {"message": "House deleted successfully"}
+@app.get("/house/{house_id}/changes")
+@locked
+def get_house_changes(house_id: Id, since: int = Query(0, ge=0), epoch: Optional[str] = None):
+    check_house(house_id)
+    version = house_versions[house_id]
+    changes = None
+    # Versions restart with the process and with each recreation of the house,
+    # so a version from another epoch means nothing here
+    if epoch in (None, house_epoch(house_id)) and since <= version:
+        changes = house_changes[house_id].since(since)
+    return {"house_id": house_id, "epoch": house_epoch(house_id), "version": version,
+            "resync": changes is None, "changes": changes or []}
+
+def drop_house(house_id: int):
+    job_id = delete_subtree("house", house_id, house_id, [])
+    version, changes = house_versions.pop(house_id), house_changes.pop(house_id)
+    incarnation = house_incarnations.pop(house_id)
+
+    def restore():
+        house_versions[house_id] = version
+        house_changes[house_id] = changes
+        house_incarnations[house_id] = incarnation
+    on_rollback(restore)
+    house_snapshots.discard(house_id)
+    house_snapshots.discard((house_id, "msgpack"))
+    return job_id
+
+@app.delete("/house/{house_id}", status_code=202)
+@mutation
+def delete_house(house_id: Id):
+    check_house(house_id)
+    return {"message": "House deleted successfully", "job_id": drop_house(house_id)}
+
+#BULK
+def bulk_conflicts(house: House):
+    # Every problem with the document in one pass, rather than the first one
+    conflicts = []
+    seen = set()
+
+    def claim(kind: str, id: int):
+        if (kind, id) in seen:
+            conflicts.append({"kind": kind, "id": id, "detail": "Duplicate id in document"})
+        elif repo.contains(kind, id):
+            conflicts.append({"kind": kind, "id": id, "detail": f"{kind.capitalize()} already exists"})
+        seen.add((kind, id))
+
+    owner = repo.get("user", house.owner.user_id)
+    if owner is None:
+        conflicts.append({"kind": "user", "id": house.owner.user_id, "detail": "Owner doesnt exist"})
+    elif owner.name != house.owner.name:
+        conflicts.append({"kind": "user", "id": house.owner.user_id, "detail": "Owner name mismatch"})
+    claim("house", house.house_id)
+    for floor in house.floors:
+        claim("floor", floor.floor_id)
+        for room in floor.rooms:
+            claim("room", room.room_id)
+            for device in room.devices:
+                claim("device", device.device_id)
+        for hallway in floor.hallways:
+            claim("hallway", hallway.hallway_id)
+            for device in hallway.devices:
+                claim("device", device.device_id)
+    return conflicts
+
+@mutation
+def import_house(house: House):
+    assign_id("house", house)
+    for floor in house.floors:
+        assign_id("floor", floor)
+        for container_kind, containers in (("room", floor.rooms), ("hallway", floor.hallways)):
+            for container in containers:
+                assign_id(container_kind, container)
+                for device in container.devices:
+                    assign_id("device", device)
+    conflicts = bulk_conflicts(house)
+    if conflicts:
+        raise HTTPException(status_code=400, detail={"message": "House import conflicts", "conflicts": conflicts})
+    inserted = []
+
+    def put(kind: str, record, parent):
+        insert(kind, record, parent)
+        inserted.append((kind, getattr(record, f"{kind}_id")))
+
+    try:
+        put("house", house.model_copy(update={"floors": []}), house.owner.user_id)
+        for floor in house.floors:
+            put("floor", floor.model_copy(update={"rooms": [], "hallways": []}), house.house_id)
+            for room in floor.rooms:
+                put("room", room.model_copy(update={"devices": []}), floor.floor_id)
+                for device in room.devices:
+                    put("device", device, ("room", room.room_id))
+            for hallway in floor.hallways:
+                put("hallway", hallway.model_copy(update={"devices": []}), floor.floor_id)
+                for device in hallway.devices:
+                    put("device", device, ("hallway", hallway.hallway_id))
+    except HTTPException:
+        # An id taken concurrently under another house; undo so the import stays all-or-nothing
+        for kind, id in reversed(inserted):
+            repo.remove(kind, id)
+        raise
+    counts = {"floors": 0, "rooms": 0, "hallways": 0, "devices": 0}
+    for kind, id in inserted:
+        if kind == "device":
+            start_history(repo.get("device", id))
+            aggregate_device(id)
+            check_rules(id)
+        if kind != "house":
+            counts[kind + "s"] += 1
+    start_changes(house.house_id)
+    return {"house_id": house.house_id, **counts}
+
+def import_result(line: bytes):
+    try:
+        house = House.model_validate_json(line)
+    except ValidationError as e:
+        return {"status": 422, "detail": json.loads(e.json())}
+    try:
+        return {"status": 200, **import_house(house)}
+    except HTTPException as e:
+        return {"house_id": house.house_id, "status": e.status_code, "detail": e.detail}
+
+async def iter_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+@app.post("/house/bulk")
+async def bulk_import_house(request: Request):
+    # A JSON body is one nested House; NDJSON is a stream of them, each
+    # imported as soon as its line arrives and reported on separately.
+    if "ndjson" in request.headers.get("content-type", ""):
+        results = []
+        async for line in iter_lines(request):
+            results.append(await run_in_threadpool(import_result, line))
+        return {"imported": sum(1 for r in results if r["status"] == 200), "results": results}
+    try:
+        house = House.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json()))
+    return await run_in_threadpool(import_house, house)
 
 #FLOOR
 @app.post("/house/{house_id}/floor", response_model=Floor)
-def create_floor(house_id:int, floor: Floor):
-    if floor.floor_id in floors:
+@mutation
+def create_floor(house_id:Id, floor: Floor):
+    assign_id("floor", floor)
+    if repo.contains("floor", floor.floor_id):
         raise HTTPException(status_code=400, detail="Floor already exists")
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    floors[floor.floor_id] = floor
-    houses[house_id].floors.append(floor)
+    check_house(house_id)
+    if floor.rooms or floor.hallways:
+        raise HTTPException(status_code=400, detail="Rooms and hallways must be created through their endpoints")
+    insert("floor", floor, parent=house_id)
+    touch_house(house_id, "create", "floor", floor.floor_id, ("house", house_id), name=floor.name)
     return floor
 
 @app.patch("/house/{house_id}/floors/{floor_id}")
-def update_floor(house_id:int, floor_id: int, floor: UpdatedObject):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    for i, f in enumerate(houses[house_id].floors):
-        if f.floor_id == floor_id:
-            if floor.name:
-                old_floor = floors[floor_id]
-                updated_floor = old_floor.model_copy(update={"name": floor.name})
-                floors[floor_id] = updated_floor
-                houses[house_id].floors[i] = updated_floor
-                return floors[floor_id]
-    raise HTTPException(status_code=404, detail="This floor doesnt exist in thr house")
-                
+@mutation
+def update_floor(house_id:Id, floor_id: Id, floor: UpdatedObject):
+    check_floor(house_id, floor_id)
+    if floor.name:
+        repo.update("floor", floor_id, name=floor.name)
+        touch_house(house_id, "update", "floor", floor_id, name=floor.name)
+    return build_floor(floor_id)
+
 
 @app.get("/house/{house_id}/floors/{floor_id}", response_model=Floor)
-def get_floor(floor_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    for i, f in enumerate(houses[house_id].floors):
-        if f.floor_id == floor_id:
-            return floors[floor_id]
-    raise HTTPException(status_code=404, detail="This floor doesnt exist in the house")
-
-@app.delete("/house/{house_id}/floor/{floor_id}")
-def delete_floor(house_id:int, floor_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
+@locked
+def get_floor(house_id: Id, floor_id: Id, accept: Optional[str] = Header(None),
+              depth: Optional[int] = Query(None, ge=0), fields: Optional[str] = None, include: Optional[str] = None):
+    check_floor(house_id, floor_id)
+    spec = projection(depth, fields, include)
+    if spec is not None:
+        return encode_data(project("floor", floor_id, spec), accept)
+    return encode(build_floor(floor_id), accept)
 
-    for i, f in enumerate(houses[house_id].floors):
-        if f.floor_id == floor_id:
-            del houses[house_id].floors[i]
-            delete_floor_by_id(floor_id)
-            return {"message": "Floor deleted successfully"}
-    raise HTTPException(status_code=404, detail="This floor doesnt exist in the house")
+@app.delete("/house/{house_id}/floor/{floor_id}", status_code=202)
+@mutation
+def delete_floor(house_id:Id, floor_id: Id):
+    check_floor(house_id, floor_id)
+    job_id = delete_subtree("floor", floor_id, house_id, [("house", house_id)])
+    touch_house(house_id, "delete", "floor", floor_id)
+    return {"message": "Floor deleted successfully", "job_id": job_id}
 
 #ROOM
 @app.post("/house/{house_id}/floor/{floor_id}/room", response_model=Room)
-def create_room(house_id:int, floor_id:int, room: Room):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room.room_id in rooms:
+@mutation
+def create_room(house_id:Id, floor_id:Id, room: Room):
+    check_floor(house_id, floor_id)
+    assign_id("room", room)
+    if repo.contains("room", room.room_id):
         raise HTTPException(status_code=400, detail="Room already exists")
-
-    rooms[room.room_id] = room
-    floors[floor_id].rooms.append(room)
+    if room.devices:
+        raise HTTPException(status_code=400, detail="Devices must be created through the device endpoint")
+    insert("room", room, parent=floor_id)
+    touch_house(house_id, "create", "room", room.room_id, ("floor", floor_id), name=room.name)
     return room
 
 @app.patch("/house/{house_id}/floors/{floor_id}/room/{room_id}")
-def update_room(house_id:int, floor_id: int, room_id:int,  room: UpdatedObject):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Rooms not found")
-    for i, r in enumerate(floors[floor_id].rooms):
-        if r.room_id == room_id:
-            if room.name:
-                    old_room =  rooms[room_id]
-                    updated_room = old_room.model_copy(update={"name": room.name})
-                    rooms[room_id] = updated_room
-                    floors[floor_id].rooms[i] = updated_room
-                    return rooms[room_id]
-    raise HTTPException(status_code=404, detail="This room doesnt exist in the specified floor")
+@mutation
+def update_room(house_id:Id, floor_id: Id, room_id:Id,  room: UpdatedObject):
+    check_room(house_id, floor_id, room_id)
+    if room.name:
+        repo.update("room", room_id, name=room.name)
+        touch_house(house_id, "update", "room", room_id, name=room.name)
+    return build_room(room_id)
 
 
 @app.get("/house/{house_id}/floor/{floor_id}/room/{room_id}", response_model=Room)
-def get_room(room_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Rooms not found")
-    for i, r in enumerate(floors[floor_id].rooms):
-        if r.room_id == room_id:
-            return rooms[room_id]
-    raise HTTPException(status_code=404, detail="This room doesnt exist in the specified floor")
-
-
-##ADD Dependencies
-@app.delete("/house/{house_id}/floor/{floor_id}/room/{room_id}")
-def delete_room(house_id:int, floor_id: int, room_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Rooms not found")
-    for i, r in enumerate(floors[floor_id].rooms):
-        if r.room_id == room_id:
-            delete_room_by_id(room_id)
-            del floors[floor_id].rooms[i]
-            return {"message": "Room deleted successfully"}
-    raise HTTPException(status_code=404, detail="This room doesnt exist in the specified floor")
+@locked
+def get_room(house_id: Id, floor_id: Id, room_id: Id, accept: Optional[str] = Header(None)):
+    check_room(house_id, floor_id, room_id)
+    return encode(build_room(room_id), accept)
+
+
+@app.delete("/house/{house_id}/floor/{floor_id}/room/{room_id}", status_code=202)
+@mutation
+def delete_room(house_id:Id, floor_id: Id, room_id:Id):
+    check_room(house_id, floor_id, room_id)
+    job_id = delete_subtree("room", room_id, house_id, [("floor", floor_id), ("house", house_id)])
+    touch_house(house_id, "delete", "room", room_id)
+    return {"message": "Room deleted successfully", "job_id": job_id}
 
 #HALLWAY
 @app.post("/house/{house_id}/floor/{floor_id}/hallway", response_model=Hallway)
-def create_hallway(house_id:int, floor_id:int, hallway: Hallway):
-    if hallway.hallway_id in hallways:
+@mutation
+def create_hallway(house_id:Id, floor_id:Id, hallway: Hallway):
+    assign_id("hallway", hallway)
+    if repo.contains("hallway", hallway.hallway_id):
         raise HTTPException(status_code=400, detail="Hallway already exists")
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    hallways[hallway.hallway_id] = hallway
-    floors[floor_id].hallways.append(hallway)
+    check_floor(house_id, floor_id)
+    if hallway.devices:
+        raise HTTPException(status_code=400, detail="Devices must be created through the device endpoint")
+    insert("hallway", hallway, parent=floor_id)
+    touch_house(house_id, "create", "hallway", hallway.hallway_id, ("floor", floor_id), name=hallway.name)
     return hallway
 
 @app.patch("/house/{house_id}/floors/{floor_id}/hallway/{hallway_id}")
-def update_hallway(house_id:int, floor_id: int, hallway_id:int,  hallway: UpdatedObject):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    for i, h in enumerate(floors[floor_id].hallways):
-        if h.hallway_id == hallway_id:
-            if hallway.name:
-                old_hallway = hallways[hallway_id]
-                updated_hallway = old_hallway.model_copy(update={"name": hallway.name})
-                hallways[hallway_id] = updated_hallway
-                floors[floor_id].hallways[i] = updated_hallway
-            return hallways[hallway_id]
-    raise HTTPException(status_code=404, detail="This hallway doesnt exist in the specified floor")
+@mutation
+def update_hallway(house_id:Id, floor_id: Id, hallway_id:Id,  hallway: UpdatedObject):
+    check_hallway(house_id, floor_id, hallway_id)
+    if hallway.name:
+        repo.update("hallway", hallway_id, name=hallway.name)
+        touch_house(house_id, "update", "hallway", hallway_id, name=hallway.name)
+    return build_hallway(hallway_id)
 
 @app.get("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}", response_model=Hallway)
-def get_hallway(hallway_id: int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    for i, h in enumerate(floors[floor_id].hallways):
-        if h.hallway_id == hallway_id:
-            return hallways[hallway_id]
-    raise HTTPException(status_code=404, detail="This hallway doesnt exist in the specified floor")
+@locked
+def get_hallway(house_id: Id, floor_id: Id, hallway_id: Id, accept: Optional[str] = Header(None)):
+    check_hallway(house_id, floor_id, hallway_id)
+    return encode(build_hallway(hallway_id), accept)
 
 
-@app.delete("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}")
-def delete_hallway(house_id:int, floor_id: int, hallway_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-   
-    for i, h in enumerate(floors[floor_id].hallways):
-        if h.hallway_id == hallway_id:
-            del floors[floor_id].hallways[i]
-            delete_hallway_by_id(hallway_id)
-            return {"message": "Hallway deleted successfully"}
-    raise HTTPException(status_code=404, detail="This hallway doesnt exist in the specified floor")
+@app.delete("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}", status_code=202)
+@mutation
+def delete_hallway(house_id:Id, floor_id: Id, hallway_id:Id):
+    check_hallway(house_id, floor_id, hallway_id)
+    job_id = delete_subtree("hallway", hallway_id, house_id, [("floor", floor_id), ("house", house_id)])
+    touch_house(house_id, "delete", "hallway", hallway_id)
+    return {"message": "Hallway deleted successfully", "job_id": job_id}
 
 #DEVICE
+def add_device(kind: str, container_id: int, device: Device):
+    assign_id("device", device)
+    if repo.contains("device", device.device_id):
+        raise HTTPException(status_code=400, detail="Device already exists")
+    insert("device", device, parent=(kind, container_id))
+    start_history(device)
+    aggregate_device(device.device_id)
+    publish_device(device.device_id)
+    check_rules(device.device_id)
+    return device
+
+def update_device(device_id: int, device: UpdatedDevice):
+    if device.device_info is not None:
+        apply_reading(device_id, device.device_info)
+    return repo.get("device", device_id)
 
 @app.post("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/device", response_model=Device)
-def create_device_to_hallway(house_id:int, floor_id:int, hallway_id: int, device:Device):
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    devices[device.device_id] = device
-    hallways[hallway_id].devices.append(device)
-    return device
+@mutation
+def create_device_to_hallway(house_id:Id, floor_id:Id, hallway_id: Id, device:Device):
+    check_hallway(house_id, floor_id, hallway_id)
+    added = add_device("hallway", hallway_id, device)
+    touch_house(house_id, "create", "device", device.device_id, ("hallway", hallway_id),
+                device_type=device.device_type, device_info=device.device_info)
+    return added
 
 @app.post("/house/{house_id}/floor/{floor_id}/room/{room_id}/device", response_model=Device)
-def create_device_to_room(house_id:int, floor_id:int, room_id: int, device:Device):
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    devices[device.device_id] = device
-    rooms[room_id].devices.append(device)
-    return device
+@mutation
+def create_device_to_room(house_id:Id, floor_id:Id, room_id: Id, device:Device):
+    check_room(house_id, floor_id, room_id)
+    added = add_device("room", room_id, device)
+    touch_house(house_id, "create", "device", device.device_id, ("room", room_id),
+                device_type=device.device_type, device_info=device.device_info)
+    return added
 
-@app.patch("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/device/{device_id}")
+@mutation
 def update_device_hallway(house_id:int, floor_id: int, hallway_id:int, device_id:int,  device: UpdatedDevice):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    
-    for i, d in enumerate(hallways[hallway_id].devices):
-            if d.device_id == device_id:
-                if device.device_info:
-                    old_device = devices[device_id]
-                    updated_device = old_device.model_copy(update={"device_info": device.device_info})
-                    devices[device_id] = updated_device
-                    hallways[hallway_id].devices[i] = updated_device
-                    return devices[device_id]
-    raise HTTPException(status_code=404, detail="Device not found in hallway")
+    check_hallway(house_id, floor_id, hallway_id)
+    check_device("hallway", hallway_id, device_id)
+    return update_device(device_id, device)
 
-@app.patch("/house/{house_id}/floor/{floor_id}/room/{room_id}/device/{device_id}")
+@locked
+def check_hallway_device(house_id: int, floor_id: int, hallway_id: int, device_id: int):
+    check_hallway(house_id, floor_id, hallway_id)
+    check_device("hallway", hallway_id, device_id)
+
+@app.patch("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/device/{device_id}")
+def patch_device_hallway(house_id:Id, floor_id: Id, hallway_id:Id, device_id:Id,  device: UpdatedDevice):
+    if write_buffer is None:
+        return update_device_hallway(house_id, floor_id, hallway_id, device_id, device)
+    check_hallway_device(house_id, floor_id, hallway_id, device_id)
+    buffer_readings([(device_id, device.device_info)])
+    return JSONResponse(status_code=202, content={"device_id": device_id, "device_info": device.device_info,
+                                                  "status": "queued"})
+
+@mutation
 def update_device_room(house_id:int, floor_id: int, room_id:int, device_id:int,  device: UpdatedDevice):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
-    for i, d in enumerate(rooms[room_id].devices):
-            if d.device_id == device_id:
-                if device.device_info is not None:
-                    old_device = devices[device_id]
-                    updated_device = old_device.model_copy(update={"device_info": device.device_info})
-                    devices[device_id] = updated_device
-                    rooms[room_id].devices[i] = updated_device
-                    return updated_device
-    raise HTTPException(status_code=404, detail="Device not found in room")
-  
+    check_room(house_id, floor_id, room_id)
+    check_device("room", room_id, device_id)
+    return update_device(device_id, device)
+
+@locked
+def check_room_device(house_id: int, floor_id: int, room_id: int, device_id: int):
+    check_room(house_id, floor_id, room_id)
+    check_device("room", room_id, device_id)
+
+@app.patch("/house/{house_id}/floor/{floor_id}/room/{room_id}/device/{device_id}")
+def patch_device_room(house_id:Id, floor_id: Id, room_id:Id, device_id:Id,  device: UpdatedDevice):
+    if write_buffer is None:
+        return update_device_room(house_id, floor_id, room_id, device_id, device)
+    check_room_device(house_id, floor_id, room_id, device_id)
+    buffer_readings([(device_id, device.device_info)])
+    return JSONResponse(status_code=202, content={"device_id": device_id, "device_info": device.device_info,
+                                                  "status": "queued"})
+
 
 @app.get("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/device/{device_id}", response_model=Device)
-def get_hallway_device(house_id:int, floor_id:int, hallway_id: int, device_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    if device_id not in devices:
-        raise HTTPException(status_code=404, detail="Device not found")
-    for i, d in enumerate(hallways[hallway_id].devices):
-            if d.device_id == device_id:
-                 return devices[device_id]
-    raise HTTPException(status_code=404, detail="Device not found in the hallway")
+@locked
+def get_hallway_device(house_id:Id, floor_id:Id, hallway_id: Id, device_id:Id, accept: Optional[str] = Header(None)):
+    check_hallway(house_id, floor_id, hallway_id)
+    check_device("hallway", hallway_id, device_id)
+    return encode(repo.get("device", device_id), accept)
 
 @app.get("/house/{house_id}/floor/{floor_id}/room/{room_id}/device/{device_id}", response_model=Device)
-def get_room_device(house_id:int, floor_id:int, room_id: int, device_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
-    if device_id not in devices:
-        raise HTTPException(status_code=404, detail="Device not found")
-    for i, d in enumerate(rooms[room_id].devices):
-            if d.device_id == device_id:
-                 return devices[device_id]
-    raise HTTPException(status_code=404, detail="Device not found in the room")
+@locked
+def get_room_device(house_id:Id, floor_id:Id, room_id: Id, device_id:Id, accept: Optional[str] = Header(None)):
+    check_room(house_id, floor_id, room_id)
+    check_device("room", room_id, device_id)
+    return encode(repo.get("device", device_id), accept)
 
 @app.delete("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/device/{device_id}")
-def delete_hallway_device(house_id:int, floor_id: int, hallway_id:int, device_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if hallway_id not in hallways:
-        raise HTTPException(status_code=404, detail="Hallway not found")
-    if device_id not in devices:
-        raise HTTPException(status_code=404, detail="Device not found")
-    for i, d in enumerate(hallways[hallway_id].devices):
-            if d.device_id == device_id:
-                del hallways[hallway_id].devices[i]
-                del devices[device_id]
-                return {"message": "Device deleted successfully"}
-
-    raise HTTPException(status_code=404, detail="Device not found in the hallway")
+@mutation
+def delete_hallway_device(house_id:Id, floor_id: Id, hallway_id:Id, device_id:Id):
+    check_hallway(house_id, floor_id, hallway_id)
+    check_device("hallway", hallway_id, device_id)
+    delete_device_by_id(device_id)
+    touch_house(house_id, "delete", "device", device_id)
+    return {"message": "Device deleted successfully"}
 
 @app.delete("/house/{house_id}/floor/{floor_id}/room/{room_id}/device/{device_id}")
-def delete_room_device(house_id:int, floor_id: int, room_id:int, device_id:int):
-    if house_id not in houses:
-        raise HTTPException(status_code=404, detail="House not found")
-    if floor_id not in floors:
-        raise HTTPException(status_code=404, detail="Floor not found")
-    if room_id not in rooms:
-        raise HTTPException(status_code=404, detail="Room not found")
-    if device_id not in devices:
+@mutation
+def delete_room_device(house_id:Id, floor_id: Id, room_id:Id, device_id:Id):
+    check_room(house_id, floor_id, room_id)
+    check_device("room", room_id, device_id)
+    delete_device_by_id(device_id)
+    touch_house(house_id, "delete", "device", device_id)
+    return {"message": "Device deleted successfully"}
+
+#BATCH
+class Operation(BaseModel):
+    op: str
+    args: dict = {}
+
+class Batch(BaseModel):
+    house_id: int
+    operations: list[Operation] = Field(..., max_length=1000)
+
+# Writes a batch may not contain; everything else taking a house_id may
+BATCH_EXCLUDED = ("delete_house", "run_batch")
+
+def batch_call(index: int, operation: Operation, house_id: int):
+    entry = replay_handlers.get(operation.op)
+    if entry is None or operation.op in BATCH_EXCLUDED or "house_id" not in entry[1]:
+        raise HTTPException(status_code=400, detail=f"Operation {index}: unknown operation {operation.op}")
+    handler, adapters = entry
+    args = {**operation.args, "house_id": house_id}
+    try:
+        return handler, adapters, {name: adapters[name].validate_python(args[name]) for name in adapters}
+    except (KeyError, ValidationError):
+        raise HTTPException(status_code=422, detail=f"Operation {index}: invalid arguments for {operation.op}")
+
+@app.post("/batch")
+@mutation
+def run_batch(batch: Batch):
+    # The operations share one lock, transaction and journal record, so a
+    # failure anywhere rolls back the ones before it.
+    results = []
+    for index, operation in enumerate(batch.operations):
+        handler, adapters, args = batch_call(index, operation, batch.house_id)
+        try:
+            result = handler(**args)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"Operation {index} ({operation.op}): {e.detail}")
+        # Journal the arguments as applied, with any allocated ids filled in
+        operation.args = {name: adapters[name].dump_python(value, mode="json") for name, value in args.items()}
+        results.append(jsonable_encoder(result))
+    return {"results": results}
+
+#TELEMETRY
+def buffer_readings(readings: list):
+    try:
+        write_buffer.offer(readings)
+    except Overloaded:
+        raise HTTPException(status_code=429, detail="Too many pending writes",
+                            headers={"Retry-After": str(max(1, math.ceil(write_buffer.window)))})
+
+def queue_readings(items: list):
+    # Unknown devices are reported now; the rest are applied by the buffer's writer
+    results = []
+    queued = []
+    for item in items:
+        try:
+            reading = Reading.model_validate(item)
+        except ValidationError:
+            results.append({"device_id": item.get("device_id") if isinstance(item, dict) else None,
+                            "status": 422, "detail": "Invalid reading"})
+            continue
+        if house_of_device(reading.device_id) is None:
+            results.append({"device_id": reading.device_id, "status": 404, "detail": "Device not found"})
+            continue
+        queued.append((reading.device_id, reading.device_info))
+        results.append({"device_id": reading.device_id, "status": 202})
+    buffer_readings(queued)
+    return results
+
+@mutation
+def apply_house_readings(house_id: int, readings: list[Reading]):
+    results = []
+    for reading in readings:
+        try:
+            if house_of_device(reading.device_id) != house_id:
+                raise HTTPException(status_code=404, detail="Device not found")
+            apply_reading(reading.device_id, reading.device_info)
+        except HTTPException as e:
+            results.append({"device_id": reading.device_id, "status": e.status_code, "detail": e.detail})
+            continue
+        results.append({"device_id": reading.device_id, "status": 200})
+    return results
+
+def ingest_readings(items: list):
+    # Readings are grouped by house so each house's lock is taken once per batch
+    results = [None] * len(items)
+    by_house = {}
+    for i, item in enumerate(items):
+        try:
+            reading = Reading.model_validate(item)
+        except ValidationError:
+            results[i] = {"device_id": item.get("device_id") if isinstance(item, dict) else None,
+                          "status": 422, "detail": "Invalid reading"}
+            continue
+        house_id = house_of_device(reading.device_id)
+        if house_id is None:
+            results[i] = {"device_id": reading.device_id, "status": 404, "detail": "Device not found"}
+            continue
+        slots, readings = by_house.setdefault(house_id, ([], []))
+        slots.append(i)
+        readings.append(reading)
+    for house_id, (slots, readings) in by_house.items():
+        for i, result in zip(slots, apply_house_readings(house_id, readings)):
+            results[i] = result
+    return results
+
+@app.post("/telemetry")
+async def ingest_telemetry(request: Request):
+    try:
+        items = parse_readings(await request.body(), request.headers.get("content-type", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed telemetry body")
+    if write_buffer is not None:
+        results = await run_in_threadpool(queue_readings, items)
+        return {"applied": 0, "queued": sum(1 for result in results if result["status"] == 202), "results": results}
+    results = await run_in_threadpool(ingest_readings, items)
+    applied = sum(1 for result in results if result["status"] == 200)
+    return {"applied": applied, "results": results}
+
+#HISTORY
+@app.get("/devices/{device_id}/history")
+def get_device_history(device_id: Id, start: Optional[float] = None, end: Optional[float] = None,
+                       buckets: Optional[int] = Query(None, ge=1, le=10000)):
+    history = histories.get(device_id)
+    if history is None and house_of_device(device_id) is not None:
+        history = device_history(device_id)
+    if history is None:
         raise HTTPException(status_code=404, detail="Device not found")
-    for i, d in enumerate(rooms[room_id].devices):
-            if d.device_id == device_id:
-                del rooms[room_id].devices[i]
-                del devices[device_id]
-                return {"message": "Device deleted successfully"}
+    if buckets is None:
+        return {"device_id": device_id, "samples": history.samples(start, end)}
+    return {"device_id": device_id, "buckets": history.downsample(buckets, start, end)}
+
+#LISTING
+PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def is_int64(value) -> bool:
+    return type(value) is int and INT64_MIN <= value <= INT64_MAX
+
+def decode_cursor(cursor: str, by_value: bool):
+    # The key must have the shape the listing pages by, or the index search
+    # would compare ints with pairs
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if by_value and isinstance(key, list) and len(key) == 2 and all(map(is_int64, key)):
+        return tuple(key)
+    if not by_value and is_int64(key):
+        return key
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def summary(kind: str, record, parent):
+    # Flat item: the record without child lists, plus a reference to its parent
+    item = record.model_dump(exclude={"owner", "floors", "rooms", "hallways", "devices"})
+    if kind == "house":
+        item["user_id"] = parent
+    elif kind == "floor":
+        item["house_id"] = parent
+    elif kind in ("room", "hallway"):
+        item["floor_id"] = parent
+    elif kind == "device":
+        item[f"{parent[0]}_id"] = parent[1]
+    return item
+
+def list_page(kind: str, filters: dict, cursor: Optional[str], limit: int):
+    after = decode_cursor(cursor, keyed_by_value(kind, filters)) if cursor else None
+    # One extra match tells us whether another page exists
+    found = repo.page(kind, filters, after, limit + 1)
+    next_cursor = encode_cursor(found[limit - 1][0]) if len(found) > limit else None
+    return {"items": [summary(kind, record, parent) for _, record, parent in found[:limit]],
+            "next_cursor": next_cursor}
+
+@app.get("/users")
+def list_users(cursor: Optional[str] = None, limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    return list_page("user", {}, cursor, limit)
+
+@app.get("/houses")
+def list_houses(user_id: Optional[Id] = None, cursor: Optional[str] = None,
+                limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    return list_page("house", {"user_id": user_id}, cursor, limit)
+
+@app.get("/floors")
+def list_floors(house_id: Optional[Id] = None, cursor: Optional[str] = None,
+                limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    return list_page("floor", {"house_id": house_id}, cursor, limit)
+
+@app.get("/rooms")
+def list_rooms(house_id: Optional[Id] = None, floor_id: Optional[Id] = None, cursor: Optional[str] = None,
+               limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    return list_page("room", {"house_id": house_id, "floor_id": floor_id}, cursor, limit)
+
+@app.get("/hallways")
+def list_hallways(house_id: Optional[Id] = None, floor_id: Optional[Id] = None, cursor: Optional[str] = None,
+                  limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    return list_page("hallway", {"house_id": house_id, "floor_id": floor_id}, cursor, limit)
+
+@app.get("/devices")
+def list_devices(device_type: Optional[str] = None, house_id: Optional[Id] = None,
+                 floor_id: Optional[Id] = None,
+                 min_info: Optional[int] = Query(None, ge=INT64_MIN, le=INT64_MAX),
+                 max_info: Optional[int] = Query(None, ge=INT64_MIN, le=INT64_MAX), cursor: Optional[str] = None,
+                 limit: int = Query(PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT)):
+    filters = {"device_type": device_type, "house_id": house_id, "floor_id": floor_id,
+               "min_info": min_info, "max_info": max_info}
+    return list_page("device", filters, cursor, limit)
+
+#SUBSCRIPTIONS
+def subscription_scope(house_id: int, floor_id, room_id, hallway_id, device_id):
+    # The narrowest of the given levels; the wider ids must contain it
+    if device_id is not None:
+        if house_of_device(device_id) != house_id:
+            raise HTTPException(status_code=404, detail="Device not found")
+        return ("device", device_id)
+    if room_id is not None:
+        check_room(house_id, floor_id, room_id)
+        return ("room", room_id)
+    if hallway_id is not None:
+        check_hallway(house_id, floor_id, hallway_id)
+        return ("hallway", hallway_id)
+    if floor_id is not None:
+        check_floor(house_id, floor_id)
+        return ("floor", floor_id)
+    check_house(house_id)
+    return ("house", house_id)
+
+@app.websocket("/house/{house_id}/subscribe")
+async def subscribe(websocket: WebSocket, house_id: Id, floor_id: Optional[Id] = None,
+                    room_id: Optional[Id] = None, hallway_id: Optional[Id] = None,
+                    device_id: Optional[Id] = None):
+    try:
+        scope = subscription_scope(house_id, floor_id, room_id, hallway_id, device_id)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+    subscription = hub.subscribe(scope, asyncio.get_running_loop())
+
+    async def pump():
+        while True:
+            await subscription.ready.wait()
+            await asyncio.sleep(SUBSCRIPTION_TICK)
+            await websocket.send_json(subscription.drain())
+
+    sender = asyncio.create_task(pump())
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        sender.cancel()
+        hub.unsubscribe(subscription)
+
+#AGGREGATES
+def aggregate_summary(scope: tuple):
+    return {device_type: aggregate.summary() for device_type, aggregate in aggregates.get(scope, {}).items()}
+
+@app.get("/house/{house_id}/aggregates")
+@locked
+def get_house_aggregates(house_id: Id):
+    check_house(house_id)
+    return aggregate_summary(("house", house_id))
+
+@app.get("/house/{house_id}/floors/{floor_id}/aggregates")
+@locked
+def get_floor_aggregates(house_id: Id, floor_id: Id):
+    check_floor(house_id, floor_id)
+    return aggregate_summary(("floor", floor_id))
+
+@app.get("/house/{house_id}/floor/{floor_id}/room/{room_id}/aggregates")
+@locked
+def get_room_aggregates(house_id: Id, floor_id: Id, room_id: Id):
+    check_room(house_id, floor_id, room_id)
+    return aggregate_summary(("room", room_id))
+
+@app.get("/house/{house_id}/floor/{floor_id}/hallway/{hallway_id}/aggregates")
+@locked
+def get_hallway_aggregates(house_id: Id, floor_id: Id, hallway_id: Id):
+    check_hallway(house_id, floor_id, hallway_id)
+    return aggregate_summary(("hallway", hallway_id))
+
+#ALERTS
+@app.post("/rules", response_model=Rule)
+@mutation
+def create_rule(rule: Rule):
+    if rule.rule_id in rules:
+        raise HTTPException(status_code=400, detail="Rule already exists")
+    if rule.scope is not None and not repo.contains(rule.scope, rule.scope_id):
+        raise HTTPException(status_code=404, detail=f"{rule.scope.capitalize()} not found")
+    rules.add(rule)
+    on_rollback(lambda: rules.remove(rule.rule_id))
+    return rule
+
+@app.get("/rules/{rule_id}", response_model=Rule)
+def get_rule(rule_id: Id):
+    if rule_id not in rules:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    return rules.rules[rule_id]
+
+@app.delete("/rules/{rule_id}")
+@mutation
+def delete_rule(rule_id: Id):
+    rule = rules.remove(rule_id)
+    if rule is None:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    on_rollback(lambda: rules.add(rule))
+    return {"message": "Rule deleted successfully"}
+
+@app.get("/alerts")
+def list_alerts(after: int = 0, limit: int = Query(100, ge=1, le=1000)):
+    alerts = rules.since(after, limit)
+    return {"alerts": alerts, "last_alert_id": alerts[-1]["alert_id"] if alerts else after}
+
+#IDS
+MAX_RESERVE = 100_000
+
+@app.post("/ids/reserve")
+def reserve_ids(kind: str, count: int = Query(1, ge=1, le=MAX_RESERVE)):
+    if kind not in ID_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind {kind}")
+    try:
+        first = ids.reserve(kind, count)
+    except OverflowError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Journaled as the block granted, not the count asked for: reservations
+    # racing other allocations can reach the log out of order, and replaying
+    # advances gives the same counter in any order
+    advance_ids(kind, first + count)
+    return {"kind": kind, "first": first, "last": first + count - 1, "count": count}
+
+@app.post("/ids/observe")
+def observe_ids(kind: str, id: Id):
+    # For an id taken somewhere this process cannot see: the shard router
+    # reports house ids clients pick to worker 0, which allocates them
+    if kind not in ID_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind {kind}")
+    if ids.base <= id < ids.end and id >= ids.next[kind]:
+        advance_ids(kind, id + 1)
+    return {"kind": kind, "next": ids.next[kind]}
+
+@mutation
+def advance_ids(kind: str, next_id: int):
+    # Also in snapshots from before they held the stored state
+    ids.advance(kind, next_id)
+
+def reserved_ids(kind: str, count: int):
+    # Journals from before blocks were logged as granted hold the request;
+    # replayed in log order, it is the best that can be done for them
+    ids.reserve(kind, count)
+
+replay_handlers["reserve_ids"] = (reserved_ids, {"kind": TypeAdapter(str), "count": TypeAdapter(int)})
 
-    raise HTTPException(status_code=404, detail="Device not found in the room")
+#JOBS
+@app.get("/jobs/{job_id}")
+def get_job(job_id: Id):
+    status = reaper.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
 
+#METRICS
+@app.get("/metrics")
+def get_metrics():
+    gauges = {kind: repo.count(kind) for kind in ("user", "house", "floor", "room", "hallway", "device")}
+    buffered = None if write_buffer is None else write_buffer.stats()
+    return Response(content=metrics.render(gauges, buffered), media_type="text/plain; version=0.0.4")
 
+if os.environ.get("HOUSE_DATA_DIR"):
+    enable_persistence(os.environ["HOUSE_DATA_DIR"])
+elif repo.count("house"):
+    resume_repository()
+if os.environ.get("HOUSE_WRITE_BUFFER_MS"):
+    write_buffer = WriteBuffer(ingest_readings, float(os.environ["HOUSE_WRITE_BUFFER_MS"]) / 1000,
+                               int(os.environ.get("HOUSE_WRITE_BUFFER_MAX", MAX_PENDING)))
@@ -0,0 +1,173 @@
+from collections import Counter
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Label for requests that matched no route, so unknown paths cannot blow up cardinality
+UNMATCHED = "unmatched"
+
+
+class Metrics:
+    """Per-route request counts, error counts by status and latency histograms."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (method, route) -> count
+        self.errors = Counter()  # (method, route, status) -> count
+        self.latency = {}  # (method, route) -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route)
+        with self.lock:
+            self.requests[key] += 1
+            if status >= 400:
+                self.errors[(method, route, status)] += 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def render(self, gauges: dict, buffered: dict = None) -> str:
+        """Prometheus text exposition; `gauges` maps store kind -> record count
+        and `buffered` holds the write buffer's stats, if it is enabled."""
+        with self.lock:
+            requests = dict(self.requests)
+            errors = dict(self.errors)
+            latency = {key: list(histogram) for key, histogram in self.latency.items()}
+        lines = ["# HELP house_http_requests_total Requests handled, by route.",
+                 "# TYPE house_http_requests_total counter"]
+        for (method, route), count in sorted(requests.items()):
+            lines.append(f'house_http_requests_total{{method="{method}",route="{route}"}} {count}')
+        lines += ["# HELP house_http_errors_total Responses with status 400 or above, by route and status.",
+                  "# TYPE house_http_errors_total counter"]
+        for (method, route, status), count in sorted(errors.items()):
+            lines.append(f'house_http_errors_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        lines += ["# HELP house_http_request_duration_seconds Request latency, by route.",
+                  "# TYPE house_http_request_duration_seconds histogram"]
+        for (method, route), histogram in sorted(latency.items()):
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f'house_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"house_http_request_duration_seconds_sum{{{labels}}} {histogram[-1]}")
+            lines.append(f"house_http_request_duration_seconds_count{{{labels}}} {cumulative}")
+        lines += ["# HELP house_store_records Records held, by kind.",
+                  "# TYPE house_store_records gauge"]
+        for kind, count in gauges.items():
+            lines.append(f'house_store_records{{kind="{kind}"}} {count}')
+        if buffered is not None:
+            lines += ["# HELP house_write_buffer_pending Devices with a reading waiting in the write buffer.",
+                      "# TYPE house_write_buffer_pending gauge",
+                      f"house_write_buffer_pending {buffered['pending']}"]
+            for name in ("accepted", "coalesced", "rejected"):
+                lines += [f"# HELP house_write_buffer_{name}_total Readings {name} by the write buffer.",
+                          f"# TYPE house_write_buffer_{name}_total counter",
+                          f"house_write_buffer_{name}_total {buffered[name]}"]
+        return "\n".join(lines) + "\n"
+
+
+class SlowRequestProfiler:
+    """Samples every thread's stack while requests are in flight and logs the
+    collected profile of any request that takes longer than `threshold` seconds.
+
+    Handlers run on thread-pool workers, so samples cannot be tied to a single
+    request; each in-flight request collects everything sampled during its
+    lifetime. Idle threads (parked in a wait) are skipped.
+    """
+
+    IDLE = ("wait", "select", "poll", "sleep")
+
+    def __init__(self, threshold: float, interval: float = 0.005, top: int = 10):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.lock = threading.Lock()
+        self.active = {}  # token -> Counter of collapsed stacks
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+        self.thread.start()
+
+    def start(self):
+        token = object()
+        with self.lock:
+            self.active[token] = Counter()
+        self.wakeup.set()
+        return token
+
+    def finish(self, token, label: str, seconds: float):
+        with self.lock:
+            samples = self.active.pop(token)
+            if not self.active:
+                self.wakeup.clear()
+        if seconds >= self.threshold:
+            self.dump(label, seconds, samples)
+
+    def dump(self, label: str, seconds: float, samples: Counter):
+        total = sum(samples.values())
+        lines = [f"{count:>5} {stack}" for stack, count in samples.most_common(self.top)]
+        logger.warning("Slow request %s took %.1f ms; %d stack samples:\n%s",
+                       label, seconds * 1000, total, "\n".join(lines) or "  (none)")
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            self.wakeup.wait()
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or frame.f_code.co_name in self.IDLE:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(names)))
+            with self.lock:
+                for samples in self.active.values():
+                    samples.update(stacks)
+            time.sleep(self.interval)
+
+
+class MetricsMiddleware:
+    """ASGI middleware feeding `Metrics` (and, if given, a profiler) for every HTTP request."""
+
+    def __init__(self, app, metrics: Metrics, profiler=None):
+        self.app = app
+        self.metrics = metrics
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        token = self.profiler.start() if self.profiler else None
+
+        async def capture(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            template = route.path if route is not None else UNMATCHED
+            self.metrics.observe(scope["method"], template, status, elapsed)
+            if token is not None:
+                self.profiler.finish(token, f"{scope['method']} {scope['path']}", elapsed)
@@ -0,0 +1,55 @@
+from pydantic import BaseModel, Field, model_validator
+from typing import Annotated, Literal, Optional
+
+# Devices are stored in 64-bit typed arrays, and SQLite keeps every id as a
+# 64-bit INTEGER
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+Id = Annotated[int, Field(ge=INT64_MIN, le=INT64_MAX)]
+
+# Ids may be left out when creating a record; the server then allocates one.
+
+class User(BaseModel):
+    user_id : Optional[Id] = None
+    name : str = Field(..., min_length=3, max_length=50)
+
+class Device(BaseModel):
+    device_id: Optional[Id] = None
+    device_type: Literal["humidity", "temperature"]  # Only allow 'humidity' or 'temperature'
+    device_info : int = Field(..., ge=INT64_MIN, le=INT64_MAX)
+
+class Hallway(BaseModel):
+    hallway_id : Optional[Id] = None
+    name : str
+    devices : list[Device] = []
+
+class Room(BaseModel):
+    room_id : Optional[Id] = None
+    name : str
+    devices : list[Device] = []
+
+class Floor(BaseModel):
+    floor_id : Optional[Id] = None
+    name:str
+    rooms: list[Room] = []
+    hallways: list[Hallway] = []
+
+class House(BaseModel):
+    house_id: Optional[Id] = None
+    name:str
+    owner: User
+    floors: list[Floor] = []
+
+class Rule(BaseModel):
+    rule_id: Id
+    # Unset scope means every house; unset device_type means both types
+    scope: Optional[Literal["house", "floor", "room", "hallway"]] = None
+    scope_id: Optional[Id] = None
+    device_type: Optional[Literal["humidity", "temperature"]] = None
+    op: Literal[">", ">=", "<", "<="]
+    threshold: float = Field(..., allow_inf_nan=False)
+
+    @model_validator(mode="after")
+    def check_scope(self):
+        if (self.scope is None) != (self.scope_id is None):
+            raise ValueError("scope and scope_id go together")
+        return self
@@ -0,0 +1,161 @@
+import json
+import logging
+import mmap
+import os
+import pickle
+import threading
+
+logger = logging.getLogger(__name__)
+
+WAL_FILE = "wal.log"
+# The log being folded into a snapshot, until the snapshot is safely written
+OLD_WAL_FILE = "wal.log.old"
+SNAPSHOT_FILE = "snapshot.bin"
+# Compact the log into a snapshot once it holds this many records
+SNAPSHOT_EVERY = 100_000
+
+
+class Journal:
+    """Append-only write-ahead log of mutation records plus a binary snapshot.
+
+    Records are `(op, args)` pairs. The log stores one compact JSON line per
+    record, numbered in order; the snapshot is the whole state as one pickled
+    object, loaded directly instead of replayed, together with the number of
+    the last record it reflects. Compaction happens in two steps: `checkpoint`
+    captures the state and moves the log aside, which must happen with no
+    writes in flight, and `write_snapshot` writes it out while new records
+    are already being logged. Records at or below the snapshot's number are
+    skipped on load, so a crash between the steps loses nothing.
+    """
+
+    def __init__(self, data_dir: str, snapshot_every: int = SNAPSHOT_EVERY, sync: bool = True):
+        self.data_dir = data_dir
+        self.wal_path = os.path.join(data_dir, WAL_FILE)
+        self.old_wal_path = os.path.join(data_dir, OLD_WAL_FILE)
+        self.snapshot_path = os.path.join(data_dir, SNAPSHOT_FILE)
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.seq = 0  # number of the last record logged
+        self.wal = None
+        self.valid_end = None  # length of the log's intact prefix, once loaded
+        self.compaction = None  # background compaction thread, while one runs
+        os.makedirs(data_dir, exist_ok=True)
+
+    def load(self):
+        """Return `(state, records)`: the snapshot's state, or None if there is
+        none yet, and the records logged after it, oldest first."""
+        state, records, snapshot_seq = None, [], 0
+        if os.path.exists(self.snapshot_path) and os.path.getsize(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                state = pickle.loads(m)
+            if isinstance(state, tuple):
+                snapshot_seq, state = state
+            # else: a snapshot from before records were numbered
+        self.seq = snapshot_seq
+        self.valid_end = 0
+        for path in (self.old_wal_path, self.wal_path):
+            if not os.path.exists(path):
+                continue
+            end, loaded = 0, len(records)
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError
+                        op, args, *seq = json.loads(line)
+                    except ValueError:
+                        break  # torn final write from a crash; everything before it is intact
+                    end += len(line)
+                    # Unnumbered lines predate numbering and so any numbered snapshot
+                    seq = seq[0] if seq else None
+                    if seq is not None:
+                        if seq <= snapshot_seq:
+                            continue
+                        self.seq = seq
+                    records.append((op, args))
+                    self.pending += 1
+            if path == self.wal_path:
+                self.valid_end = end
+            elif len(records) == loaded:
+                os.remove(path)  # already all in the snapshot
+            else:
+                os.truncate(path, end)  # kept until the next snapshot, so it must end cleanly
+        return state, records
+
+    def open(self):
+        self.wal = open(self.wal_path, "ab")
+        if self.valid_end is not None:
+            # Cut off a torn final write, so new records follow the last intact one
+            self.wal.truncate(self.valid_end)
+
+    def append(self, op: str, args: dict, compact=None):
+        """Log one record. Once the log is long enough and `compact` is given,
+        it is started on a background thread; it should `checkpoint` with
+        writes held off and then `write_snapshot`."""
+        payload = json.dumps(args, separators=(",", ":"))
+        with self.lock:
+            self.seq += 1
+            self.wal.write(f"[{json.dumps(op)},{payload},{self.seq}]\n".encode())
+            self.wal.flush()
+            if self.sync:
+                os.fsync(self.wal.fileno())
+            self.pending += 1
+            if compact is not None and self.pending >= self.snapshot_every and self.compaction is None:
+                self.compaction = threading.Thread(target=self._run_compaction, args=(compact,),
+                                                   name="journal-compaction", daemon=True)
+                self.compaction.start()
+
+    def _run_compaction(self, compact):
+        try:
+            compact()
+        except Exception:
+            logger.exception("Journal compaction failed")
+        finally:
+            self.compaction = None
+
+    def checkpoint(self, state) -> bytes:
+        """Pickle `state`, which must reflect every record logged so far, and
+        move the log aside so new records start a fresh one."""
+        data = pickle.dumps((self.seq, state), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.wal is not None:
+                self.wal.close()
+            if os.path.exists(self.wal_path):
+                if os.path.exists(self.old_wal_path):
+                    # Left by a compaction that never finished; keep both logs' records
+                    with open(self.old_wal_path, "ab") as old, open(self.wal_path, "rb") as f:
+                        old.write(f.read())
+                    os.remove(self.wal_path)
+                else:
+                    os.replace(self.wal_path, self.old_wal_path)
+            self.wal = open(self.wal_path, "ab")
+            self.valid_end = None
+            self.pending = 0
+        return data
+
+    def write_snapshot(self, data: bytes):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Every record in the old log is in the snapshot now
+        if os.path.exists(self.old_wal_path):
+            os.remove(self.old_wal_path)
+
+    def compact(self, state):
+        """Both steps at once, for when nothing else is writing."""
+        self.write_snapshot(self.checkpoint(state))
+
+    def close(self):
+        compaction = self.compaction
+        if compaction is not None:
+            compaction.join()
+        with self.lock:
+            if self.wal is not None:
+                self.wal.close()
+                self.wal = None
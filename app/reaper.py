@@ -0,0 +1,121 @@
+from collections import OrderedDict
+import itertools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Records freed per lock hold, so a big subtree never stalls its house for long
+CHUNK = 500
+# Finished jobs kept around for the status endpoint
+KEEP_FINISHED = 1000
+
+
+class Job:
+    __slots__ = ("id", "kind", "root", "scope", "stack", "freed", "status", "done")
+
+    def __init__(self, id: int, kind: str, root: int, scope):
+        self.id = id
+        self.kind = kind
+        self.root = root
+        self.scope = scope
+        self.stack = [(kind, root)]
+        self.freed = {}
+        self.status = "pending"
+        self.done = threading.Event()
+
+    def summary(self) -> dict:
+        return {"job_id": self.id, "kind": self.kind, "id": self.root, "status": self.status,
+                "freed": dict(self.freed), "pending": len(self.stack)}
+
+
+class Reaper:
+    """Frees detached subtrees on a background thread, bottom-up and in chunks.
+
+    `children(kind, id)` lists a record's `(kind, id)` children and
+    `free(kind, id)` deletes one record whose children are already gone. Each
+    chunk runs under `lock_for(job.scope)` and `transaction()`, so requests on
+    the same house interleave with a long reap instead of waiting for all of it.
+    """
+
+    def __init__(self, children, free, lock_for, transaction, chunk: int = CHUNK):
+        self.children = children
+        self.free = free
+        self.lock_for = lock_for
+        self.transaction = transaction
+        self.chunk = chunk
+        self.ids = itertools.count(1)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="reaper", daemon=True)
+        self.thread.start()
+
+    def submit(self, kind: str, id: int, scope, inline: bool = False, held: bool = False) -> Job:
+        """Queue the subtree rooted at `(kind, id)`; with `inline`, free it now.
+
+        A `held` job gets its id but waits for `release` (or `cancel`), so a
+        write can hand out the id before it knows it will commit.
+        """
+        job = Job(next(self.ids), kind, id, scope)
+        with self.lock:
+            self.jobs[job.id] = job
+        if inline:
+            self._finish(job)
+        elif not held:
+            self.queue.put(job)
+        return job
+
+    def release(self, job: Job):
+        self.queue.put(job)
+
+    def cancel(self, job: Job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+
+    def status(self, job_id: int):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return None if job is None else job.summary()
+
+    def wait(self, job_id: int, timeout: float = None) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job is None or job.done.wait(timeout)
+
+    def _step(self, job: Job):
+        with self.lock_for(job.scope), self.transaction():
+            budget = self.chunk
+            while job.stack and budget:
+                kind, id = job.stack[-1]
+                # Children go on top the first time round; once they are all
+                # freed the record surfaces again with none left and goes too.
+                below = self.children(kind, id)
+                if below:
+                    job.stack.extend(below)
+                    continue
+                job.stack.pop()
+                self.free(kind, id)
+                job.freed[kind] = job.freed.get(kind, 0) + 1
+                budget -= 1
+
+    def _finish(self, job: Job):
+        job.status = "running"
+        try:
+            while job.stack:
+                self._step(job)
+        except Exception:
+            logger.exception("Reaping %s %s failed", job.kind, job.root)
+            job.status = "failed"
+        else:
+            job.status = "done"
+        job.done.set()
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.done.is_set()]
+            for old in finished[:max(0, len(finished) - KEEP_FINISHED)]:
+                del self.jobs[old.id]
+
+    def _run(self):
+        while True:
+            self._finish(self.queue.get())
@@ -0,0 +1,94 @@
+from array import array
+import threading
+from typing import get_args
+
+from .models import Device
+
+# Small-integer codes for the values repeated on every device
+DEVICE_TYPES = get_args(Device.model_fields["device_type"].annotation)
+CONTAINER_KINDS = ("room", "hallway")
+
+
+class DeviceRegistry:
+    """Devices stored as parallel typed arrays instead of one object each.
+
+    Slot i holds one device across `ids`, `types`, `values`, `container_kinds`
+    and `container_ids` (8 + 1 + 8 + 1 + 8 bytes), and `slots` maps a device
+    id to its slot. Deleting moves the last slot into the freed one, so the
+    arrays stay dense. `Device` models are only built by `get`, at the API
+    boundary; `values` can be scanned in bulk (e.g. with numpy.frombuffer).
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.types = array("b")
+        self.values = array("q")
+        self.container_kinds = array("b")
+        self.container_ids = array("q")
+        self.slots = {}
+        # Deletes move slots around, so every lookup resolves its slot under the lock
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, device_id):
+        return device_id in self.slots
+
+    def __iter__(self):
+        with self.lock:
+            return iter(self.ids.tolist())
+
+    def __getstate__(self):
+        # The columns pickle as raw bytes; `slots` is rebuilt from `ids` on load
+        with self.lock:
+            return {"ids": self.ids, "types": self.types, "values": self.values,
+                    "container_kinds": self.container_kinds, "container_ids": self.container_ids}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.slots = dict(zip(self.ids, range(len(self.ids))))
+        self.lock = threading.Lock()
+
+    def insert(self, device: Device, parent: tuple) -> bool:
+        """Append `device` under `parent`, a `(kind, id)` pair; False if the id is taken."""
+        with self.lock:
+            if device.device_id in self.slots:
+                return False
+            self.slots[device.device_id] = len(self.ids)
+            self.ids.append(device.device_id)
+            self.types.append(DEVICE_TYPES.index(device.device_type))
+            self.values.append(device.device_info)
+            self.container_kinds.append(CONTAINER_KINDS.index(parent[0]))
+            self.container_ids.append(parent[1])
+        return True
+
+    def get(self, device_id):
+        with self.lock:
+            slot = self.slots.get(device_id)
+            if slot is None:
+                return None
+            return Device.model_construct(device_id=device_id, device_type=DEVICE_TYPES[self.types[slot]],
+                                          device_info=self.values[slot])
+
+    def parent(self, device_id):
+        with self.lock:
+            slot = self.slots.get(device_id)
+            if slot is None:
+                return None
+            return (CONTAINER_KINDS[self.container_kinds[slot]], self.container_ids[slot])
+
+    def set_value(self, device_id, value: int):
+        with self.lock:
+            self.values[self.slots[device_id]] = value
+
+    def delete(self, device_id):
+        with self.lock:
+            slot = self.slots.pop(device_id)
+            last = len(self.ids) - 1
+            if slot != last:
+                for column in (self.ids, self.types, self.values, self.container_kinds, self.container_ids):
+                    column[slot] = column[last]
+                self.slots[self.ids[slot]] = slot
+            for column in (self.ids, self.types, self.values, self.container_kinds, self.container_ids):
+                del column[last]
@@ -0,0 +1,474 @@
+"""Sharded multi-process mode.
+
+Each worker is an ordinary `app.main:app` process owning the houses whose
+`house_id % len(shards)` is its index; users are replicated to every worker.
+The router in front forwards house-scoped requests to the owning worker,
+broadcasts user and unscoped alert rule writes, and scatters cross-house listings,
+telemetry, history lookups and alerts, merging what comes back.
+
+    python -m app.shard --workers 4 --port 8000
+
+Subscriptions (`/house/{id}/subscribe`) and `/metrics` are served by the
+workers themselves; `GET /shards` tells clients which worker owns a house.
+"""
+import argparse
+import asyncio
+import base64
+import heapq
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+
+from fastapi import FastAPI, HTTPException, Request, Response
+import httpx
+
+try:
+    import msgpack
+except ImportError:  # optional, as in app.main
+    msgpack = None
+
+from .ids import SPAN
+
+# Upstream headers passed back to the client
+FORWARD_HEADERS = ("content-type", "etag", "vary", "x-house-epoch", "x-house-version")
+HOUSE_PATH = re.compile(r"^/house/(-?\d+)(/.*)?$")
+DEVICE_CREATE = re.compile(r"/(room|hallway)/-?\d+/device$")
+HISTORY_PATH = re.compile(r"^/devices/(-?\d+)/history$")
+JOB_PATH = re.compile(r"^/jobs/(-?\d+)$")
+USER_PATH = re.compile(r"^/users/(-?\d+)$")
+USER_HOUSES_PATH = re.compile(r"^/users/(-?\d+)/houses$")
+RULE_PATH = re.compile(r"^/rules(/-?\d+)?$")
+LISTINGS = ("/users", "/houses", "/floors", "/rooms", "/hallways", "/devices")
+ID_FIELDS = {"/users": "user_id", "/houses": "house_id", "/floors": "floor_id", "/rooms": "room_id",
+             "/hallways": "hallway_id", "/devices": "device_id"}
+# Ids each worker checks for uniqueness only among its own houses
+WORKER_ID_FIELDS = ("floor_id", "room_id", "hallway_id", "device_id")
+
+
+class ShardRouter:
+    """Routes requests across worker processes by house_id.
+
+    `shards` are httpx.AsyncClient instances pointed at the workers. Devices
+    are located through `directory` (device_id -> shard), filled in as devices
+    are created, imported or found; a device not in it is looked up by asking
+    every shard once.
+    """
+
+    def __init__(self, shards: list):
+        self.shards = shards
+        self.directory = {}
+        self.user_writes = asyncio.Lock()
+        self.rule_writes = asyncio.Lock()
+
+    def shard_of(self, house_id: int) -> int:
+        return house_id % len(self.shards)
+
+    async def send(self, shard: int, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self.shards[shard].request(method, url, **kwargs)
+
+    async def broadcast(self, method: str, url: str, **kwargs) -> list:
+        return await asyncio.gather(*(self.send(i, method, url, **kwargs) for i in range(len(self.shards))))
+
+    def relay(self, response: httpx.Response, content: bytes = None) -> Response:
+        headers = {k: v for k, v in response.headers.items() if k in FORWARD_HEADERS}
+        return Response(content=response.content if content is None else content,
+                        status_code=response.status_code, headers=headers)
+
+    def check_ids(self, document, shard: int):
+        # A worker only sees its own houses' floors, rooms, hallways and
+        # devices, so two workers could accept the same id. Ids clients pick
+        # must lie in the owning worker's range, as the ones it allocates do.
+        if isinstance(document, list):
+            for item in document:
+                self.check_ids(item, shard)
+        elif isinstance(document, dict):
+            for name, value in document.items():
+                if name in WORKER_ID_FIELDS and isinstance(value, int) \
+                        and not shard * SPAN <= value < (shard + 1) * SPAN:
+                    raise HTTPException(status_code=400, detail=f"{name[:-3].capitalize()} id {value} is outside "
+                                                                f"the range of worker {shard}, which owns this house")
+                self.check_ids(value, shard)
+
+    def learn(self, house: dict, shard: int):
+        for floor in house.get("floors", ()):
+            for container in floor.get("rooms", []) + floor.get("hallways", []):
+                for device in container.get("devices", ()):
+                    self.directory[device["device_id"]] = shard
+
+    def global_job(self, response: httpx.Response, shard: int) -> Response:
+        # Job ids are per worker; fold the shard in so /jobs/{id} can find it again
+        body = response.json()
+        for result in body.get("results", [body]) if isinstance(body, dict) else ():
+            if isinstance(result, dict) and "job_id" in result:
+                result["job_id"] = result["job_id"] * len(self.shards) + shard
+        return self.relay(response, json.dumps(body).encode())
+
+    async def handle(self, request: Request) -> Response:
+        path, method = request.url.path, request.method
+        body = await request.body()
+        headers = {k: v for k, v in request.headers.items() if k in ("content-type", "accept", "if-none-match")}
+        kwargs = {"content": body, "headers": headers, "params": list(request.query_params.multi_items())}
+
+        if path == "/ids/reserve":
+            # Ids for a house's floors, rooms, hallways and devices come from the worker owning it
+            house_id = request.query_params.get("house_id", "")
+            shard = self.shard_of(int(house_id)) if house_id.lstrip("-").isdigit() else 0
+            return self.relay(await self.send(shard, method, path, **kwargs))
+        if path in ("/house", "/house/bulk") and method == "POST" and "ndjson" not in headers.get("content-type", ""):
+            body = kwargs["content"] = await self.fill_id(body, "house")
+        if path == "/users" and method == "POST":
+            body = kwargs["content"] = await self.fill_id(body, "user")
+        if path == "/house/bulk" and method == "POST":
+            return await self.bulk(body, headers, kwargs)
+        if path in ("/house", "/batch") and method == "POST":
+            try:
+                document = json.loads(body)
+                shard = self.shard_of(int(document["house_id"]))
+            except (ValueError, KeyError, TypeError):
+                document, shard = None, 0  # any worker gives the same validation error
+            if path == "/batch":
+                self.check_ids(document.get("operations") if document else None, shard)
+            response = await self.send(shard, method, path, **kwargs)
+            if path == "/batch" and response.status_code == 200:
+                return self.global_job(response, shard)
+            return self.relay(response)
+        match = HOUSE_PATH.match(path)
+        if match:
+            shard = self.shard_of(int(match.group(1)))
+            if method == "POST":
+                try:
+                    document = json.loads(body)
+                except ValueError:
+                    document = None  # the worker reports it
+                self.check_ids(document, shard)
+            response = await self.send(shard, method, path, **kwargs)
+            if method == "POST" and DEVICE_CREATE.search(path) and response.status_code == 200:
+                self.directory[response.json()["device_id"]] = shard
+            if method == "DELETE" and response.status_code == 202:
+                return self.global_job(response, shard)
+            return self.relay(response)
+        if path.startswith("/users"):
+            if method == "GET" and USER_HOUSES_PATH.match(path):
+                return await self.user_houses(path)
+            if method == "GET":
+                return self.relay(await self.send(0, method, path, **kwargs))
+            async with self.user_writes:
+                if method == "DELETE" and USER_PATH.match(path):
+                    return await self.delete_user(path, request, kwargs)
+                responses = await self.broadcast(method, path, **kwargs)
+            return self.relay(responses[0])
+        if RULE_PATH.match(path):
+            if method == "POST":
+                return await self.create_rule(body, kwargs)
+            if method == "DELETE":
+                async with self.rule_writes:
+                    return self.relay(self.found(await self.broadcast(method, path, **kwargs)))
+            return self.relay(self.found(await self.broadcast(method, path, **kwargs)))
+        if path == "/alerts" and method == "GET":
+            return await self.alerts(request)
+        if path == "/telemetry" and method == "POST":
+            return await self.telemetry(body, request.headers.get("content-type", ""))
+        if path in LISTINGS and method == "GET":
+            return await self.listing(path, request, kwargs)
+        match = HISTORY_PATH.match(path)
+        if match:
+            return await self.locate(int(match.group(1)), method, path, kwargs)
+        match = JOB_PATH.match(path)
+        if match:
+            job_id = int(match.group(1))
+            shard, local = job_id % len(self.shards), job_id // len(self.shards)
+            response = await self.send(shard, method, f"/jobs/{local}")
+            return self.global_job(response, shard) if response.status_code == 200 else self.relay(response)
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    async def fill_id(self, body: bytes, kind: str) -> bytes:
+        # Ids left for the server to pick come from shard 0, before routing,
+        # so every replica of a user and the shard owning a house agree on it
+        try:
+            document = json.loads(body)
+        except ValueError:
+            return body
+        if not isinstance(document, dict):
+            return body
+        chosen = document.get(f"{kind}_id")
+        if chosen is not None:
+            if kind == "house" and type(chosen) is int and self.shard_of(chosen) != 0:
+                # Shard 0 allocates every house id but stores only its own
+                # houses, so it is told about this one before it is created
+                await self.send(0, "POST", "/ids/observe", params={"kind": "house", "id": chosen})
+            return body
+        response = await self.send(0, "POST", "/ids/reserve", params={"kind": kind})
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.json()["detail"])
+        document[f"{kind}_id"] = response.json()["first"]
+        return json.dumps(document).encode()
+
+    async def user_houses(self, path: str) -> Response:
+        responses = await self.broadcast("GET", path)
+        if responses[0].status_code != 200:
+            return self.relay(responses[0])
+        houses = sorted((house for response in responses for house in response.json()["houses"]),
+                        key=lambda house: house["house_id"])
+        return Response(content=json.dumps({**responses[0].json(), "houses": houses}).encode(),
+                        media_type="application/json")
+
+    async def delete_user(self, path: str, request: Request, kwargs: dict) -> Response:
+        # Workers only see their own houses, so the ownership check is made
+        # here, before any replica of the user is removed
+        cascade = request.query_params.get("cascade", "").lower() in ("1", "true", "yes", "on")
+        owned = await self.broadcast("GET", path + "/houses")
+        if not cascade and any(r.status_code == 200 and r.json()["houses"] for r in owned):
+            raise HTTPException(status_code=400, detail="User still owns houses")
+        responses = await self.broadcast("DELETE", path, **kwargs)
+        if responses[0].status_code != 200:
+            return self.relay(responses[0])
+        job_ids = [job_id * len(self.shards) + shard for shard, response in enumerate(responses)
+                   for job_id in response.json().get("job_ids", ())]
+        return Response(content=json.dumps({**responses[0].json(), "job_ids": job_ids}).encode(),
+                        media_type="application/json")
+
+    async def locate(self, device_id: int, method: str, path: str, kwargs: dict) -> Response:
+        shard = self.directory.get(device_id)
+        if shard is not None:
+            response = await self.send(shard, method, path, **kwargs)
+            if response.status_code != 404:
+                return self.relay(response)
+        responses = await self.broadcast(method, path, **kwargs)
+        for shard, response in enumerate(responses):
+            if response.status_code != 404:
+                self.directory[device_id] = shard
+                return self.relay(response)
+        return self.relay(responses[0])
+
+    async def bulk(self, body: bytes, headers: dict, kwargs: dict) -> Response:
+        if "ndjson" not in headers.get("content-type", ""):
+            try:
+                house = json.loads(body)
+                shard = self.shard_of(int(house["house_id"]))
+            except (ValueError, KeyError, TypeError):
+                house, shard = None, 0
+            self.check_ids(house, shard)
+            response = await self.send(shard, "POST", "/house/bulk", **kwargs)
+            if response.status_code == 200:
+                self.learn(house, shard)
+            return self.relay(response)
+        # Each worker gets its own lines; results are put back in line order
+        groups, results = {}, {}
+        for position, line in enumerate(l for l in body.splitlines() if l.strip()):
+            line = await self.fill_id(line, "house")
+            try:
+                house = json.loads(line)
+                shard = self.shard_of(int(house["house_id"]))
+            except (ValueError, KeyError, TypeError):
+                house, shard = None, 0
+            try:
+                self.check_ids(house, shard)
+            except HTTPException as e:
+                results[position] = {"house_id": house["house_id"], "status": e.status_code, "detail": e.detail}
+                continue
+            groups.setdefault(shard, []).append((position, line, house))
+        sent = list(groups.items())
+        responses = await asyncio.gather(*(
+            self.send(shard, "POST", "/house/bulk", content=b"\n".join(line for _, line, _ in lines),
+                      headers=headers) for shard, lines in sent))
+        for (shard, lines), response in zip(sent, responses):
+            for (position, _, house), result in zip(lines, response.json()["results"]):
+                results[position] = result
+                if result["status"] == 200:
+                    self.learn(house, shard)
+        ordered = [results[position] for position in sorted(results)]
+        return Response(content=json.dumps({"imported": sum(1 for r in ordered if r["status"] == 200),
+                                            "results": ordered}).encode(), media_type="application/json")
+
+    async def telemetry(self, body: bytes, content_type: str) -> Response:
+        try:
+            if "msgpack" in content_type:
+                if msgpack is None:
+                    raise HTTPException(status_code=415, detail="MessagePack is not supported")
+                items = msgpack.unpackb(body)
+            elif "ndjson" in content_type:
+                items = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                items = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed telemetry body")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Expected an array of readings")
+        # Known devices go to their worker; unknown ones go everywhere once and
+        # take the answer from the worker that has them.
+        routed, unknown = {}, []
+        for position, item in enumerate(items):
+            device_id = item.get("device_id") if isinstance(item, dict) else None
+            shard = self.directory.get(device_id) if isinstance(device_id, int) else 0
+            if shard is None:
+                unknown.append(position)
+            else:
+                routed.setdefault(shard, []).append(position)
+        calls = [(shard, positions) for shard, positions in routed.items()]
+        calls += [(shard, unknown) for shard in range(len(self.shards)) if unknown]
+        responses = await asyncio.gather(*(
+            self.send(shard, "POST", "/telemetry", json=[items[p] for p in positions]) for shard, positions in calls))
+        if any(response.status_code == 429 for response in responses):
+            # A worker's write buffer is full; the readings others queued still stand
+            raise HTTPException(status_code=429, detail="Too many pending writes")
+        results = [None] * len(items)
+        for (shard, positions), response in zip(calls, responses):
+            for position, result in zip(positions, response.json()["results"]):
+                if results[position] is None or result["status"] != 404:
+                    results[position] = result
+                    if result["status"] in (200, 202):
+                        self.directory[result["device_id"]] = shard
+        applied = sum(1 for result in results if result["status"] == 200)
+        body = {"applied": applied, "results": results}
+        if any(result["status"] == 202 for result in results):
+            body["queued"] = sum(1 for result in results if result["status"] == 202)
+        return Response(content=json.dumps(body).encode(), media_type="application/json")
+
+    def found(self, responses: list) -> httpx.Response:
+        # The answer of a worker that has the record, if any does
+        return next((response for response in responses if response.status_code != 404), responses[0])
+
+    def scope_shard(self, scope: str, scope_id: int) -> int:
+        # Houses are placed by id; what is under them has ids from the owning
+        # worker's range. Anything else is found nowhere, shard 0 says so.
+        shard = self.shard_of(scope_id) if scope == "house" else scope_id // SPAN
+        return shard if 0 <= shard < len(self.shards) else 0
+
+    async def create_rule(self, body: bytes, kwargs: dict) -> Response:
+        # An unscoped rule goes to every worker, each checking readings of its
+        # own houses; a scoped one only to the worker owning that scope, the
+        # only one that can tell it exists. Rule ids are unique across both.
+        try:
+            rule = json.loads(body)
+            rule_id, scope, scope_id = rule["rule_id"], rule.get("scope"), rule.get("scope_id")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            rule_id = scope = scope_id = None  # any worker gives the same validation error
+        async with self.rule_writes:
+            if type(rule_id) is int:
+                existing = await self.broadcast("GET", f"/rules/{rule_id}")
+                if any(response.status_code == 200 for response in existing):
+                    raise HTTPException(status_code=400, detail="Rule already exists")
+            if isinstance(scope, str) and type(scope_id) is int:
+                return self.relay(await self.send(self.scope_shard(scope, scope_id), "POST", "/rules", **kwargs))
+            return self.relay((await self.broadcast("POST", "/rules", **kwargs))[0])
+
+    async def alerts(self, request: Request) -> Response:
+        # Alert ids are per worker, and a worker's alerts can come later than
+        # higher ids from another, so one id cannot mark where a poll got to.
+        # `last_alert_id` is a cursor holding each worker's own position
+        # instead; alert ids are folded with the worker as job ids are.
+        n = len(self.shards)
+        after = request.query_params.get("after", "0")
+        try:
+            if after.lstrip("-").isdigit():
+                positions = [max(0, (int(after) - shard) // n) for shard in range(n)]
+            else:
+                positions = json.loads(base64.urlsafe_b64decode(after.encode()))
+                if not (isinstance(positions, list) and len(positions) == n
+                        and all(type(position) is int for position in positions)):
+                    raise ValueError
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        limit = request.query_params.get("limit", "100")
+        responses = await asyncio.gather(*(self.send(shard, "GET", "/alerts", params={"after": position, "limit": limit})
+                                           for shard, position in enumerate(positions)))
+        for response in responses:
+            if response.status_code != 200:
+                return self.relay(response)
+        fired = heapq.merge(*([(alert, shard) for alert in response.json()["alerts"]]
+                              for shard, response in enumerate(responses)), key=lambda pair: pair[0]["ts"])
+        alerts = []
+        for alert, shard in itertools.islice(fired, int(limit)):
+            positions[shard] = alert["alert_id"]
+            alerts.append({**alert, "alert_id": alert["alert_id"] * n + shard})
+        cursor = base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+        return Response(content=json.dumps({"alerts": alerts, "last_alert_id": cursor}).encode(),
+                        media_type="application/json")
+
+    async def listing(self, path: str, request: Request, kwargs: dict) -> Response:
+        params = request.query_params
+        if path == "/users":
+            return self.relay(await self.send(0, "GET", path, **kwargs))
+        house_id = params.get("house_id")
+        if house_id is not None:
+            # One that is not a number gets the worker's own validation error
+            shard = self.shard_of(int(house_id)) if house_id.lstrip("-").isdigit() else 0
+            return self.relay(await self.send(shard, "GET", path, **kwargs))
+        # Every worker pages with the same keyset cursor; the global page is the
+        # first `limit` of their merged pages, in the order the workers use.
+        responses = await self.broadcast("GET", path, **kwargs)
+        for response in responses:
+            if response.status_code != 200:
+                return self.relay(response)
+        limit = int(params.get("limit", 50))  # validated by the workers by now
+        by_value = path == "/devices" and (params.get("min_info") or params.get("max_info")) \
+            and not any(params.get(name) for name in ("floor_id", "device_type"))
+        id_field = ID_FIELDS[path]
+
+        def key(item):
+            return [item["device_info"], item[id_field]] if by_value else item[id_field]
+
+        pages = [response.json() for response in responses]
+        merged = list(heapq.merge(*(page["items"] for page in pages), key=key))
+        items = merged[:limit]
+        more = len(merged) > limit or any(page["next_cursor"] for page in pages)
+        next_cursor = None
+        if more and items:
+            next_cursor = base64.urlsafe_b64encode(json.dumps(key(items[-1])).encode()).decode()
+        return Response(content=json.dumps({"items": items, "next_cursor": next_cursor}).encode(),
+                        media_type="application/json")
+
+
+def create_router(urls: list) -> FastAPI:
+    router_app = FastAPI()
+    router = ShardRouter([httpx.AsyncClient(base_url=url, timeout=30) for url in urls])
+    router_app.state.router = router
+
+    @router_app.get("/shards")
+    def shards(house_id: int = None):
+        if house_id is None:
+            return {"shards": urls}
+        return {"house_id": house_id, "shard": router.shard_of(house_id), "url": urls[router.shard_of(house_id)]}
+
+    @router_app.api_route("/{path:path}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def forward(request: Request):
+        return await router.handle(request)
+
+    return router_app
+
+
+if os.environ.get("HOUSE_SHARDS"):
+    app = create_router(os.environ["HOUSE_SHARDS"].split(","))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the API as sharded worker processes behind a router")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+    import uvicorn
+
+    ports = [args.port + 1 + i for i in range(args.workers)]
+    workers = []
+    for i, port in enumerate(ports):
+        env = dict(os.environ)
+        # Workers allocate ids from disjoint ranges
+        env["HOUSE_ID_BASE"] = str(i * SPAN)
+        if env.get("HOUSE_DATA_DIR"):
+            # Each worker journals its own partition
+            env["HOUSE_DATA_DIR"] = os.path.join(env["HOUSE_DATA_DIR"], f"shard-{i}")
+        workers.append(subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app",
+                                         "--host", "127.0.0.1", "--port", str(port)], env=env))
+    try:
+        uvicorn.run(create_router([f"http://127.0.0.1:{port}" for port in ports]), host=args.host, port=args.port)
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,723 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import queue
+import sqlite3
+import threading
+import uuid
+
+from .indexes import SortedIndex, scan_sorted
+from .registry import DeviceRegistry
+from .models import Device, Floor, Hallway, House, Room, User
+
+ID_FIELD = {
+    "user": "user_id",
+    "house": "house_id",
+    "floor": "floor_id",
+    "room": "room_id",
+    "hallway": "hallway_id",
+    "device": "device_id",
+}
+PARENT_KIND = {"house": "user", "floor": "house", "room": "floor", "hallway": "floor"}
+# Filters accepted by `page`, per kind
+PAGE_FILTERS = {
+    "user": (),
+    "house": ("user_id",),
+    "floor": ("house_id",),
+    "room": ("house_id", "floor_id"),
+    "hallway": ("house_id", "floor_id"),
+    "device": ("house_id", "floor_id", "device_type", "min_info", "max_info"),
+}
+
+# parent kind -> kinds that hang off it
+CHILD_KINDS = {
+    "user": ("house",),
+    "house": ("floor",),
+    "floor": ("room", "hallway"),
+    "room": ("device",),
+    "hallway": ("device",),
+    "device": (),
+}
+
+
+def keyed_by_value(kind: str, filters: dict) -> bool:
+    """Whether `page` keys these matches by `(device_info, device_id)` rather than by id."""
+    return (kind == "device"
+            and (filters.get("min_info") is not None or filters.get("max_info") is not None)
+            and all(filters.get(name) is None for name in ("floor_id", "house_id", "device_type")))
+
+
+class DuplicateError(Exception):
+    """Raised by `add` when the id is already taken."""
+
+
+class Repository:
+    """Storage behind the route handlers.
+
+    Records are the API models with their nested child lists left empty.
+    Every entity except a user has a parent: a house's is its owner's
+    user_id, a floor's its house_id, a room's or hallway's its floor_id and a
+    device's a ("room" | "hallway", container_id) pair. Callers cascade
+    deletes themselves; `remove` only detaches a single record. `add` is an
+    atomic insert-if-absent, since ids are global while locks are per house.
+    """
+
+    def get(self, kind: str, id: int):
+        raise NotImplementedError
+
+    def contains(self, kind: str, id: int) -> bool:
+        raise NotImplementedError
+
+    def add(self, kind: str, record, parent=None):
+        raise NotImplementedError
+
+    def update(self, kind: str, id: int, **fields):
+        raise NotImplementedError
+
+    def remove(self, kind: str, id: int):
+        raise NotImplementedError
+
+    def detach(self, kind: str, id: int):
+        """Unlink a record from its parent in O(1). It and its descendants stay
+        stored, with their ids taken, until each is `remove`d; meanwhile
+        `parent` returns None for it, it is not among its parent's `children`
+        and `page` skips the whole subtree."""
+        raise NotImplementedError
+
+    def parent(self, kind: str, id: int):
+        raise NotImplementedError
+
+    def children(self, kind: str, id: int, child_kind: str) -> list:
+        raise NotImplementedError
+
+    def count(self, kind: str) -> int:
+        raise NotImplementedError
+
+    def ids(self, kind: str) -> list:
+        raise NotImplementedError
+
+    def max_id(self, kind: str, low: int, high: int):
+        """The highest id in [low, high), or None."""
+        raise NotImplementedError
+
+    def detached_records(self) -> list:
+        """`(kind, id, house_id)` of every detached record not yet removed."""
+        raise NotImplementedError
+
+    def dump(self):
+        """Everything stored, as one picklable object that `load` puts back
+        without going through `add` record by record."""
+        raise NotImplementedError
+
+    def load(self, state):
+        """Replace the whole contents with a `dump`."""
+        raise NotImplementedError
+
+    def page(self, kind: str, filters: dict, after=None, limit: int = 50) -> list:
+        """Up to `limit` `(key, record, parent)` matches ordered by key, starting
+        after `after`. Keys are ids, except for devices filtered only by a
+        device_info range, which are ordered by `(device_info, device_id)`."""
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self, rollback: bool = True):
+        """Writes inside commit together, or not at all if the block raises.
+        `rollback=False` lets a backend skip keeping undo state for a block
+        that handles its own errors, such as journal replay."""
+        yield
+
+    def close(self):
+        pass
+
+
+class MemoryRepository(Repository):
+    """Dict-backed store. Child sets are insertion-ordered dicts, so every
+    operation is O(1) and children come back in creation order. Devices, by
+    far the most numerous, live in a compact array-backed DeviceRegistry."""
+
+    # Attributes holding the stored data, as opposed to per-thread bookkeeping
+    STATE = ("records", "parents", "devices", "kids", "ordered", "devices_by_type",
+             "devices_by_house", "devices_by_value", "detached")
+
+    def __init__(self):
+        self.records = {kind: {} for kind in ID_FIELD if kind != "device"}
+        self.parents = {kind: {} for kind in ID_FIELD if kind != "device"}
+        self.devices = DeviceRegistry()
+        # (parent kind, parent id) -> {child kind: {child_id: None}}
+        self.kids = {}
+        # Secondary indexes for `page`
+        self.ordered = {kind: SortedIndex() for kind in ID_FIELD}
+        self.devices_by_type = {}
+        self.devices_by_house = {}
+        self.devices_by_value = SortedIndex()  # (device_info, device_id)
+        # (kind, id) of detached records still awaiting removal
+        self.detached = set()
+        # Undo log of the running transaction, per thread
+        self.local = threading.local()
+
+    @contextmanager
+    def transaction(self, rollback: bool = True):
+        if not rollback or getattr(self.local, "undo", None) is not None:
+            yield
+            return
+        self.local.undo, self.local.orders = [], {}
+        try:
+            yield
+        except BaseException:
+            undo = self.local.undo
+            self.local.undo = None  # the undo steps themselves are not logged
+            for step in reversed(undo):
+                step()
+            raise
+        finally:
+            self.local.undo = self.local.orders = None
+
+    def _log(self, step):
+        undo = getattr(self.local, "undo", None)
+        if undo is not None:
+            undo.append(step)
+
+    def _keep_order(self, siblings):
+        # The first removal from a sibling group in a transaction records the
+        # group's order, so a rollback puts re-added children back in place
+        undo = getattr(self.local, "undo", None)
+        if undo is None or siblings is None or id(siblings) in self.local.orders:
+            return
+        self.local.orders[id(siblings)] = siblings
+        order = list(siblings)
+
+        def reorder():
+            known = set(order)
+            ids = [id for id in order if id in siblings] + [id for id in siblings if id not in known]
+            siblings.clear()
+            siblings.update(dict.fromkeys(ids))
+        undo.append(reorder)
+
+    def _link(self, kind, id):
+        self.kids[(kind, id)] = {child_kind: {} for child_kind in CHILD_KINDS[kind]}
+
+    def _siblings(self, kind, parent):
+        key = parent if kind == "device" else (PARENT_KIND[kind], parent)
+        group = self.kids.get(key)
+        # A house can outlive its owner's user record
+        return None if group is None else group[kind]
+
+    def get(self, kind, id):
+        if kind == "device":
+            return self.devices.get(id)
+        return self.records[kind].get(id)
+
+    def contains(self, kind, id):
+        return id in (self.devices if kind == "device" else self.records[kind])
+
+    def add(self, kind, record, parent=None):
+        id = getattr(record, ID_FIELD[kind])
+        if kind == "device":
+            if not self.devices.insert(record, parent):
+                raise DuplicateError(kind, id)
+            self._siblings(kind, parent)[id] = None
+            self.ordered[kind].add(id)
+            self.devices_by_type.setdefault(record.device_type, SortedIndex()).add(id)
+            self.devices_by_house.setdefault(self._device_house(id), SortedIndex()).add(id)
+            self.devices_by_value.add((record.device_info, id))
+            self._log(lambda: self.remove(kind, id))
+            return
+        if self.records[kind].setdefault(id, record) is not record:
+            raise DuplicateError(kind, id)
+        self._link(kind, id)
+        if kind != "user":
+            self.parents[kind][id] = parent
+            self._siblings(kind, parent)[id] = None
+        self.ordered[kind].add(id)
+        self._log(lambda: self.remove(kind, id))
+
+    def update(self, kind, id, **fields):
+        if kind == "device":
+            # device_info is the only mutable device field
+            old = self.devices.get(id).device_info
+            self.devices.set_value(id, fields["device_info"])
+            self.devices_by_value.discard((old, id))
+            self.devices_by_value.add((fields["device_info"], id))
+            self._log(lambda: self.update(kind, id, device_info=old))
+            return
+        record = self.records[kind][id]
+        old = {name: getattr(record, name) for name in fields}
+        for name, value in fields.items():
+            setattr(record, name, value)
+        self._log(lambda: self.update(kind, id, **old))
+
+    def remove(self, kind, id):
+        record = self.get(kind, id)
+        parent = self.devices.parent(id) if kind == "device" else self.parents[kind].get(id)
+        kids = self.kids.get((kind, id))
+        was_detached = (kind, id) in self.detached
+        siblings = None if kind == "user" else self._siblings(kind, parent)
+        self._keep_order(siblings)
+        self.ordered[kind].discard(id)
+        if kind == "device":
+            self.devices_by_type[record.device_type].discard(id)
+            self.devices_by_house[self._device_house(id)].discard(id)
+            self.devices_by_value.discard((record.device_info, id))
+            self.devices.delete(id)
+        else:
+            del self.records[kind][id]
+            del self.kids[(kind, id)]
+            if kind != "user":
+                del self.parents[kind][id]
+        self.detached.discard((kind, id))
+        if siblings is not None:
+            siblings.pop(id, None)
+
+        def restore():
+            self.add(kind, record, parent)
+            if kids is not None:
+                self.kids[(kind, id)] = kids
+            if was_detached:
+                self.detach(kind, id)
+        self._log(restore)
+
+    def detach(self, kind, id):
+        # Raw parent pointers stay so the secondary indexes can still be unwound on remove
+        siblings = self._siblings(kind, self.parents[kind][id])
+        self._keep_order(siblings)
+        if siblings is not None:
+            siblings.pop(id, None)
+        self.detached.add((kind, id))
+
+        def reattach():
+            self.detached.discard((kind, id))
+            if siblings is not None:
+                siblings[id] = None
+        self._log(reattach)
+
+    def parent(self, kind, id):
+        if kind == "device":
+            return self.devices.parent(id)
+        if (kind, id) in self.detached:
+            return None
+        return self.parents[kind].get(id)
+
+    def children(self, kind, id, child_kind):
+        return list(self.kids[(kind, id)][child_kind])
+
+    def count(self, kind):
+        return len(self.devices if kind == "device" else self.records[kind])
+
+    def ids(self, kind):
+        return list(self.devices if kind == "device" else self.records[kind])
+
+    def max_id(self, kind, low, high):
+        keys = self.ordered[kind].sorted_keys()
+        i = bisect_left(keys, high)
+        return keys[i - 1] if i and keys[i - 1] >= low else None
+
+    def detached_records(self):
+        found = []
+        for kind, id in self.detached:
+            up, house_id = kind, id
+            while up != "house":
+                up, house_id = PARENT_KIND[up], self.parents[up][house_id]
+            found.append((kind, id, house_id))
+        return found
+
+    def dump(self):
+        # Pickled as is: the registry as its typed columns, the indexes as sorted lists
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def load(self, state):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+
+    def _device_floor(self, id):
+        parent = self.devices.parent(id)
+        return None if parent is None else self.parents[parent[0]].get(parent[1])
+
+    def _device_house(self, id):
+        return self.parents["floor"].get(self._device_floor(id))
+
+    def _floor_ids(self, filters):
+        if filters.get("floor_id") is not None:
+            return [filters["floor_id"]]
+        return list(self.kids.get(("house", filters["house_id"]), {}).get("floor", ()))
+
+    def _plan(self, kind, filters, after):
+        # Pick the narrowest index for the filters; `_matches` checks the rest
+        if kind == "device":
+            low, high = filters.get("min_info"), filters.get("max_info")
+            if filters.get("floor_id") is not None:
+                ids = []
+                for floor_id in self._floor_ids(filters):
+                    group = self.kids.get(("floor", floor_id), {})
+                    for container_kind in ("room", "hallway"):
+                        for container_id in group.get(container_kind, ()):
+                            ids.extend(self.kids[(container_kind, container_id)]["device"])
+                return scan_sorted(sorted(ids), after)
+            if filters.get("house_id") is not None:
+                return self.devices_by_house.get(filters["house_id"], SortedIndex()).scan(after)
+            if filters.get("device_type") is not None:
+                return self.devices_by_type.get(filters["device_type"], SortedIndex()).scan(after)
+            if low is not None or high is not None:
+                return self.devices_by_value.scan(
+                    after,
+                    low=None if low is None else (low, float("-inf")),
+                    high=None if high is None else (high, float("inf")))
+        elif kind in ("room", "hallway") and (filters.get("floor_id") is not None or filters.get("house_id") is not None):
+            ids = []
+            for floor_id in self._floor_ids(filters):
+                ids.extend(self.kids.get(("floor", floor_id), {}).get(kind, ()))
+            return scan_sorted(sorted(ids), after)
+        elif kind == "floor" and filters.get("house_id") is not None:
+            return scan_sorted(sorted(self.kids.get(("house", filters["house_id"]), {}).get("floor", ())), after)
+        elif kind == "house" and filters.get("user_id") is not None:
+            return scan_sorted(sorted(self.kids.get(("user", filters["user_id"]), {}).get("house", ())), after)
+        return self.ordered[kind].scan(after)
+
+    def _live(self, kind, id):
+        # False under a detached ancestor (or if detached itself)
+        if not self.detached:
+            return True
+        if kind == "device":
+            kind, id = self.devices.parent(id)
+        while kind != "user" and id is not None:
+            if (kind, id) in self.detached:
+                return False
+            kind, id = PARENT_KIND[kind], self.parents[kind].get(id)
+        return True
+
+    def _matches(self, kind, id, record, filters):
+        parent = self.parent(kind, id)
+        if kind == "device":
+            floor_id = self._device_floor(id)
+            return ((filters.get("device_type") is None or record.device_type == filters["device_type"])
+                    and (filters.get("min_info") is None or record.device_info >= filters["min_info"])
+                    and (filters.get("max_info") is None or record.device_info <= filters["max_info"])
+                    and (filters.get("floor_id") is None or floor_id == filters["floor_id"])
+                    and (filters.get("house_id") is None
+                         or self.parents["floor"].get(floor_id) == filters["house_id"]))
+        if kind in ("room", "hallway"):
+            return ((filters.get("floor_id") is None or parent == filters["floor_id"])
+                    and (filters.get("house_id") is None
+                         or self.parents["floor"].get(parent) == filters["house_id"]))
+        if kind == "floor":
+            return filters.get("house_id") is None or parent == filters["house_id"]
+        if kind == "house":
+            return filters.get("user_id") is None or parent == filters["user_id"]
+        return True
+
+    def page(self, kind, filters, after=None, limit=50):
+        found = []
+        for key in self._plan(kind, filters, after):
+            id = key[1] if isinstance(key, tuple) else key
+            record = self.get(kind, id)
+            if record is None or not self._live(kind, id) or not self._matches(kind, id, record, filters):
+                continue
+            found.append((key, record, self.parent(kind, id)))
+            if len(found) == limit:
+                break
+        return found
+
+
+class ConnectionPool:
+    def __init__(self, connect, size: int):
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(connect())
+
+    @contextmanager
+    def connection(self):
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (id INTEGER NOT NULL UNIQUE, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS houses (id INTEGER NOT NULL UNIQUE, name TEXT NOT NULL, parent_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS floors (id INTEGER NOT NULL UNIQUE, name TEXT NOT NULL, parent_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS rooms (id INTEGER NOT NULL UNIQUE, name TEXT NOT NULL, parent_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS hallways (id INTEGER NOT NULL UNIQUE, name TEXT NOT NULL, parent_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS devices (id INTEGER NOT NULL UNIQUE, device_type TEXT NOT NULL,
+    device_info INTEGER NOT NULL, parent_kind TEXT NOT NULL, parent_id INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS houses_parent ON houses (parent_id);
+CREATE INDEX IF NOT EXISTS floors_parent ON floors (parent_id);
+CREATE INDEX IF NOT EXISTS rooms_parent ON rooms (parent_id);
+CREATE INDEX IF NOT EXISTS hallways_parent ON hallways (parent_id);
+CREATE INDEX IF NOT EXISTS devices_parent ON devices (parent_kind, parent_id);
+CREATE INDEX IF NOT EXISTS devices_type ON devices (device_type, id);
+CREATE INDEX IF NOT EXISTS devices_value ON devices (device_info, id);
+CREATE TABLE IF NOT EXISTS detached (kind TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (kind, id));
+"""
+
+# Record columns (in `_record` order) followed by the parent reference
+PAGE_COLUMNS = {
+    "user": "t.id, t.name",
+    "house": "t.id, t.name, t.parent_id, (SELECT name FROM users WHERE id = t.parent_id), t.parent_id",
+    "floor": "t.id, t.name, t.parent_id",
+    "room": "t.id, t.name, t.parent_id",
+    "hallway": "t.id, t.name, t.parent_id",
+    "device": "t.id, t.device_type, t.device_info, t.parent_kind, t.parent_id",
+}
+
+# `(kind, id)` of a row and its ancestors, for skipping detached subtrees in `page`
+FLOOR_OF_DEVICE = ("(CASE t.parent_kind WHEN 'room' THEN (SELECT parent_id FROM rooms WHERE id = t.parent_id) "
+                   "ELSE (SELECT parent_id FROM hallways WHERE id = t.parent_id) END)")
+LINEAGE = {
+    "user": [],
+    "house": [("'house'", "t.id")],
+    "floor": [("'floor'", "t.id"), ("'house'", "t.parent_id")],
+    "room": [("'room'", "t.id"), ("'floor'", "t.parent_id"),
+             ("'house'", "(SELECT parent_id FROM floors WHERE id = t.parent_id)")],
+    "hallway": [("'hallway'", "t.id"), ("'floor'", "t.parent_id"),
+                ("'house'", "(SELECT parent_id FROM floors WHERE id = t.parent_id)")],
+    "device": [("t.parent_kind", "t.parent_id"), ("'floor'", FLOOR_OF_DEVICE),
+               ("'house'", f"(SELECT parent_id FROM floors WHERE id = {FLOOR_OF_DEVICE})")],
+}
+
+TABLE = {"user": "users", "house": "houses", "floor": "floors",
+         "room": "rooms", "hallway": "hallways", "device": "devices"}
+# The house above a detached record
+HOUSE_OF = {
+    "house": "SELECT ?",
+    "floor": "SELECT parent_id FROM floors WHERE id = ?",
+    "room": "SELECT f.parent_id FROM rooms t JOIN floors f ON f.id = t.parent_id WHERE t.id = ?",
+    "hallway": "SELECT f.parent_id FROM hallways t JOIN floors f ON f.id = t.parent_id WHERE t.id = ?",
+}
+
+
+class SQLiteRepository(Repository):
+    """SQLite-backed store for datasets that do not fit in memory.
+
+    Connections come from a fixed pool; a `transaction()` pins one connection
+    to the calling thread so a batch of writes commits once. Children are
+    returned in insertion (rowid) order, like the in-memory store.
+    """
+
+    def __init__(self, path: str = ":memory:", pool_size: int = 4):
+        if path == ":memory:":
+            # A private shared-cache database, so every pooled connection sees it
+            path = f"file:houses-{uuid.uuid4().hex}?mode=memory&cache=shared"
+        self.path = path
+        self.local = threading.local()
+        self.pool = ConnectionPool(self._connect, pool_size)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, uri=self.path.startswith("file:"),
+                               check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self.pool.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def transaction(self, rollback: bool = True):
+        if getattr(self.local, "conn", None) is not None:
+            yield
+            return
+        with self.pool.connection() as conn:
+            self.local.conn = conn
+            # IMMEDIATE takes the write lock up front, so two writers queue on
+            # busy_timeout instead of deadlocking on a read-to-write upgrade
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self.local.conn = None
+
+    def _record(self, kind, row):
+        if kind == "user":
+            return User.model_construct(user_id=row[0], name=row[1])
+        if kind == "house":
+            owner = User.model_construct(user_id=row[2], name=row[3] if row[3] is not None else "")
+            return House.model_construct(house_id=row[0], name=row[1], owner=owner, floors=[])
+        if kind == "floor":
+            return Floor.model_construct(floor_id=row[0], name=row[1], rooms=[], hallways=[])
+        if kind == "room":
+            return Room.model_construct(room_id=row[0], name=row[1], devices=[])
+        if kind == "hallway":
+            return Hallway.model_construct(hallway_id=row[0], name=row[1], devices=[])
+        return Device.model_construct(device_id=row[0], device_type=row[1], device_info=row[2])
+
+    def get(self, kind, id):
+        with self._conn() as conn:
+            if kind == "house":
+                row = conn.execute("SELECT h.id, h.name, h.parent_id, u.name FROM houses h "
+                                   "LEFT JOIN users u ON u.id = h.parent_id WHERE h.id = ?", (id,)).fetchone()
+            elif kind == "device":
+                row = conn.execute("SELECT id, device_type, device_info FROM devices WHERE id = ?", (id,)).fetchone()
+            else:
+                row = conn.execute(f"SELECT id, name FROM {TABLE[kind]} WHERE id = ?", (id,)).fetchone()
+        return None if row is None else self._record(kind, row)
+
+    def contains(self, kind, id):
+        with self._conn() as conn:
+            return conn.execute(f"SELECT 1 FROM {TABLE[kind]} WHERE id = ?", (id,)).fetchone() is not None
+
+    def add(self, kind, record, parent=None):
+        id = getattr(record, ID_FIELD[kind])
+        with self._conn() as conn:
+            try:
+                self._insert(conn, kind, id, record, parent)
+            except sqlite3.IntegrityError:
+                raise DuplicateError(kind, id)
+
+    def _insert(self, conn, kind, id, record, parent):
+        if kind == "user":
+            conn.execute("INSERT INTO users (id, name) VALUES (?, ?)", (id, record.name))
+        elif kind == "device":
+            conn.execute("INSERT INTO devices (id, device_type, device_info, parent_kind, parent_id) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (id, record.device_type, record.device_info, parent[0], parent[1]))
+        else:
+            conn.execute(f"INSERT INTO {TABLE[kind]} (id, name, parent_id) VALUES (?, ?, ?)",
+                         (id, record.name, parent))
+
+    def update(self, kind, id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._conn() as conn:
+            conn.execute(f"UPDATE {TABLE[kind]} SET {assignments} WHERE id = ?", (*fields.values(), id))
+
+    def remove(self, kind, id):
+        with self._conn() as conn:
+            conn.execute(f"DELETE FROM {TABLE[kind]} WHERE id = ?", (id,))
+            conn.execute("DELETE FROM detached WHERE kind = ? AND id = ?", (kind, id))
+
+    def detach(self, kind, id):
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO detached (kind, id) VALUES (?, ?)", (kind, id))
+
+    def parent(self, kind, id):
+        with self._conn() as conn:
+            if kind == "device":
+                row = conn.execute("SELECT parent_kind, parent_id FROM devices WHERE id = ?", (id,)).fetchone()
+                return None if row is None else (row[0], row[1])
+            row = conn.execute(f"SELECT parent_id FROM {TABLE[kind]} WHERE id = ? AND NOT EXISTS "
+                               "(SELECT 1 FROM detached WHERE kind = ? AND id = ?)", (id, kind, id)).fetchone()
+        return None if row is None else row[0]
+
+    def children(self, kind, id, child_kind):
+        with self._conn() as conn:
+            if child_kind == "device":
+                rows = conn.execute("SELECT id FROM devices WHERE parent_kind = ? AND parent_id = ? ORDER BY rowid",
+                                    (kind, id))
+            else:
+                rows = conn.execute(f"SELECT id FROM {TABLE[child_kind]} t WHERE parent_id = ? AND NOT EXISTS "
+                                    "(SELECT 1 FROM detached d WHERE d.kind = ? AND d.id = t.id) ORDER BY rowid",
+                                    (id, child_kind))
+            return [row[0] for row in rows]
+
+    def count(self, kind):
+        with self._conn() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {TABLE[kind]}").fetchone()[0]
+
+    def ids(self, kind):
+        with self._conn() as conn:
+            return [row[0] for row in conn.execute(f"SELECT id FROM {TABLE[kind]} ORDER BY rowid")]
+
+    def max_id(self, kind, low, high):
+        with self._conn() as conn:
+            return conn.execute(f"SELECT MAX(id) FROM {TABLE[kind]} WHERE id >= ? AND id < ?",
+                                (low, high)).fetchone()[0]
+
+    def detached_records(self):
+        with self._conn() as conn:
+            return [(kind, id, conn.execute(HOUSE_OF[kind], (id,)).fetchone()[0])
+                    for kind, id in conn.execute("SELECT kind, id FROM detached").fetchall()]
+
+    def dump(self):
+        with self._conn() as conn:
+            return {table: conn.execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall()
+                    for table in (*TABLE.values(), "detached")}
+
+    def load(self, state):
+        with self.transaction(), self._conn() as conn:
+            for table, rows in state.items():
+                conn.execute(f"DELETE FROM {table}")
+                if rows:
+                    conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+
+    def page(self, kind, filters, after=None, limit=50):
+        where, params = [], []
+        by_value = False
+        floors_of_house = "SELECT id FROM floors WHERE parent_id = ?"
+        if kind == "device":
+            if filters.get("device_type") is not None:
+                where.append("t.device_type = ?")
+                params.append(filters["device_type"])
+            if filters.get("min_info") is not None:
+                where.append("t.device_info >= ?")
+                params.append(filters["min_info"])
+            if filters.get("max_info") is not None:
+                where.append("t.device_info <= ?")
+                params.append(filters["max_info"])
+            for name, cond in (("floor_id", "parent_id = ?"), ("house_id", f"parent_id IN ({floors_of_house})")):
+                if filters.get(name) is not None:
+                    where.append(f"((t.parent_kind = 'room' AND t.parent_id IN (SELECT id FROM rooms WHERE {cond})) OR "
+                                 f"(t.parent_kind = 'hallway' AND t.parent_id IN (SELECT id FROM hallways WHERE {cond})))")
+                    params.extend([filters[name], filters[name]])
+            by_value = keyed_by_value(kind, filters)
+        else:
+            if filters.get("floor_id") is not None:
+                where.append("t.parent_id = ?")
+                params.append(filters["floor_id"])
+            if filters.get("house_id") is not None:
+                where.append("t.parent_id = ?" if kind == "floor" else f"t.parent_id IN ({floors_of_house})")
+                params.append(filters["house_id"])
+            if filters.get("user_id") is not None:
+                where.append("t.parent_id = ?")
+                params.append(filters["user_id"])
+        if LINEAGE[kind]:
+            where.append("NOT EXISTS (SELECT 1 FROM detached d WHERE "
+                         + " OR ".join(f"(d.kind = {k} AND d.id = {i})" for k, i in LINEAGE[kind]) + ")")
+        if after is not None:
+            where.append("(t.device_info, t.id) > (?, ?)" if by_value else "t.id > ?")
+            params.extend(after if by_value else [after])
+        sql = f"SELECT {PAGE_COLUMNS[kind]} FROM {TABLE[kind]} t"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += (" ORDER BY t.device_info, t.id" if by_value else " ORDER BY t.id") + " LIMIT ?"
+        params.append(limit)
+        with self._conn() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        found = []
+        for row in rows:
+            if kind == "device":
+                parent = (row[3], row[4])
+            elif kind == "user":
+                parent = None
+            else:
+                parent = row[-1]
+            key = (row[2], row[0]) if by_value else row[0]
+            found.append((key, self._record(kind, row), parent))
+        return found
+
+    def close(self):
+        self.pool.close()
+
+
+def open_repository(url: str) -> Repository:
+    """`memory` or `sqlite:<path>` (`sqlite::memory:` for a throwaway database)."""
+    if url == "memory":
+        return MemoryRepository()
+    if url.startswith("sqlite:"):
+        return SQLiteRepository(url[len("sqlite:"):] or ":memory:")
+    raise ValueError(f"Unknown storage backend: {url}")
@@ -0,0 +1,22 @@
+from app.aggregates import Aggregate
+
+
+def test_aggregate_tracks_removals():
+    aggregate = Aggregate()
+    for value in (5, 1, 9, 1):
+        aggregate.add(value)
+    assert aggregate.summary() == {"count": 4, "min": 1, "max": 9, "mean": 4.0}
+    aggregate.remove(1)
+    assert aggregate.min() == 1
+    aggregate.remove(1)
+    aggregate.replace(9, 3)
+    assert aggregate.summary() == {"count": 2, "min": 3, "max": 5, "mean": 4.0}
+
+
+def test_aggregate_heaps_stay_bounded():
+    aggregate = Aggregate()
+    aggregate.add(0)
+    for value in range(1, 1000):
+        aggregate.replace(value - 1, value)
+    assert aggregate.min() == aggregate.max() == 999
+    assert len(aggregate.low) < 40
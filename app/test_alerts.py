@@ -0,0 +1,32 @@
+import random
+import time
+
+from app.alerts import RuleIndex
+from app.models import Rule
+
+
+def test_bounds_follow_operators():
+    index = RuleIndex()
+    index.add(Rule(rule_id=1, op=">", threshold=30))
+    index.add(Rule(rule_id=2, op=">=", threshold=30.5))
+    index.add(Rule(rule_id=3, op="<=", threshold=10))
+    index.add(Rule(rule_id=4, op="<", threshold=10, scope="room", scope_id=5, device_type="humidity"))
+    assert index.matching([], "temperature", 30) == set()
+    assert index.matching([], "temperature", 31) == {1, 2}
+    assert index.matching([], "humidity", 10) == {3}
+    assert index.matching([("room", 5)], "humidity", 9) == {3, 4}
+    assert index.matching([("room", 6)], "humidity", 9) == {3}
+
+
+def test_evaluation_is_fast_with_many_rules():
+    rng = random.Random(7)
+    index = RuleIndex()
+    for rule_id in range(20_000):
+        index.add(Rule(rule_id=rule_id, scope="house", scope_id=rng.randrange(1000), device_type="temperature",
+                       op=rng.choice([">", "<"]), threshold=rng.randrange(100)))
+    scopes = [("room", 1), ("floor", 1), ("house", 7)]
+    index.evaluate(1, "temperature", 50, scopes, 7)
+    started = time.perf_counter()
+    for value in range(1000):
+        index.evaluate(1, "temperature", value % 100, scopes, 7)
+    assert (time.perf_counter() - started) / 1000 < 0.001
@@ -0,0 +1,25 @@
+import pytest
+
+from app.buffer import Overloaded, WriteBuffer
+
+
+def test_coalesces_last_write_wins():
+    batches = []
+    buffer = WriteBuffer(batches.append, window=60)
+    buffer.offer([(1, 10), (2, 20)])
+    buffer.offer([(1, 11), (1, 12)])
+    buffer.flush()
+    assert batches == [[{"device_id": 1, "device_info": 12}, {"device_id": 2, "device_info": 20}]]
+    assert buffer.stats() == {"pending": 0, "accepted": 4, "coalesced": 2, "rejected": 0}
+    buffer.flush()
+    assert len(batches) == 1
+
+
+def test_refuses_new_devices_when_full():
+    buffer = WriteBuffer(lambda readings: None, window=60, max_pending=2)
+    buffer.offer([(1, 10), (2, 20)])
+    buffer.offer([(2, 21)])  # already pending, so it still fits
+    with pytest.raises(Overloaded):
+        buffer.offer([(2, 22), (3, 30)])
+    assert buffer.pending == {1: 10, 2: 21}
+    assert buffer.stats()["rejected"] == 2
@@ -0,0 +1,28 @@
+from app.changes import ChangeLog
+
+
+def test_since_returns_later_changes():
+    log = ChangeLog()
+    for version in range(1, 4):
+        log.append(version, {"op": "update", "kind": "room", "id": version})
+    assert [c["id"] for c in log.since(1)] == [2, 3]
+    assert log.since(3) == []
+    log.pop()
+    assert [c["version"] for c in log.since(0)] == [1, 2]
+
+
+def test_compacts_past_limit():
+    log = ChangeLog(version=10, limit=2)
+    for version in range(11, 15):
+        log.append(version, {"op": "delete", "kind": "floor", "id": version})
+    assert log.since(11) is None
+    assert [c["version"] for c in log.since(12)] == [13, 14]
+
+
+def test_zero_limit_keeps_nothing():
+    log = ChangeLog(limit=0)
+    log.append(1, {"op": "create", "kind": "floor", "id": 1})
+    assert log.since(0) is None
+    assert log.since(1) == []
+    log.pop()
+    assert log.since(0) is None
@@ -0,0 +1,20 @@
+from app.history import DeviceHistory
+
+
+def test_ring_buffer_overwrites_oldest():
+    history = DeviceHistory(capacity=3)
+    for i, value in enumerate([1, 2, 3, 4, 5]):
+        history.append(value, ts=float(i))
+    assert len(history) == 3
+    assert [s["value"] for s in history.samples()] == [3, 4, 5]
+    assert [s["value"] for s in history.samples(start=3.0)] == [4, 5]
+
+
+def test_downsample_buckets():
+    history = DeviceHistory(capacity=10)
+    for i in range(10):
+        history.append(i, ts=float(i))
+    buckets = history.downsample(2)
+    assert [b["count"] for b in buckets] == [5, 5]
+    assert buckets[0]["min"] == 0 and buckets[0]["max"] == 4
+    assert buckets[1]["mean"] == 7.0
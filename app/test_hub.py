@@ -0,0 +1,25 @@
+import asyncio
+
+from app.hub import Hub
+
+
+def test_slow_subscriber_is_bounded_and_coalesced():
+    async def scenario():
+        hub = Hub()
+        subscription = hub.subscribe(("house", 1), asyncio.get_running_loop(), max_pending=2)
+        other = hub.subscribe(("room", 5), asyncio.get_running_loop())
+        for value in range(10):
+            hub.publish([("house", 1)], 1, {"device_id": 1, "device_info": value})
+        hub.publish([("house", 1)], 2, {"device_id": 2, "device_info": 0})
+        hub.publish([("house", 1)], 3, {"device_id": 3, "device_info": 0})
+        await asyncio.wait_for(subscription.ready.wait(), 1)
+        batch = subscription.drain()
+        assert [e["device_id"] for e in batch["events"]] == [1, 2]
+        assert batch["events"][0]["device_info"] == 9
+        assert batch["dropped"] == 1
+        assert not other.pending and not subscription.ready.is_set()
+        hub.unsubscribe(subscription)
+        hub.unsubscribe(other)
+        assert not hub
+
+    asyncio.run(scenario())
@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.ids import SPAN, IdAllocator
+
+
+def test_reserves_contiguous_blocks_above_stored_ids():
+    ids = IdAllocator({"device": 41})
+    assert ids.reserve("device", 10) == 42
+    assert ids.reserve("device") == 52
+    assert ids.reserve("room") == 1
+
+
+def test_observe_skips_client_chosen_ids():
+    ids = IdAllocator({}, base=SPAN)
+    ids.observe("house", SPAN + 99)
+    ids.observe("house", 5)  # another allocator's range
+    assert ids.reserve("house") == SPAN + 100
+    with pytest.raises(OverflowError):
+        ids.reserve("house", SPAN)
+
+
+def test_concurrent_reservations_do_not_overlap():
+    ids = IdAllocator({})
+    with ThreadPoolExecutor(8) as pool:
+        firsts = list(pool.map(lambda _: ids.reserve("device", 3), range(1000)))
+    assert sorted(firsts) == list(range(1, 3001, 3))
@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException
+import json
 from fastapi.testclient import TestClient
 from app.main import app
 import pytest
@@ -50,7 +51,7 @@ def test_update_house():
 def test_delete_house():
     client.post("/house", json={"house_id": 2, "name": "Test House", "owner": {"user_id": 1, "name": "John Doe"}, "devices": [], "floors": []})
     response = client.delete("/house/2") 
-    assert response.status_code == 200
+    assert response.status_code == 202
     assert response.json()["message"] == "House deleted successfully"
     response = client.get("/house/2")
     assert response.status_code == 404
@@ -147,7 +148,758 @@ def test_delete_house_with_floors():
     client.post("/house", json={"house_id": 3, "name": "Test House", "owner": {"user_id": 1, "name": "John Doe"}, "devices": [], "floors": []})
     client.post("/house/3/floor", json={"floor_id": 110, "name": "First Floor", "rooms": [], "hallways": [], "devices": []})
     response = client.delete("/house/3")
-    assert response.status_code == 200
+    assert response.status_code == 202
     assert response.json()["message"] == "House deleted successfully"
     response = client.get("/house/3")
     assert response.status_code == 404
+
+def test_ingest_telemetry():
+    client.post("/house", json={"house_id": 20, "name": "Sensor House", "owner": {"user_id": 1, "name": "John Doe"}, "floors": []})
+    client.post("/house/20/floor", json={"floor_id": 20, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/20/floor/20/room", json={"room_id": 20, "name": "Lab", "devices": []})
+    client.post("/house/20/floor/20/room/20/device", json={"device_id": 2001, "device_type": "temperature", "device_info": 18})
+    client.post("/house/20/floor/20/hallway", json={"hallway_id": 20, "name": "Corridor", "devices": []})
+    client.post("/house/20/floor/20/hallway/20/device", json={"device_id": 2002, "device_type": "humidity", "device_info": 40})
+
+    response = client.post("/telemetry", json=[
+        {"device_id": 2001, "device_info": 21},
+        {"device_id": 2002, "device_info": 55},
+        {"device_id": 9999, "device_info": 1},
+    ])
+    assert response.status_code == 200
+    assert response.json()["applied"] == 2
+    assert [r["status"] for r in response.json()["results"]] == [200, 200, 404]
+    assert client.get("/house/20/floor/20/room/20/device/2001").json()["device_info"] == 21
+
+    body = '{"device_id": 2002, "device_info": 60}\n{"device_id": 2002}\n'
+    response = client.post("/telemetry", content=body, headers={"content-type": "application/x-ndjson"})
+    assert [r["status"] for r in response.json()["results"]] == [200, 422]
+    assert client.get("/house/20/floor/20/hallway/20/device/2002").json()["device_info"] == 60
+
+def test_device_history():
+    client.post("/telemetry", json=[{"device_id": 2001, "device_info": 30}])
+    response = client.get("/devices/2001/history")
+    assert response.status_code == 200
+    assert [s["value"] for s in response.json()["samples"]][-2:] == [21, 30]
+
+    response = client.get("/devices/2001/history", params={"buckets": 1})
+    bucket = response.json()["buckets"][0]
+    assert bucket["min"] == 18 and bucket["max"] == 30
+
+    assert client.get("/devices/9999/history").status_code == 404
+
+def test_parent_indexes():
+    client.post("/house", json={"house_id": 30, "name": "Index House", "owner": {"user_id": 1, "name": "John Doe"}, "floors": []})
+    client.post("/house/30/floor", json={"floor_id": 30, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/30/floor", json={"floor_id": 31, "name": "Upper", "rooms": [], "hallways": []})
+    for room_id in (30, 31, 32):
+        client.post("/house/30/floor/30/room", json={"room_id": room_id, "name": f"Room {room_id}", "devices": []})
+
+    response = client.delete("/house/30/floor/30/room/30")
+    assert response.status_code == 202
+    assert client.patch("/house/30/floors/30/room/32", json={"name": "Study"}).json()["name"] == "Study"
+    assert client.get("/house/30/floor/30/room/31").status_code == 200
+    floor = client.get("/house/30/floors/30").json()
+    assert sorted(r["room_id"] for r in floor["rooms"]) == [31, 32]
+
+    response = client.get("/house/30/floor/31/room/31")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "This room doesnt exist in the specified floor"
+    response = client.get("/house/20/floors/30")
+    assert response.json()["detail"] == "This floor doesnt exist in the house"
+
+def test_normalized_store():
+    client.post("/users", json={"user_id": 40, "name": "Carol"})
+    client.post("/house", json={"house_id": 40, "name": "Flat", "owner": {"user_id": 40, "name": "Carol"}, "floors": []})
+    client.post("/house/40/floor", json={"floor_id": 40, "name": "Only", "rooms": [], "hallways": []})
+    client.post("/house/40/floor/40/room", json={"room_id": 40, "name": "Kitchen", "devices": []})
+    client.post("/house/40/floor/40/room/40/device", json={"device_id": 4001, "device_type": "humidity", "device_info": 35})
+
+    client.patch("/users/40", json={"name": "Caroline"})
+    client.patch("/house/40/floor/40/room/40/device/4001", json={"device_info": 50})
+    house = client.get("/house/40").json()
+    assert house["owner"]["name"] == "Caroline"
+    assert house["floors"][0]["rooms"][0]["devices"][0]["device_info"] == 50
+
+    client.delete("/house/40")
+    assert client.get("/devices/4001/history").status_code == 404
+
+def test_get_house_etag():
+    client.post("/house", json={"house_id": 50, "name": "Polled", "owner": {"user_id": 1, "name": "John Doe"}, "floors": []})
+    response = client.get("/house/50")
+    etag = response.headers["etag"]
+    assert response.json()["name"] == "Polled"
+
+    response = client.get("/house/50", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    client.post("/house/50/floor", json={"floor_id": 50, "name": "Ground", "rooms": [], "hallways": []})
+    response = client.get("/house/50", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["floors"][0]["floor_id"] == 50
+
+    # A house recreated under the same id is back at the same version, not the same ETag
+    from app import main
+    main.reaper.wait(client.delete("/house/50").json()["job_id"], timeout=5)
+    client.post("/house", json={"house_id": 50, "name": "Rebuilt", "owner": {"user_id": 1, "name": "John Doe"}, "floors": []})
+    response = client.get("/house/50", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.json()["name"] == "Rebuilt"
+
+def test_journal_replay(tmp_path):
+    from app import main
+    from app.persistence import Journal
+
+    main.enable_persistence(str(tmp_path))
+    try:
+        client.post("/users", json={"user_id": 60, "name": "Dana"})
+        client.post("/house", json={"house_id": 60, "name": "Logged", "owner": {"user_id": 60, "name": "Dana"}, "floors": []})
+        client.post("/house/60/floor", json={"floor_id": 60, "name": "Ground", "rooms": [], "hallways": []})
+        client.post("/house/60/floor/60/room", json={"room_id": 60, "name": "Den", "devices": []})
+        client.post("/house/60/floor/60/room/60/device", json={"device_id": 6001, "device_type": "temperature", "device_info": 19})
+        client.post("/telemetry", json=[{"device_id": 6001, "device_info": 23}])
+    finally:
+        main.journal.close()
+        main.journal = None
+
+    main.reaper.wait(client.delete("/house/60").json()["job_id"], timeout=5)
+    client.delete("/users/60")
+    main.replay(Journal(str(tmp_path)).load()[1])
+    assert client.get("/users/60").json()["name"] == "Dana"
+    assert client.get("/house/60/floor/60/room/60/device/6001").json()["device_info"] == 23
+
+def test_sqlite_backend(monkeypatch):
+    import base64
+    from app import main
+    from app.storage import SQLiteRepository
+
+    monkeypatch.setattr(main, "repo", SQLiteRepository())
+    client.post("/users", json={"user_id": 70, "name": "Erin"})
+    client.post("/house", json={"house_id": 70, "name": "Stored", "owner": {"user_id": 70, "name": "Erin"}, "floors": []})
+    client.post("/house/70/floor", json={"floor_id": 70, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/70/floor/70/hallway", json={"hallway_id": 70, "name": "Hall", "devices": []})
+    client.post("/house/70/floor/70/hallway/70/device", json={"device_id": 7001, "device_type": "temperature", "device_info": 20})
+    client.post("/telemetry", json=[{"device_id": 7001, "device_info": 26}])
+
+    house = client.get("/house/70").json()
+    assert house["owner"]["name"] == "Erin"
+    assert house["floors"][0]["hallways"][0]["devices"][0]["device_info"] == 26
+
+    # SQLite keeps ids as 64-bit integers, so larger ones are rejected up front
+    huge = 2**70
+    assert client.post("/users", json={"user_id": huge, "name": "Huge"}).status_code == 422
+    assert client.get(f"/users/{huge}").status_code == 422
+    assert client.get("/rooms", params={"house_id": huge}).status_code == 422
+    assert client.get("/devices", params={"min_info": huge}).status_code == 422
+    assert client.post("/telemetry", json=[{"device_id": huge, "device_info": 1}]).json()["results"][0]["status"] == 422
+    batch = {"house_id": 70, "operations": [{"op": "create_floor", "args": {"floor": {"floor_id": huge, "name": "F"}}}]}
+    assert client.post("/batch", json=batch).status_code == 422
+    cursor = base64.urlsafe_b64encode(str(huge).encode()).decode()
+    assert client.get("/users", params={"cursor": cursor}).status_code == 400
+
+    response = client.delete("/house/70")
+    assert response.status_code == 202
+    assert main.reaper.wait(response.json()["job_id"], timeout=5)
+    assert main.repo.count("device") == 0
+
+def test_concurrent_writes_per_house():
+    from concurrent.futures import ThreadPoolExecutor
+    from app import main
+
+    for house_id in (80, 81):
+        client.post("/house", json={"house_id": house_id, "name": "Busy", "owner": {"user_id": 1, "name": "John Doe"}, "floors": []})
+        client.post(f"/house/{house_id}/floor", json={"floor_id": house_id, "name": "Ground", "rooms": [], "hallways": []})
+
+    def create(args):
+        house_id, room_id = args
+        try:
+            main.create_room(house_id, house_id, main.Room(room_id=room_id, name="Racing"))
+            return True
+        except main.HTTPException:
+            return False
+
+    # Every room id is attempted twice, from both houses at once
+    attempts = [(house_id, 8000 + i) for i in range(200) for house_id in (80, 81)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        created = sum(pool.map(create, attempts))
+
+    assert created == 200
+    rooms = sum(len(client.get(f"/house/{h}/floors/{h}").json()["rooms"]) for h in (80, 81))
+    assert rooms == 200
+
+def test_bulk_import_house():
+    house = {
+        "house_id": 90, "name": "Imported", "owner": {"user_id": 1, "name": "John Doe"},
+        "floors": [{
+            "floor_id": 90, "name": "Ground",
+            "rooms": [{"room_id": 90, "name": "Hall", "devices": [{"device_id": 9001, "device_type": "temperature", "device_info": 21}]}],
+            "hallways": [{"hallway_id": 90, "name": "Corridor", "devices": [{"device_id": 9002, "device_type": "humidity", "device_info": 44}]}],
+        }],
+    }
+    response = client.post("/house/bulk", json=house)
+    assert response.status_code == 200
+    assert response.json() == {"house_id": 90, "floors": 1, "rooms": 1, "hallways": 1, "devices": 2}
+    assert client.get("/house/90").json()["floors"] == house["floors"]
+    assert client.get("/house/90/floor/90/hallway/90/device/9002").json()["device_info"] == 44
+
+    clash = {**house, "house_id": 91, "floors": [{**house["floors"][0], "floor_id": 91}]}
+    response = client.post("/house/bulk", json=clash)
+    assert response.status_code == 400
+    conflicts = response.json()["detail"]["conflicts"]
+    assert {(c["kind"], c["id"]) for c in conflicts} == {("room", 90), ("hallway", 90), ("device", 9001), ("device", 9002)}
+    assert client.get("/house/91").status_code == 404
+
+    lines = [json.dumps({**house, "house_id": 92, "floors": []}), json.dumps(clash)]
+    response = client.post("/house/bulk", content="\n".join(lines), headers={"content-type": "application/x-ndjson"})
+    assert response.json()["imported"] == 1
+    assert [r["status"] for r in response.json()["results"]] == [200, 400]
+
+def test_list_devices_paginated():
+    client.post("/users", json={"user_id": 100, "name": "Lister"})
+    client.post("/house", json={"house_id": 100, "name": "Listed", "owner": {"user_id": 100, "name": "Lister"}, "floors": []})
+    client.post("/house/100/floor", json={"floor_id": 100, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/100/floor/100/room", json={"room_id": 100, "name": "Den", "devices": []})
+    for device_id in range(10005, 10000, -1):
+        client.post("/house/100/floor/100/room/100/device",
+                    json={"device_id": device_id, "device_type": "humidity", "device_info": device_id - 10000})
+
+    seen, cursor = [], None
+    while True:
+        params = {"house_id": 100, "limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/devices", params=params).json()
+        seen += [item["device_id"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [10001, 10002, 10003, 10004, 10005]
+    assert page["items"][-1]["room_id"] == 100
+
+    page = client.get("/devices", params={"min_info": 2, "max_info": 3}).json()
+    assert [item["device_id"] for item in page["items"]] == [10002, 10003]
+    assert client.get("/houses", params={"user_id": 100}).json()["items"] == [{"house_id": 100, "name": "Listed", "user_id": 100}]
+
+    # A cursor from a listing keyed the other way is rejected, not compared
+    import base64
+    pair, single = (base64.urlsafe_b64encode(json.dumps(key).encode()).decode() for key in ([2, 10002], 10002))
+    for path, params in (("/users", {}), ("/houses", {}), ("/devices", {"device_type": "humidity"})):
+        assert client.get(path, params={**params, "cursor": pair}).status_code == 400
+    assert client.get("/devices", params={"min_info": 0, "cursor": single}).status_code == 400
+    assert client.get("/devices", params={"min_info": 0, "cursor": pair}).status_code == 200
+    assert client.get("/devices", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_aggregates_follow_device_writes():
+    client.post("/users", json={"user_id": 110, "name": "Aggregator"})
+    client.post("/house", json={"house_id": 110, "name": "Summed", "owner": {"user_id": 110, "name": "Aggregator"}, "floors": []})
+    client.post("/house/110/floor", json={"floor_id": 110, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/110/floor/110/room", json={"room_id": 110, "name": "Den", "devices": []})
+    client.post("/house/110/floor/110/hallway", json={"hallway_id": 110, "name": "Corridor", "devices": []})
+    client.post("/house/110/floor/110/room/110/device", json={"device_id": 11001, "device_type": "temperature", "device_info": 20})
+    client.post("/house/110/floor/110/room/110/device", json={"device_id": 11002, "device_type": "temperature", "device_info": 24})
+    client.post("/house/110/floor/110/hallway/110/device", json={"device_id": 11003, "device_type": "temperature", "device_info": 16})
+
+    assert client.get("/house/110/aggregates").json() == {"temperature": {"count": 3, "min": 16, "max": 24, "mean": 20.0}}
+    assert client.get("/house/110/floor/110/room/110/aggregates").json()["temperature"]["mean"] == 22.0
+
+    client.patch("/house/110/floor/110/room/110/device/11002", json={"device_info": 30})
+    client.delete("/house/110/floor/110/hallway/110/device/11003")
+    assert client.get("/house/110/floors/110/aggregates").json() == {"temperature": {"count": 2, "min": 20, "max": 30, "mean": 25.0}}
+    assert client.get("/house/110/floor/110/hallway/110/aggregates").json() == {}
+
+    client.delete("/house/110/floor/110/room/110")
+    assert client.get("/house/110/aggregates").json() == {}
+
+def test_subscribe_coalesces_device_updates():
+    client.post("/users", json={"user_id": 120, "name": "Watcher"})
+    client.post("/house", json={"house_id": 120, "name": "Watched", "owner": {"user_id": 120, "name": "Watcher"}, "floors": []})
+    client.post("/house/120/floor", json={"floor_id": 120, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/120/floor/120/room", json={"room_id": 120, "name": "Den", "devices": []})
+    client.post("/house/120/floor/120/room/120/device", json={"device_id": 12001, "device_type": "humidity", "device_info": 1})
+
+    with client.websocket_connect("/house/120/subscribe?floor_id=120") as websocket:
+        for value in (2, 3, 4):
+            client.patch("/house/120/floor/120/room/120/device/12001", json={"device_info": value})
+        message = websocket.receive_json()
+        assert message["dropped"] == 0
+        assert [(e["device_id"], e["device_info"], e["room_id"]) for e in message["events"]] == [(12001, 4, 120)]
+
+    with pytest.raises(Exception):
+        with client.websocket_connect("/house/120/subscribe?device_id=99999") as websocket:
+            websocket.receive_json()
+
+def test_msgpack_negotiation():
+    msgpack = pytest.importorskip("msgpack")
+    client.post("/users", json={"user_id": 130, "name": "Packer"})
+    client.post("/house", json={"house_id": 130, "name": "Packed", "owner": {"user_id": 130, "name": "Packer"}, "floors": []})
+    response = client.get("/house/130", headers={"accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content)["name"] == "Packed"
+    assert response.headers["etag"] != client.get("/house/130").headers["etag"]
+    body = msgpack.packb([{"device_id": 99999, "device_info": 1}])
+    response = client.post("/telemetry", content=body, headers={"content-type": "application/msgpack"})
+    assert response.json()["results"][0]["status"] == 404
+
+def test_msgpack_fallback(monkeypatch):
+    from app import main
+
+    # Without the optional dependency clients fall back to JSON
+    monkeypatch.setattr(main, "msgpack", None)
+    client.post("/users", json={"user_id": 131, "name": "Packer"})
+    client.post("/house", json={"house_id": 131, "name": "Unpacked", "owner": {"user_id": 131, "name": "Packer"}, "floors": []})
+    response = client.get("/house/131", headers={"accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()["name"] == "Unpacked"
+    response = client.post("/telemetry", content=b"\x90", headers={"content-type": "application/msgpack"})
+    assert response.status_code == 415
+
+def test_metrics_endpoint():
+    client.get("/users/99999")
+    client.get("/no/such/path")
+    text = client.get("/metrics").text
+    assert 'house_http_errors_total{method="GET",route="/users/{user_id}",status="404"}' in text
+    assert 'house_http_request_duration_seconds_bucket{method="GET",route="/users/{user_id}",le="+Inf"}' in text
+    assert 'route="unmatched"' in text
+    assert 'house_store_records{kind="device"}' in text
+
+def test_background_delete_job():
+    from app import main
+
+    client.post("/users", json={"user_id": 140, "name": "Mover"})
+    client.post("/house", json={"house_id": 140, "name": "Big", "owner": {"user_id": 140, "name": "Mover"}, "floors": []})
+    client.post("/house/140/floor", json={"floor_id": 140, "name": "Ground", "rooms": [], "hallways": []})
+    for room_id in (140, 141):
+        client.post("/house/140/floor/140/room", json={"room_id": room_id, "name": "Room", "devices": []})
+        for n in range(3):
+            client.post(f"/house/140/floor/140/room/{room_id}/device",
+                        json={"device_id": room_id * 100 + n, "device_type": "humidity", "device_info": n})
+
+    response = client.delete("/house/140/floor/140/room/141")
+    assert response.status_code == 202
+    assert client.get("/house/140/floor/140/room/141").status_code == 404
+    assert client.get("/house/140/aggregates").json()["humidity"]["count"] == 3
+
+    job_id = client.delete("/house/140").json()["job_id"]
+    assert client.get("/house/140").status_code == 404
+    assert client.post("/telemetry", json=[{"device_id": 14000, "device_info": 9}]).json()["applied"] == 0
+    assert main.reaper.wait(job_id, timeout=5)
+    assert client.get(f"/jobs/{job_id}").json() == {
+        "job_id": job_id, "kind": "house", "id": 140, "status": "done",
+        "freed": {"device": 3, "room": 1, "floor": 1, "house": 1}, "pending": 0}
+    assert not main.repo.contains("device", 14000) and 14000 not in main.histories
+    assert client.get("/jobs/999999").status_code == 404
+
+def test_threshold_alerts():
+    client.post("/users", json={"user_id": 150, "name": "Alerted"})
+    client.post("/house", json={"house_id": 150, "name": "Hot", "owner": {"user_id": 150, "name": "Alerted"}, "floors": []})
+    client.post("/house/150/floor", json={"floor_id": 150, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/150/floor/150/room", json={"room_id": 150, "name": "Den", "devices": []})
+    client.post("/house/150/floor/150/room/150/device", json={"device_id": 15001, "device_type": "temperature", "device_info": 25})
+    client.post("/house/150/floor/150/room/150/device", json={"device_id": 15002, "device_type": "humidity", "device_info": 50})
+
+    assert client.post("/rules", json={"rule_id": 1500, "scope": "house", "scope_id": 150, "device_type": "temperature",
+                                       "op": ">", "threshold": 30}).status_code == 200
+    client.post("/rules", json={"rule_id": 1501, "scope": "floor", "scope_id": 150, "device_type": "humidity",
+                                "op": "<", "threshold": 20})
+    assert client.post("/rules", json={"rule_id": 1502, "scope": "room", "scope_id": 99999, "op": "<",
+                                       "threshold": 1}).status_code == 404
+    assert client.post("/rules", json={"rule_id": 1503, "scope": "room", "op": "<", "threshold": 1}).status_code == 422
+    infinite = '{"rule_id": 1504, "op": ">", "threshold": Infinity}'
+    assert client.post("/rules", content=infinite, headers={"content-type": "application/json"}).status_code == 422
+    assert client.get("/rules/1504").status_code == 404
+    after = max([a["alert_id"] for a in client.get("/alerts", params={"limit": 1000}).json()["alerts"]] + [0])
+
+    client.post("/telemetry", json=[{"device_id": 15001, "device_info": 30}, {"device_id": 15002, "device_info": 19}])
+    client.post("/telemetry", json=[{"device_id": 15001, "device_info": 31}])
+    client.post("/telemetry", json=[{"device_id": 15001, "device_info": 35}])
+    alerts = client.get("/alerts", params={"after": after}).json()["alerts"]
+    assert [(a["rule_id"], a["device_id"], a["value"]) for a in alerts] == [(1501, 15002, 19), (1500, 15001, 31)]
+
+    client.delete("/rules/1500")
+    client.post("/telemetry", json=[{"device_id": 15001, "device_info": 20}, {"device_id": 15001, "device_info": 40}])
+    assert len(client.get("/alerts", params={"after": after}).json()["alerts"]) == 2
+    assert client.get("/rules/1500").status_code == 404
+
+def test_batch_is_all_or_nothing():
+    from app import main
+
+    client.post("/users", json={"user_id": 160, "name": "Planner"})
+    client.post("/house", json={"house_id": 160, "name": "Plan", "owner": {"user_id": 160, "name": "Planner"}, "floors": []})
+    client.post("/house/160/floor", json={"floor_id": 160, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/160/floor/160/room", json={"room_id": 160, "name": "Den", "devices": []})
+    client.post("/house/160/floor/160/hallway", json={"hallway_id": 160, "name": "Hall", "devices": []})
+    client.post("/house/160/floor/160/hallway/160/device", json={"device_id": 16000, "device_type": "humidity", "device_info": 40})
+    client.post("/house/160/floor/160/room/160/device", json={"device_id": 16001, "device_type": "humidity", "device_info": 50})
+    before = client.get("/house/160").json()
+    aggregates = client.get("/house/160/aggregates").json()
+    samples = client.get("/devices/16001/history").json()["samples"]
+
+    failed = client.post("/batch", json={"house_id": 160, "operations": [
+        {"op": "update_room", "args": {"floor_id": 160, "room_id": 160, "room": {"name": "Study"}}},
+        {"op": "create_device_to_room", "args": {"floor_id": 160, "room_id": 160,
+                                                 "device": {"device_id": 16002, "device_type": "humidity", "device_info": 1}}},
+        {"op": "update_device_room", "args": {"floor_id": 160, "room_id": 160, "device_id": 16001, "device": {"device_info": 9}}},
+        {"op": "delete_room_device", "args": {"floor_id": 160, "room_id": 160, "device_id": 16001}},
+        {"op": "delete_hallway", "args": {"floor_id": 160, "hallway_id": 160}},
+        {"op": "update_room", "args": {"floor_id": 160, "room_id": 999999, "room": {"name": "Nowhere"}}},
+    ]})
+    assert failed.status_code == 404
+    assert failed.json()["detail"] == "Operation 5 (update_room): Room not found"
+    assert client.get("/house/160").json() == before
+    assert client.get("/house/160/aggregates").json() == aggregates
+    assert client.get("/devices/16001/history").json()["samples"] == samples
+    assert not main.repo.contains("device", 16002) and 16002 not in main.histories
+
+    assert client.post("/batch", json={"house_id": 160, "operations": [{"op": "delete_house", "args": {}}]}).status_code == 400
+    assert client.post("/batch", json={"house_id": 160, "operations": [{"op": "update_room", "args": {}}]}).status_code == 422
+
+    done = client.post("/batch", json={"house_id": 160, "operations": [
+        {"op": "update_room", "args": {"floor_id": 160, "room_id": 160, "room": {"name": "Study"}}},
+        {"op": "create_device_to_room", "args": {"floor_id": 160, "room_id": 160,
+                                                 "device": {"device_id": 16002, "device_type": "humidity", "device_info": 1}}},
+        {"op": "delete_hallway", "args": {"floor_id": 160, "hallway_id": 160}},
+    ]})
+    assert done.status_code == 200
+    results = done.json()["results"]
+    assert results[0]["name"] == "Study" and results[1]["device_id"] == 16002
+    assert main.reaper.wait(results[2]["job_id"], timeout=5)
+    floor = client.get("/house/160").json()["floors"][0]
+    assert floor["hallways"] == [] and [d["device_id"] for d in floor["rooms"][0]["devices"]] == [16001, 16002]
+    assert client.get("/house/160/aggregates").json()["humidity"]["count"] == 2
+
+def test_house_change_feed():
+    from app import main
+
+    client.post("/users", json={"user_id": 170, "name": "Syncer"})
+    client.post("/house", json={"house_id": 170, "name": "Synced", "owner": {"user_id": 170, "name": "Syncer"}, "floors": []})
+    house = client.get("/house/170")
+    epoch, version = house.headers["X-House-Epoch"], int(house.headers["X-House-Version"])
+    assert version == 0
+
+    client.post("/house/170/floor", json={"floor_id": 170, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/170/floor/170/room", json={"room_id": 170, "name": "Den", "devices": []})
+    client.post("/house/170/floor/170/room/170/device", json={"device_id": 17000, "device_type": "humidity", "device_info": 40})
+    client.post("/telemetry", json=[{"device_id": 17000, "device_info": 41}])
+    client.patch("/house/170/floors/170/room/170", json={"name": "Study"})
+    client.delete("/house/170/floor/170/room/170/device/17000")
+
+    feed = client.get("/house/170/changes", params={"since": version, "epoch": epoch}).json()
+    assert feed["version"] == 6 and not feed["resync"]
+    assert [(c["version"], c["op"], c["kind"], c["id"]) for c in feed["changes"]] == [
+        (1, "create", "floor", 170), (2, "create", "room", 170), (3, "create", "device", 17000),
+        (4, "update", "device", 17000), (5, "update", "room", 170), (6, "delete", "device", 17000)]
+    assert feed["changes"][2]["parent"] == ["room", 170]
+    assert feed["changes"][2]["data"] == {"device_type": "humidity", "device_info": 40}
+    assert client.get("/house/170/changes", params={"since": 6}).json()["changes"] == []
+
+    # A rolled-back batch leaves no trace in the feed
+    client.post("/batch", json={"house_id": 170, "operations": [
+        {"op": "update_floor", "args": {"floor_id": 170, "floor": {"name": "First"}}},
+        {"op": "delete_room", "args": {"floor_id": 170, "room_id": 999999}}]})
+    assert client.get("/house/170/changes", params={"since": 6}).json()["version"] == 6
+
+    assert client.get("/house/170/changes", params={"since": 7}).json()["resync"]
+    assert client.get("/house/170/changes", params={"since": 0, "epoch": "other"}).json()["resync"]
+    main.house_changes[170] = main.ChangeLog(6, limit=1)
+    client.patch("/house/170", json={"name": "Renamed"})
+    client.patch("/house/170", json={"name": "Again"})
+    assert client.get("/house/170/changes", params={"since": 6}).json()["resync"]
+    assert [c["data"] for c in client.get("/house/170/changes", params={"since": 7}).json()["changes"]] == [{"name": "Again"}]
+
+    # A recreated house counts from version 0 again, under a new epoch
+    client.delete("/house/170")
+    client.post("/house", json={"house_id": 170, "name": "Reborn", "owner": {"user_id": 170, "name": "Syncer"}, "floors": []})
+    client.post("/house/170/floor", json={"floor_id": 171, "name": "Ground", "rooms": [], "hallways": []})
+    assert client.get("/house/170").headers["X-House-Epoch"] != epoch
+    assert client.get("/house/170/changes", params={"since": 1, "epoch": epoch}).json()["resync"]
+
+def test_buffered_device_writes():
+    from app import main
+    from app.buffer import WriteBuffer
+
+    client.post("/users", json={"user_id": 180, "name": "Sensor"})
+    client.post("/house", json={"house_id": 180, "name": "Busy", "owner": {"user_id": 180, "name": "Sensor"}, "floors": []})
+    client.post("/house/180/floor", json={"floor_id": 180, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/180/floor/180/room", json={"room_id": 180, "name": "Lab", "devices": []})
+    for device_id in (18000, 18001, 18002):
+        client.post("/house/180/floor/180/room/180/device", json={"device_id": device_id, "device_type": "humidity", "device_info": 0})
+
+    main.write_buffer = WriteBuffer(main.ingest_readings, window=60, max_pending=2)
+    try:
+        path = "/house/180/floor/180/room/180/device"
+        for value in (1, 2, 3):
+            response = client.patch(f"{path}/18000", json={"device_info": value})
+            assert response.status_code == 202 and response.json()["status"] == "queued"
+        assert client.patch(f"{path}/99999", json={"device_info": 1}).status_code == 404
+        queued = client.post("/telemetry", json=[{"device_id": 18001, "device_info": 7}, {"device_id": 99999, "device_info": 1}])
+        assert queued.json()["queued"] == 1 and queued.json()["results"][1]["status"] == 404
+        assert client.get(f"{path}/18000").json()["device_info"] == 0
+
+        refused = client.post("/telemetry", json=[{"device_id": 18002, "device_info": 5}])
+        assert refused.status_code == 429 and refused.headers["Retry-After"] == "60"
+        assert "house_write_buffer_coalesced_total 2" in client.get("/metrics").text
+
+        main.write_buffer.flush()
+        assert client.get(f"{path}/18000").json()["device_info"] == 3
+        assert client.get(f"{path}/18001").json()["device_info"] == 7
+        assert [s["value"] for s in client.get("/devices/18000/history").json()["samples"]] == [0, 3]
+    finally:
+        main.write_buffer = None
+    assert client.patch("/house/180/floor/180/room/180/device/18002", json={"device_info": 4}).json()["device_info"] == 4
+
+def test_sparse_house_reads():
+    client.post("/users", json={"user_id": 190, "name": "Sparse"})
+    client.post("/house", json={"house_id": 190, "name": "Tower", "owner": {"user_id": 190, "name": "Sparse"}, "floors": []})
+    client.post("/house/190/floor", json={"floor_id": 190, "name": "Ground", "rooms": [], "hallways": []})
+    client.post("/house/190/floor/190/room", json={"room_id": 190, "name": "Den", "devices": []})
+    client.post("/house/190/floor/190/hallway", json={"hallway_id": 190, "name": "Hall", "devices": []})
+    client.post("/house/190/floor/190/room/190/device", json={"device_id": 19000, "device_type": "humidity", "device_info": 40})
+
+    assert client.get("/house/190", params={"depth": 0}).json() == {
+        "house_id": 190, "name": "Tower", "owner": {"user_id": 190, "name": "Sparse"}}
+    assert client.get("/house/190", params={"depth": 2, "fields": "name"}).json() == {
+        "house_id": 190, "name": "Tower", "floors": [{"floor_id": 190, "name": "Ground",
+                                                     "rooms": [{"room_id": 190, "name": "Den"}],
+                                                     "hallways": [{"hallway_id": 190, "name": "Hall"}]}]}
+    assert client.get("/house/190", params={"include": "floors,rooms,devices", "fields": "device_info"}).json() == {
+        "house_id": 190, "floors": [{"floor_id": 190, "rooms": [{"room_id": 190, "devices": [
+            {"device_id": 19000, "device_info": 40}]}]}]}
+    assert client.get("/house/190/floors/190", params={"include": "hallways"}).json() == {
+        "floor_id": 190, "name": "Ground", "hallways": [{"hallway_id": 190, "name": "Hall"}]}
+    assert client.get("/house/190", params={"fields": "color"}).status_code == 400
+    assert client.get("/house/190", params={"include": "attics"}).status_code == 400
+
+    sparse = client.get("/house/190", params={"depth": 1})
+    full = client.get("/house/190")
+    assert sparse.headers["ETag"] != full.headers["ETag"]
+    assert client.get("/house/190", params={"depth": 1}, headers={"If-None-Match": sparse.headers["ETag"]}).status_code == 304
+    assert full.json()["floors"][0]["rooms"][0]["devices"][0]["device_id"] == 19000
+
+def test_user_houses_and_owner_delete():
+    from app import main
+
+    client.post("/users", json={"user_id": 200, "name": "Landlord"})
+    for house_id in (200, 201):
+        client.post("/house", json={"house_id": house_id, "name": "Rental", "owner": {"user_id": 200, "name": "Landlord"}, "floors": []})
+    client.post("/house/201/floor", json={"floor_id": 201, "name": "Ground", "rooms": [], "hallways": []})
+    client.patch("/users/200", json={"name": "New Landlord"})
+    assert client.get("/users/200/houses").json() == {"user_id": 200, "houses": [
+        {"house_id": 200, "name": "Rental"}, {"house_id": 201, "name": "Rental"}]}
+    assert client.get("/house/201").json()["owner"]["name"] == "New Landlord"
+    assert client.get("/users/99999/houses").status_code == 404
+
+    blocked = client.delete("/users/200")
+    assert blocked.status_code == 400 and blocked.json()["detail"] == "User still owns houses"
+    deleted = client.delete("/users/200", params={"cascade": True}).json()
+    assert len(deleted["job_ids"]) == 2
+    for job_id in deleted["job_ids"]:
+        assert main.reaper.wait(job_id, timeout=5)
+    assert client.get("/house/201").status_code == 404 and not main.repo.contains("floor", 201)
+    assert client.get("/users/200").status_code == 404
+
+def test_server_allocated_ids(tmp_path):
+    from app import main
+    from app.ids import KINDS, SPAN, IdAllocator
+    from app.persistence import Journal
+
+    main.enable_persistence(str(tmp_path))
+    try:
+        user = client.post("/users", json={"name": "Numbered"}).json()
+        house = client.post("/house", json={"name": "Numbered", "owner": user}).json()
+        floor = client.post(f"/house/{house['house_id']}/floor", json={"name": "Ground"}).json()
+        room = client.post(f"/house/{house['house_id']}/floor/{floor['floor_id']}/room", json={"name": "Den"}).json()
+        device = client.post(f"/house/{house['house_id']}/floor/{floor['floor_id']}/room/{room['room_id']}/device",
+                             json={"device_type": "humidity", "device_info": 1}).json()
+        assert client.get(f"/house/{house['house_id']}").json()["floors"][0]["rooms"][0]["devices"] == [device]
+        earlier = client.post("/ids/reserve", params={"kind": "device", "count": 5}).json()
+        block = client.post("/ids/reserve", params={"kind": "device", "count": 100}).json()
+        assert block["first"] > earlier["last"] > device["device_id"] and block["last"] == block["first"] + 99
+        assert client.post("/ids/reserve", params={"kind": "garage"}).status_code == 400
+        assert client.post("/ids/reserve", params={"kind": "device", "count": 0}).status_code == 422
+    finally:
+        main.journal.close()
+        main.journal = None
+
+    # A restart starts above the stored ids and replays the blocks granted, so
+    # none is handed out again, whatever order they were logged in
+    allocator = main.ids
+    main.ids = IdAllocator({kind: main.repo.max_id(kind, 0, SPAN) for kind in KINDS})
+    try:
+        main.replay([record for record in Journal(str(tmp_path)).load()[1] if record[0] == "advance_ids"][::-1])
+        assert main.ids.reserve("device") == block["last"] + 1
+    finally:
+        main.ids = allocator
+
+def run_restarted(env: dict, script: str):
+    # A fresh interpreter, as after a restart; the script's stdout is returned as JSON
+    import os
+    import subprocess
+    import sys
+    code = "import json\nfrom fastapi.testclient import TestClient\nfrom app import main\nclient = TestClient(main.app)\n" + script
+    result = subprocess.run([sys.executable, "-c", code], env={**os.environ, **env}, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout)
+
+def test_restart_from_snapshot(tmp_path):
+    env = {"HOUSE_DATA_DIR": str(tmp_path)}
+    before = run_restarted(env, """
+client.post("/users", json={"user_id": 1, "name": "Restarted"})
+client.post("/house/bulk", json={"house_id": 1, "name": "Home", "owner": {"user_id": 1, "name": "Restarted"}, "floors": [
+    {"floor_id": 1, "name": "Ground", "rooms": [{"room_id": 1, "name": "Den", "devices": [
+        {"device_id": 1, "device_type": "humidity", "device_info": 40},
+        {"device_id": 2, "device_type": "temperature", "device_info": 20}]}],
+     "hallways": [{"hallway_id": 1, "name": "Hall", "devices": [{"device_id": 3, "device_type": "humidity", "device_info": 50}]}]},
+    {"floor_id": 2, "name": "Attic", "rooms": [], "hallways": []}]})
+client.post("/telemetry", json=[{"device_id": 1, "device_info": 45}])
+client.post("/rules", json={"rule_id": 1, "op": ">", "threshold": 60})
+main.reaper.wait(client.delete("/house/1/floor/2").json()["job_id"], timeout=5)
+block = client.post("/ids/reserve", params={"kind": "device", "count": 10}).json()
+main.journal.compact(main.dump_state())
+print(json.dumps({"house": client.get("/house/1").json(), "aggregates": client.get("/house/1/aggregates").json(),
+                  "block": block}))
+""")
+    after = run_restarted(env, """
+print(json.dumps({"house": client.get("/house/1").json(), "aggregates": client.get("/house/1/aggregates").json(),
+                  "history": client.get("/devices/1/history").json()["samples"],
+                  "rule": client.get("/rules/1").status_code, "next": main.ids.reserve("device"),
+                  "by_value": [d["device_id"] for d in client.get("/devices", params={"min_info": 41}).json()["items"]],
+                  "reading": client.post("/telemetry", json=[{"device_id": 3, "device_info": 70}]).json()["applied"],
+                  "alerts": [a["device_id"] for a in client.get("/alerts").json()["alerts"]]}))
+""")
+    assert after["house"] == before["house"] and after["aggregates"] == before["aggregates"]
+    assert [sample["value"] for sample in after["history"]] == [45]
+    assert after["rule"] == 200 and after["next"] == before["block"]["last"] + 1
+    assert after["by_value"] == [1, 3] and after["reading"] == 1 and after["alerts"] == [3]
+
+def test_compaction_waits_for_writes(tmp_path):
+    import threading
+    from app import main
+    from app.persistence import Journal
+
+    main.enable_persistence(str(tmp_path))
+    try:
+        client.post("/users", json={"user_id": 210, "name": "Compacted"})
+        entered, release = threading.Event(), threading.Event()
+
+        def write():
+            with main.write_lock(main.house_locks(210)):
+                entered.set()
+                release.wait()
+        writer = threading.Thread(target=write)
+        writer.start()
+        entered.wait()
+        compactor = threading.Thread(target=main.compact_journal)
+        compactor.start()
+        compactor.join(0.2)
+        assert compactor.is_alive()  # held off until the write is done
+        release.set()
+        compactor.join(5)
+        writer.join()
+        state, records = Journal(str(tmp_path)).load()
+        assert records == [] and 210 in state["repository"]["records"]["user"]
+    finally:
+        main.journal.close()
+        main.journal = None
+
+def test_sqlite_file_reopens(tmp_path):
+    env = {"HOUSE_STORAGE": f"sqlite:{tmp_path / 'houses.db'}"}
+    before = run_restarted(env, """
+client.post("/users", json={"user_id": 1, "name": "Reopened"})
+client.post("/house", json={"house_id": 1, "name": "Home", "owner": {"user_id": 1, "name": "Reopened"}})
+for floor_id in (1, 2):
+    client.post("/house/1/floor", json={"floor_id": floor_id, "name": "Ground"})
+client.post("/house/1/floor/1/room", json={"room_id": 1, "name": "Den"})
+for device_id, value in ((1, 40), (2, 60)):
+    client.post("/house/1/floor/1/room/1/device", json={"device_id": device_id, "device_type": "humidity", "device_info": value})
+main.repo.detach("floor", 2)  # as if the process stopped before the reaper freed it
+print(json.dumps({"house": client.get("/house/1").json(), "aggregates": client.get("/house/1/aggregates").json()}))
+""")
+    after = run_restarted(env, """
+import time
+house = client.get("/house/1").json()
+aggregates = client.get("/house/1/aggregates").json()
+floor = client.post("/house/1/floor", json={"floor_id": 3, "name": "Upstairs"}).status_code
+patched = client.patch("/house/1/floor/1/room/1/device/1", json={"device_info": 45}).status_code
+applied = client.post("/telemetry", json=[{"device_id": 2, "device_info": 65}]).json()["applied"]
+for _ in range(50):
+    if not main.repo.contains("floor", 2):
+        break
+    time.sleep(0.1)
+print(json.dumps({"house": house, "aggregates": aggregates, "floor": floor, "patched": patched, "applied": applied,
+                  "history": [s["value"] for s in client.get("/devices/1/history").json()["samples"]],
+                  "after": client.get("/house/1/aggregates").json(), "reaped": not main.repo.contains("floor", 2)}))
+""")
+    assert after["house"] == before["house"] and after["aggregates"] == before["aggregates"]
+    assert after["floor"] == after["patched"] == 200 and after["applied"] == 1
+    assert after["history"] == [40, 45] and after["after"]["humidity"]["max"] == 65
+    assert after["reaped"]
+
+def test_user_writes_lock_houses_before_the_transaction(monkeypatch, tmp_path):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from app import main
+    from app.storage import SQLiteRepository
+
+    # On SQLite a stripe taken inside a transaction waits on busy_timeout behind the house writer
+    monkeypatch.setattr(main, "repo", SQLiteRepository(str(tmp_path / "houses.db")))
+    client.post("/users", json={"user_id": 220, "name": "Locker"})
+    for house_id in (220, 221):
+        client.post("/house", json={"house_id": house_id, "name": "Locked", "owner": {"user_id": 220, "name": "Locker"}})
+
+    def write(i):
+        if i % 3 == 0:
+            return client.patch("/users/220", json={"name": f"Locker {i}"}).status_code
+        return client.post(f"/house/{220 + i % 2}/floor", json={"floor_id": 22000 + i, "name": "Raced"}).status_code
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(8) as pool:
+        assert set(pool.map(write, range(60))) == {200}
+    assert time.monotonic() - start < 10
+    assert client.get("/house/220/changes").json()["version"] + client.get("/house/221/changes").json()["version"] == 80
+
+def test_deleted_house_is_gone_before_it_is_reaped(monkeypatch):
+    from app import main
+
+    client.post("/users", json={"user_id": 230, "name": "Mover"})
+    house = {"house_id": 230, "name": "Big", "owner": {"user_id": 230, "name": "Mover"}, "floors": [
+        {"floor_id": 230 + f, "name": "F", "hallways": [], "rooms": [
+            {"room_id": 2300 + f, "name": "R", "devices": [
+                {"device_id": 230000 + f * 100 + d, "device_type": "humidity", "device_info": d} for d in range(100)]}]}
+        for f in range(10)]}
+    assert client.post("/house/bulk", json=house).status_code == 200
+    # Hold the reap job back, as a large house keeps the reaper busy for a while
+    held = []
+    monkeypatch.setattr(main.reaper, "release", held.append)
+    response = client.delete("/house/230")
+    assert response.status_code == 202 and len(held) == 1
+    assert main.reaper.status(response.json()["job_id"])["status"] == "pending"
+
+    assert client.get("/house/230").status_code == 404
+    assert client.get("/house/230/changes").status_code == 404
+    assert client.patch("/house/230", json={"name": "Gone"}).status_code == 404
+    assert client.post("/house/230/floor", json={"floor_id": 240, "name": "New"}).status_code == 404
+    assert client.delete("/house/230").status_code == 404
+    assert client.get("/house/230/floors/230").status_code == 404
+    assert client.get("/house/230/aggregates").status_code == 404
+    assert client.get("/house/230/floor/230/room/2300").status_code == 404
+    assert client.post("/telemetry", json=[{"device_id": 230000, "device_info": 1}]).json()["results"][0]["status"] == 404
+
+    main.Reaper.release(main.reaper, held[0])
+    assert main.reaper.wait(response.json()["job_id"], timeout=10)
+    assert not main.repo.contains("device", 230000)
+
+def test_unnumbered_house_locks_its_own_stripe(monkeypatch):
+    from app import main
+
+    # The stripe is picked from the house id, so the id must be in place first
+    seen = []
+    scope_lock = main.scope_lock
+
+    def recording(arguments):
+        if "house" in arguments:
+            seen.append(arguments["house"].house_id)
+        return scope_lock(arguments)
+    monkeypatch.setattr(main, "scope_lock", recording)
+    client.post("/users", json={"user_id": 231, "name": "Locker"})
+    owner = {"user_id": 231, "name": "Locker"}
+    house = client.post("/house", json={"name": "Unnumbered", "owner": owner}).json()
+    imported = client.post("/house/bulk", json={"name": "Imported", "owner": owner, "floors": []}).json()
+    assert seen == [house["house_id"], imported["house_id"]] and None not in seen
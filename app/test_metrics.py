@@ -0,0 +1,27 @@
+import logging
+import time
+
+from app.metrics import Metrics, SlowRequestProfiler
+
+
+def test_histogram_is_cumulative():
+    metrics = Metrics(buckets=(0.01, 0.1))
+    for seconds in (0.005, 0.05, 0.05, 3.0):
+        metrics.observe("GET", "/x", 200, seconds)
+    text = metrics.render({"user": 2})
+    assert 'le="0.01"} 1' in text and 'le="0.1"} 3' in text and 'le="+Inf"} 4' in text
+    assert 'house_http_request_duration_seconds_count{method="GET",route="/x"} 4' in text
+    assert 'house_store_records{kind="user"} 2' in text
+
+
+def test_profiler_dumps_slow_requests(caplog):
+    profiler = SlowRequestProfiler(threshold=0.02, interval=0.001)
+    with caplog.at_level(logging.WARNING, logger="app.metrics"):
+        token = profiler.start()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        profiler.finish(token, "GET /slow", 0.05)
+        profiler.finish(profiler.start(), "GET /fast", 0.001)
+    assert len(caplog.records) == 1
+    assert "GET /slow" in caplog.text and "test_profiler_dumps_slow_requests" in caplog.text
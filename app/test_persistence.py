@@ -0,0 +1,55 @@
+from app.persistence import Journal
+
+
+def test_log_tail_replays_after_snapshot(tmp_path):
+    journal = Journal(str(tmp_path), snapshot_every=3)
+    journal.open()
+    journal.append("op", {"n": 1})
+    journal.append("op", {"n": 2})
+    journal.append("op", {"n": 3}, compact=lambda: journal.compact({"n": 3}))
+    journal.close()  # waits for the compaction
+    journal.open()
+    journal.append("op", {"n": 4})
+    journal.close()
+
+    assert Journal(str(tmp_path)).load() == ({"n": 3}, [("op", {"n": 4})])
+
+
+def test_compaction_interrupted_before_snapshot(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.open()
+    journal.append("op", {"n": 1})
+    journal.checkpoint({"n": 1})  # never written out
+    journal.append("op", {"n": 2})
+    journal.close()
+
+    assert Journal(str(tmp_path)).load() == (None, [("op", {"n": 1}), ("op", {"n": 2})])
+
+    journal = Journal(str(tmp_path))
+    journal.load()
+    journal.compact({"n": 2})
+    journal.close()
+    assert Journal(str(tmp_path)).load() == ({"n": 2}, [])
+
+def test_torn_final_record_is_ignored(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.open()
+    journal.append("op", {"n": 1})
+    journal.close()
+    with open(journal.wal_path, "ab") as f:
+        f.write(b'["op",{"n"')
+
+    assert Journal(str(tmp_path)).load() == (None, [("op", {"n": 1})])
+
+
+def test_appends_after_torn_record_survive(tmp_path):
+    with open(tmp_path / "wal.log", "wb") as f:
+        f.write(b'["op",{"n"')
+    journal = Journal(str(tmp_path))
+    assert journal.load() == (None, [])
+    journal.open()
+    journal.append("op", {"n": 1})
+    journal.append("op", {"n": 2})
+    journal.close()
+
+    assert Journal(str(tmp_path)).load() == (None, [("op", {"n": 1}), ("op", {"n": 2})])
@@ -0,0 +1,16 @@
+from app.models import Device
+from app.registry import DeviceRegistry
+
+
+def test_delete_keeps_slots_dense():
+    registry = DeviceRegistry()
+    for device_id in (10, 20, 30):
+        assert registry.insert(Device(device_id=device_id, device_type="humidity", device_info=device_id), ("room", 1))
+    assert not registry.insert(Device(device_id=20, device_type="temperature", device_info=0), ("room", 1))
+    registry.delete(10)
+    assert list(registry) == [30, 20]
+    assert registry.slots == {30: 0, 20: 1}
+    registry.set_value(30, 7)
+    assert registry.get(30) == Device(device_id=30, device_type="humidity", device_info=7)
+    assert registry.parent(20) == ("room", 1)
+    assert registry.get(10) is None and len(registry) == 2
@@ -0,0 +1,168 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app.ids import SPAN
+from app.shard import create_router
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def router():
+    urls, workers = [], []
+    for i in range(2):
+        port = free_port()
+        urls.append(f"http://127.0.0.1:{port}")
+        workers.append(subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port)],
+                                        env={**os.environ, "HOUSE_ID_BASE": str(i * SPAN)},
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    try:
+        for url in urls:
+            for _ in range(100):
+                try:
+                    httpx.get(url + "/metrics")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.1)
+        with TestClient(create_router(urls)) as client:
+            yield client, urls
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+
+def test_houses_are_partitioned_and_users_replicated(router):
+    client, urls = router
+    client.post("/users", json={"user_id": 1, "name": "Sharded"})
+    for house_id in (1, 2, 3):
+        # Client ids below a house must be in the range of the worker owning it
+        base = house_id % 2 * SPAN
+        house = {"house_id": house_id, "name": f"H{house_id}", "owner": {"user_id": 1, "name": "Sharded"},
+                 "floors": [{"floor_id": base + house_id, "name": "F", "hallways": [], "rooms": [
+                     {"room_id": base + house_id, "name": "R", "devices": [
+                         {"device_id": base + house_id * 10, "device_type": "humidity", "device_info": house_id}]}]}]}
+        assert client.post("/house/bulk", json=house).status_code == 200
+    assert httpx.get(urls[1] + "/house/1").status_code == 200
+    assert httpx.get(urls[0] + "/house/1").status_code == 404
+    assert all(httpx.get(url + "/users/1").status_code == 200 for url in urls)
+
+    assert client.get("/house/2/floor/2/room/2").json()["devices"][0]["device_id"] == 20
+    page = client.get("/devices", params={"limit": 2}).json()
+    assert [item["device_id"] for item in page["items"]] == [20, SPAN + 10]
+    rest = client.get("/devices", params={"limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [item["device_id"] for item in rest["items"]] == [SPAN + 30] and rest["next_cursor"] is None
+    assert client.get("/devices", params={"limit": "abc"}).status_code == 422
+    assert client.get("/rooms", params={"house_id": "x"}).status_code == 422
+
+    result = client.post("/telemetry", json=[{"device_id": SPAN + 30, "device_info": 7}, {"device_id": 99, "device_info": 1}]).json()
+    assert [r["status"] for r in result["results"]] == [200, 404]
+    assert client.get(f"/devices/{SPAN + 30}/history").json()["samples"][-1]["value"] == 7
+
+    # The same floor id on both workers would be two floors answering to one id
+    assert client.post("/house/1/floor", json={"floor_id": 2, "name": "Clash"}).status_code == 400
+    assert client.post("/batch", json={"house_id": 1, "operations": [
+        {"op": "create_room", "args": {"floor_id": SPAN + 1, "room": {"room_id": 2, "name": "Clash"}}}]}).status_code == 400
+    assert client.post("/house/1/floor", json={"floor_id": SPAN + 2, "name": "Upper"}).status_code == 200
+    block = client.post("/ids/reserve", params={"kind": "room", "house_id": 1}).json()
+    assert SPAN <= block["first"] < 2 * SPAN
+
+    response = client.delete("/house/3")
+    assert response.status_code == 202
+    job = response.json()["job_id"]
+    for _ in range(50):
+        if client.get(f"/jobs/{job}").json()["status"] == "done":
+            break
+        time.sleep(0.05)
+    assert client.get(f"/jobs/{job}").json()["id"] == 3
+    assert client.get("/shards", params={"house_id": 3}).json()["url"] == urls[1]
+
+    assert [h["house_id"] for h in client.get("/users/1/houses").json()["houses"]] == [1, 2]
+    assert client.delete("/users/1").status_code == 400
+    assert all(httpx.get(url + "/users/1").status_code == 200 for url in urls)
+    deleted = client.delete("/users/1", params={"cascade": "true"}).json()
+    assert len(deleted["job_ids"]) == 2
+    assert client.get("/house/1").status_code == 404 and client.get("/users/1").status_code == 404
+
+
+def test_router_allocates_ids(router):
+    client, urls = router
+    user = client.post("/users", json={"name": "Unnumbered"}).json()
+    assert all(httpx.get(f"{url}/users/{user['user_id']}").json() == user for url in urls)
+    house = client.post("/house", json={"name": "Unnumbered", "owner": user}).json()
+    assert client.get(f"/house/{house['house_id']}").status_code == 200
+    floor = client.post(f"/house/{house['house_id']}/floor", json={"name": "Ground"}).json()
+    # Allocated by the owning worker, from its own range
+    shard = client.get("/shards", params={"house_id": house["house_id"]}).json()["shard"]
+    assert shard * SPAN < floor["floor_id"] < (shard + 1) * SPAN
+    block = client.post("/ids/reserve", params={"kind": "device", "count": 5}).json()
+    assert block["last"] - block["first"] == 4
+
+    # Shard 0 allocates house ids, including past ones picked for shard 1's houses
+    chosen = 10_001
+    assert client.post("/house", json={"house_id": chosen, "name": "Chosen", "owner": user}).status_code == 200
+    allocated = client.post("/house", json={"name": "Allocated", "owner": user})
+    assert allocated.status_code == 200 and allocated.json()["house_id"] > chosen
+
+
+def test_rules_and_alerts_span_workers(router):
+    client, urls = router
+    client.post("/users", json={"user_id": 5, "name": "Alerted"})
+    for house_id in (5, 6):
+        base = house_id % 2 * SPAN
+        house = {"house_id": house_id, "name": f"H{house_id}", "owner": {"user_id": 5, "name": "Alerted"},
+                 "floors": [{"floor_id": base + house_id, "name": "F", "hallways": [], "rooms": [
+                     {"room_id": base + house_id, "name": "R", "devices": [
+                         {"device_id": base + house_id * 10, "device_type": "temperature", "device_info": 20}]}]}]}
+        assert client.post("/house/bulk", json=house).status_code == 200
+    rule = {"rule_id": 1, "device_type": "temperature", "op": ">", "threshold": 30}
+    assert client.post("/rules", json=rule).status_code == 200
+    assert all(httpx.get(url + "/rules/1").status_code == 200 for url in urls)
+    assert client.post("/rules", json=rule).status_code == 400
+
+    start = client.get("/alerts").json()["last_alert_id"]
+    client.post("/telemetry", json=[{"device_id": SPAN + 50, "device_info": 31}])
+    client.post("/telemetry", json=[{"device_id": 60, "device_info": 32}])
+    first = client.get("/alerts", params={"after": start, "limit": 1}).json()
+    assert [alert["device_id"] for alert in first["alerts"]] == [SPAN + 50]
+    rest = client.get("/alerts", params={"after": first["last_alert_id"]}).json()
+    assert [alert["device_id"] for alert in rest["alerts"]] == [60]
+    # A later alert on one worker is still found after a cursor past the other's
+    client.post("/telemetry", json=[{"device_id": SPAN + 50, "device_info": 20}, {"device_id": SPAN + 50, "device_info": 33}])
+    latest = client.get("/alerts", params={"after": rest["last_alert_id"]}).json()
+    assert [alert["value"] for alert in latest["alerts"]] == [33]
+    assert len({alert["alert_id"] for alert in first["alerts"] + rest["alerts"] + latest["alerts"]}) == 3
+    assert client.get("/alerts", params={"after": "garbage"}).status_code == 400
+
+    assert client.delete("/rules/1").status_code == 200
+    assert all(httpx.get(url + "/rules/1").status_code == 404 for url in urls)
+
+    # A scoped rule lives on the worker owning its scope, and its id is still taken everywhere
+    scoped = {"rule_id": 7, "scope": "house", "scope_id": 5, "op": ">", "threshold": 40}
+    assert client.post("/rules", json=scoped).status_code == 200
+    assert [httpx.get(url + "/rules/7").status_code for url in urls] == [404, 200]
+    assert client.get("/rules/7").json()["scope_id"] == 5
+    assert client.post("/rules", json={"rule_id": 7, "op": ">", "threshold": 1}).status_code == 400
+    room = {"rule_id": 8, "scope": "room", "scope_id": 6, "op": ">", "threshold": 40}
+    assert client.post("/rules", json=room).status_code == 200
+    assert [httpx.get(url + "/rules/8").status_code for url in urls] == [200, 404]
+    missing = {"rule_id": 9, "scope": "house", "scope_id": 99, "op": ">", "threshold": 40}
+    assert client.post("/rules", json=missing).status_code == 404
+    assert client.get("/rules/9").status_code == 404
+
+    before = client.get("/alerts").json()["last_alert_id"]
+    client.post("/telemetry", json=[{"device_id": SPAN + 50, "device_info": 41}])
+    assert [alert["rule_id"] for alert in client.get("/alerts", params={"after": before}).json()["alerts"]] == [7]
+    assert client.delete("/rules/7").status_code == 200 and client.delete("/rules/8").status_code == 200
+    assert client.get("/rules/7").status_code == 404 and client.delete("/rules/7").status_code == 404
@@ -0,0 +1,97 @@
+import pytest
+
+from app.models import Device, Floor, House, Room, User
+from app.storage import DuplicateError, MemoryRepository, SQLiteRepository
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def repo(request):
+    repo = MemoryRepository() if request.param == "memory" else SQLiteRepository()
+    yield repo
+    repo.close()
+
+
+def populate(repo):
+    repo.add("user", User(user_id=1, name="Owner"))
+    repo.add("house", House(house_id=1, name="Home", owner=User(user_id=1, name="Owner")), parent=1)
+    repo.add("floor", Floor(floor_id=1, name="Ground"), parent=1)
+    for room_id in (3, 1, 2):
+        repo.add("room", Room(room_id=room_id, name=f"Room {room_id}"), parent=1)
+    repo.add("device", Device(device_id=7, device_type="humidity", device_info=40), parent=("room", 1))
+
+
+def test_parents_and_children(repo):
+    populate(repo)
+    assert repo.children("floor", 1, "room") == [3, 1, 2]
+    assert repo.children("user", 1, "house") == [1]
+    assert repo.parent("room", 2) == 1
+    assert repo.parent("device", 7) == ("room", 1)
+    assert repo.parent("room", 99) is None
+
+
+def test_add_rejects_taken_id(repo):
+    populate(repo)
+    with pytest.raises(DuplicateError):
+        repo.add("room", Room(room_id=2, name="Again"), parent=1)
+    assert repo.get("room", 2).name == "Room 2"
+
+
+def test_update_and_remove(repo):
+    populate(repo)
+    repo.update("device", 7, device_info=55)
+    assert repo.get("device", 7).device_info == 55
+    repo.remove("device", 7)
+    repo.remove("room", 1)
+    assert not repo.contains("device", 7)
+    assert repo.children("floor", 1, "room") == [3, 2]
+    assert repo.count("room") == 2
+
+
+def test_transaction_rolls_back(repo):
+    populate(repo)
+    with pytest.raises(RuntimeError):
+        with repo.transaction():
+            repo.update("room", 1, name="Renamed")
+            repo.update("device", 7, device_info=99)
+            repo.remove("device", 7)
+            repo.remove("room", 1)
+            repo.detach("room", 3)
+            repo.add("room", Room(room_id=4, name="New"), parent=1)
+            raise RuntimeError
+    assert repo.get("room", 1).name == "Room 1"
+    assert repo.get("device", 7).device_info == 40
+    assert repo.children("floor", 1, "room") == [3, 1, 2]
+    assert repo.children("room", 1, "device") == [7]
+    assert repo.parent("room", 3) == 1 and not repo.contains("room", 4)
+    assert [key for key, _, _ in repo.page("device", {"min_info": 0})] == [(40, 7)]
+
+
+def test_page_filters_and_keyset(repo):
+    populate(repo)
+    repo.add("device", Device(device_id=5, device_type="temperature", device_info=18), parent=("room", 2))
+    repo.add("device", Device(device_id=9, device_type="humidity", device_info=55), parent=("room", 3))
+    assert [key for key, _, _ in repo.page("room", {"house_id": 1}, limit=2)] == [1, 2]
+    assert [key for key, _, _ in repo.page("room", {"house_id": 1}, after=2)] == [3]
+    assert [key for key, _, _ in repo.page("device", {"device_type": "humidity"})] == [7, 9]
+    assert repo.page("device", {"floor_id": 1, "device_type": "temperature"})[0][2] == ("room", 2)
+    assert [key for key, _, _ in repo.page("device", {"min_info": 20})] == [(40, 7), (55, 9)]
+    repo.update("device", 9, device_info=10)
+    assert [key for key, _, _ in repo.page("device", {"max_info": 40}, after=(10, 9))] == [(18, 5), (40, 7)]
+    repo.remove("device", 7)
+    assert [key for key, _, _ in repo.page("device", {"house_id": 1})] == [5, 9]
+    assert repo.page("house", {"user_id": 2}) == []
+
+
+def test_detach_hides_subtree_until_removed(repo):
+    populate(repo)
+    repo.detach("room", 1)
+    assert repo.parent("room", 1) is None
+    assert repo.children("floor", 1, "room") == [3, 2]
+    assert repo.children("room", 1, "device") == [7]
+    assert repo.page("device", {}) == []
+    with pytest.raises(DuplicateError):
+        repo.add("room", Room(room_id=1, name="Again"), parent=1)
+    repo.remove("device", 7)
+    repo.remove("room", 1)
+    repo.add("room", Room(room_id=1, name="Again"), parent=1)
+    assert repo.parent("room", 1) == 1
@@ -0,0 +1,204 @@
+"""In-process load and latency benchmark over synthetic buildings.
+
+    python -m benchmarks.bench --houses 20 --floors 3 --rooms 5 --devices 4
+    python -m benchmarks.bench --save        # record benchmarks/baseline.json
+    python -m benchmarks.bench --compare     # fail if p50/p99 regressed
+
+Every endpoint family is driven through the ASGI app with TestClient, so the
+numbers include routing, validation and serialization but no network. The
+first calls of each family are traced for peak memory and left out of the
+timings, since tracing would otherwise distort the latencies.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Calls traced by tracemalloc, rather than timed, per family
+MEMORY_SAMPLES = 20
+# Allowed slowdown over the baseline before a metric counts as a regression
+TOLERANCE = 0.25
+
+
+def building(house_id: int, owner: dict, ids, rng: random.Random, floors: int, rooms: int, devices: int) -> dict:
+    """A nested House document: `rooms` rooms and one hallway per floor, each
+    holding `devices` devices."""
+    def device_list():
+        return [{"device_id": next(ids), "device_type": rng.choice(["humidity", "temperature"]),
+                 "device_info": rng.randint(0, 100)} for _ in range(devices)]
+
+    return {
+        "house_id": house_id, "name": f"House {house_id}", "owner": owner,
+        "floors": [{
+            "floor_id": next(ids), "name": f"Floor {f}",
+            "rooms": [{"room_id": next(ids), "name": f"Room {r}", "devices": device_list()} for r in range(rooms)],
+            "hallways": [{"hallway_id": next(ids), "name": "Hallway", "devices": device_list()}],
+        } for f in range(floors)],
+    }
+
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(p * (len(ordered) - 1)))]
+
+
+class Bench:
+    def __init__(self, client: TestClient):
+        self.client = client
+        self.results = {}
+
+    def call(self, name: str, method: str, url: str, kwargs: dict):
+        response = self.client.request(method, url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{name}: {method} {url} -> {response.status_code} {response.text[:200]}")
+
+    def run(self, name: str, calls: list):
+        """Run every `(method, url, kwargs)` call. The first few (at most half)
+        run under tracemalloc for the peak memory and double as warm-up; the
+        rest are timed."""
+        traced = min(MEMORY_SAMPLES, len(calls) // 2)
+        tracemalloc.start()
+        for call in calls[:traced]:
+            self.call(name, *call)
+        peak = tracemalloc.get_traced_memory()[1] if traced else 0
+        tracemalloc.stop()
+
+        timings = []
+        started = time.perf_counter()
+        for call in calls[traced:]:
+            t0 = time.perf_counter()
+            self.call(name, *call)
+            timings.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+
+        self.results[name] = {
+            "calls": len(timings),
+            "ops_per_sec": len(timings) / elapsed,
+            "p50_ms": percentile(timings, 0.50) * 1000,
+            "p99_ms": percentile(timings, 0.99) * 1000,
+            "peak_kib": peak / 1024,
+        }
+
+
+def drive(bench: Bench, houses: int, floors: int, rooms: int, devices: int, seed: int, id_base: int):
+    rng = random.Random(seed)
+    ids = iter(range(id_base + houses + 1, sys.maxsize))
+    owner = {"user_id": id_base, "name": "Benchmark Owner"}
+    bench.client.post("/users", json=owner)
+
+    docs = [building(id_base + h, owner, ids, rng, floors, rooms, devices) for h in range(1, houses + 1)]
+    # Half the houses go in with one request each, the rest entity by entity
+    split = max(1, houses // 2)
+    bench.run("house_bulk_import", [("POST", "/house/bulk", {"json": doc}) for doc in docs[:split]])
+    creates = {"house": [], "floor": [], "room": [], "hallway": [], "device": []}
+    for doc in docs[split:]:
+        h = doc["house_id"]
+        creates["house"].append(("POST", "/house", {"json": {**doc, "floors": []}}))
+        for floor in doc["floors"]:
+            f = floor["floor_id"]
+            creates["floor"].append(("POST", f"/house/{h}/floor", {"json": {**floor, "rooms": [], "hallways": []}}))
+            for kind in ("room", "hallway"):
+                for container in floor[kind + "s"]:
+                    c = container[f"{kind}_id"]
+                    creates[kind].append(("POST", f"/house/{h}/floor/{f}/{kind}", {"json": {**container, "devices": []}}))
+                    creates["device"] += [("POST", f"/house/{h}/floor/{f}/{kind}/{c}/device", {"json": d})
+                                          for d in container["devices"]]
+    for kind, calls in creates.items():
+        if calls:
+            bench.run(f"create_{kind}", calls)
+
+    rooms_by_path = [(doc["house_id"], floor["floor_id"], room)
+                     for doc in docs for floor in doc["floors"] for room in floor["rooms"]]
+    device_ids = [d["device_id"] for _, _, room in rooms_by_path for d in room["devices"]]
+
+    bench.run("get_house", [("GET", f"/house/{doc['house_id']}", {}) for doc in docs])
+    bench.run("get_house_msgpack", [("GET", f"/house/{doc['house_id']}", {"headers": {"accept": "application/msgpack"}})
+                                    for doc in docs])
+    bench.run("get_floor", [("GET", f"/house/{doc['house_id']}/floors/{floor['floor_id']}", {})
+                            for doc in docs for floor in doc["floors"]])
+    bench.run("get_room", [("GET", f"/house/{h}/floor/{f}/room/{room['room_id']}", {})
+                           for h, f, room in rooms_by_path])
+    bench.run("get_device", [("GET", f"/house/{h}/floor/{f}/room/{room['room_id']}/device/{d['device_id']}", {})
+                             for h, f, room in rooms_by_path for d in room["devices"]])
+    bench.run("update_device", [("PATCH", f"/house/{h}/floor/{f}/room/{room['room_id']}/device/{d['device_id']}",
+                                 {"json": {"device_info": rng.randint(0, 100)}})
+                                for h, f, room in rooms_by_path for d in room["devices"]])
+    if device_ids:
+        batches = [device_ids[i:i + 100] for i in range(0, len(device_ids), 100)]
+        bench.run("telemetry_batch", [("POST", "/telemetry", {"json": [{"device_id": d, "device_info": rng.randint(0, 100)}
+                                                                     for d in batch]}) for batch in batches])
+        bench.run("device_history", [("GET", f"/devices/{d}/history", {"params": {"buckets": 10}}) for d in device_ids])
+    bench.run("house_aggregates", [("GET", f"/house/{doc['house_id']}/aggregates", {}) for doc in docs])
+    bench.run("list_devices", [("GET", "/devices", {"params": {"house_id": doc["house_id"], "limit": 100}})
+                               for doc in docs])
+    bench.run("delete_house", [("DELETE", f"/house/{doc['house_id']}", {}) for doc in docs])
+    bench.client.delete(f"/users/{owner['user_id']}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {before[metric]:.3f} -> {result[metric]:.3f}")
+    return regressions
+
+
+def report(results: dict):
+    print(f"{'endpoint':<20} {'calls':>6} {'ops/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'peak KiB':>9}")
+    for name, r in results.items():
+        print(f"{name:<20} {r['calls']:>6} {r['ops_per_sec']:>10.0f} {r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['peak_kib']:>9.0f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--houses", type=int, default=20)
+    parser.add_argument("--floors", type=int, default=3)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=530)
+    parser.add_argument("--id-base", type=int, default=10_000_000,
+                        help="first id used, kept clear of any existing data")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="exit 1 if p50/p99 regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    config = {"houses": args.houses, "floors": args.floors, "rooms": args.rooms,
+              "devices": args.devices, "seed": args.seed}
+    bench = Bench(TestClient(app))
+    drive(bench, args.houses, args.floors, args.rooms, args.devices, args.seed, args.id_base)
+    report(bench.results)
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"baseline was recorded with {baseline['config']}, not {config}", file=sys.stderr)
+            return 2
+        regressions = compare(bench.results, baseline["results"], args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "python": platform.python_version(), "results": bench.results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
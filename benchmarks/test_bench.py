@@ -0,0 +1,13 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from benchmarks.bench import Bench, compare, drive
+
+
+def test_benchmark_drives_every_family():
+    bench = Bench(TestClient(app))
+    drive(bench, houses=2, floors=1, rooms=1, devices=1, seed=1, id_base=20_000_000)
+    assert {"house_bulk_import", "create_device", "get_house", "telemetry_batch", "delete_house"} <= set(bench.results)
+    slower = {name: {**r, "p50_ms": r["p50_ms"] * 2 + 1} for name, r in bench.results.items()}
+    assert compare(slower, bench.results, 0.25)
+    assert not compare(bench.results, bench.results, 0.25)